@@ -0,0 +1,78 @@
+"""
+Measure what `breakdown=True` costs, with and without accessing the groups,
+compared to plain `calculate_margin` calls on random 8-leg books:
+
+    $ python benchmarks/breakdown.py
+"""
+
+import random
+import statistics
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+from margin_estimator import Option, Shares, Underlying, calculate_margin
+from margin_estimator.margin import calculate_requirements
+from margin_estimator.models import MarginRequirements
+
+BOOKS = 2000
+LEGS = 8
+ROUNDS = 5
+
+
+def random_book(rng: random.Random) -> list[Option | Shares]:
+    expirations = [date.today() + timedelta(days=d) for d in (7, 30, 120)]
+    book: list[Option | Shares] = [
+        Option(
+            expiration=rng.choice(expirations),
+            price=Decimal(rng.randrange(5, 2000)) / 100,
+            quantity=rng.choice([-3, -2, -1, 1, 2, 3]),
+            strike=Decimal(rng.randrange(80, 121)),
+            type=rng.choice(["C", "P"]),
+        )
+        for _ in range(LEGS)
+    ]
+    if rng.random() < 0.3:
+        book.append(Shares(price=Decimal(100), quantity=rng.choice([-200, 300])))
+    return book
+
+
+def unwrapped(book, underlying):
+    # what a plain call did before breakdowns were added
+    total = calculate_requirements(book, underlying)
+    return MarginRequirements.model_construct(
+        cash_requirement=total.cash_requirement,
+        margin_requirement=total.margin_requirement,
+    )
+
+
+def breakdown(book, underlying):
+    return calculate_margin(book, underlying, breakdown=True)
+
+
+def breakdown_groups(book, underlying):
+    return calculate_margin(book, underlying, breakdown=True).groups
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    underlying = Underlying(price=100)
+    books = [random_book(rng) for _ in range(BOOKS)]
+    cases = {
+        "requirements only": unwrapped,
+        "calculate_margin": calculate_margin,
+        "breakdown, unused": breakdown,
+        "breakdown, groups": breakdown_groups,
+    }
+    times: dict[str, list[float]] = {name: [] for name in cases}
+    # interleave the cases so that they see the same machine noise
+    for _ in range(ROUNDS):
+        for name, func in cases.items():
+            start = time.perf_counter()
+            for book in books:
+                func(book, underlying)
+            times[name].append((time.perf_counter() - start) / BOOKS)
+
+    print(f"{BOOKS} books of {LEGS} legs, median of {ROUNDS} rounds")
+    for name, samples in times.items():
+        print(f"{name + ':':20} {statistics.median(samples) * 1e6:6.1f} µs per call")
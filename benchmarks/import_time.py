@@ -0,0 +1,39 @@
+"""
+Measure cold import time of the package, with and without the pydantic models.
+
+    $ python benchmarks/import_time.py
+"""
+
+import statistics
+import subprocess
+import sys
+
+RUNS = 20
+SNIPPETS = {
+    "import margin_estimator": "import margin_estimator",
+    "import margin_estimator.models": "import margin_estimator.models",
+}
+
+
+def measure(snippet: str) -> float:
+    timings = []
+    for _ in range(RUNS):
+        out = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", snippet],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stderr
+        # sum cumulative times (in us) of top-level imports of the package
+        total = 0
+        for line in out.splitlines():
+            _, cumulative, name = line.split("|")
+            if name.startswith(" margin_estimator"):
+                total += int(cumulative)
+        timings.append(total / 1000)
+    return statistics.median(timings)
+
+
+if __name__ == "__main__":
+    for name, snippet in SNIPPETS.items():
+        print(f"{name:<32} {measure(snippet):>8.1f} ms")
@@ -0,0 +1,68 @@
+"""
+Measure the cost and benefit of `optimize=True` on random 50-leg books:
+
+    $ python benchmarks/optimizer.py
+"""
+
+import random
+import statistics
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+
+from margin_estimator import OptionLeg, OptionType, UnderlyingInfo
+from margin_estimator.margin import _net, calculate_requirements
+from margin_estimator.optimizer import calculate_optimized
+
+BOOKS = 200
+LEGS = 50
+
+
+def random_book(rng: random.Random) -> list[OptionLeg]:
+    expirations = [date.today() + timedelta(days=d) for d in (7, 30, 60, 120)]
+    return [
+        OptionLeg(
+            rng.choice(expirations),
+            Decimal(rng.randrange(5, 2000)) / 100,
+            rng.choice([-5, -3, -2, -1, 1, 2, 3, 5]),
+            Decimal(rng.randrange(80, 121)),
+            rng.choice(list(OptionType)),
+        )
+        for _ in range(LEGS)
+    ]
+
+
+if __name__ == "__main__":
+    rng = random.Random(0)
+    underlying = UnderlyingInfo(Decimal(100))
+    greedy_times, optimizer_times, savings = [], [], []
+    for _ in range(BOOKS):
+        book = random_book(rng)
+        start = time.perf_counter()
+        greedy = calculate_requirements(book, underlying)
+        greedy_times.append(time.perf_counter() - start)
+        stock, netted = _net(book)
+        start = time.perf_counter()
+        # no deadline, to see how long a full solve takes
+        optimized = calculate_optimized(
+            stock, netted, underlying, date.today(), float("inf")
+        )
+        optimizer_times.append(time.perf_counter() - start)
+        assert optimized is not None
+        best = min(optimized.margin_requirement, greedy.margin_requirement)
+        savings.append(1 - best / greedy.margin_requirement)
+
+    def summary(times: list[float]) -> str:
+        times = sorted(times)
+        median = statistics.median(times) * 1000
+        p99 = times[int(len(times) * 0.99) - 1] * 1000
+        return f"median {median:.2f} ms, p99 {p99:.2f} ms"
+
+    print(f"{BOOKS} books of {LEGS} legs")
+    print(f"greedy:    {summary(greedy_times)}")
+    print(f"optimizer: {summary(optimizer_times)}")
+    improved = sum(1 for s in savings if s > 0)
+    print(
+        f"lower requirement for {improved}/{BOOKS} books, "
+        f"median saving {statistics.median(savings):.1%}"
+    )
@@ -0,0 +1,107 @@
+"""
+Measure how `ReplayEngine` scales with the number of fills:
+
+    $ python benchmarks/replay.py
+
+Each fill re-matches its book's side and totals the book again, so it costs
+O(n log n) in the number of contracts n open in that account and underlying.
+A single book that keeps opening new contracts therefore replays in quadratic
+time, while books that trade a bounded set of contracts replay in linear time.
+Calling `calculate_margin` on every fill's book so far is shown for comparison.
+"""
+
+import random
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from margin_estimator import ETFType, Fill, ReplayEngine, Underlying, calculate_margin
+from margin_estimator.models import Option
+
+SIZES = [500, 1000, 2000, 4000]
+# calculate_margin per fill is much slower, so it's only run on the smaller logs
+RECALCULATE_SIZES = [500, 1000]
+START = datetime(2027, 3, 1, 9, 30)
+UNDERLYINGS = {"SPY": Underlying(price=600, etf_type=ETFType.BROAD)}
+
+
+def symbol(expiration: date, type: str, strike: int) -> str:
+    return f"SPY   {expiration:%y%m%d}{type}{strike * 1000:08d}"
+
+
+def growing_book(n: int, rng: random.Random) -> list[Fill]:
+    """
+    One account opening a new contract on every fill.
+    """
+    contracts = [
+        (START.date() + timedelta(days=7 * week), type, strike)
+        for week in range(1, 60)
+        for type in "CP"
+        for strike in range(400, 800)
+    ]
+    return [
+        Fill(
+            "a",
+            symbol(*contract),
+            Decimal(rng.randrange(50, 2000)) / 100,
+            rng.choice([-2, -1, 1, 2]),
+            START,
+        )
+        for contract in rng.sample(contracts, n)
+    ]
+
+
+def bounded_books(n: int, rng: random.Random) -> list[Fill]:
+    """
+    20 accounts trading the same 20 contracts.
+    """
+    contracts = [
+        (START.date() + timedelta(days=days), type, strike)
+        for days in (18, 46)
+        for type in "CP"
+        for strike in range(590, 615, 5)
+    ]
+    return [
+        Fill(
+            f"account-{rng.randrange(20)}",
+            symbol(*rng.choice(contracts)),
+            Decimal(rng.randrange(50, 2000)) / 100,
+            rng.choice([-2, -1, 1, 2]),
+            START,
+        )
+        for _ in range(n)
+    ]
+
+
+def replay(fills: list[Fill]) -> float:
+    engine = ReplayEngine(UNDERLYINGS)
+    start = time.perf_counter()
+    for fill in fills:
+        engine.apply(fill)
+    return time.perf_counter() - start
+
+
+def recalculate(fills: list[Fill]) -> float:
+    books: dict[str, list[Option]] = {}
+    start = time.perf_counter()
+    for fill in fills:
+        book = books.setdefault(fill.account, [])
+        book.append(Option.from_occ(fill.symbol, fill.price, fill.quantity))
+        calculate_margin(book, UNDERLYINGS["SPY"], as_of=START.date())
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    for name, generate in (
+        ("one growing book", growing_book),
+        ("20 bounded books", bounded_books),
+    ):
+        print(name)
+        for n in SIZES:
+            fills = generate(n, random.Random(n))
+            seconds = replay(fills)
+            per_fill = seconds / n * 1e6
+            line = f"  {n:5} fills: replay {seconds:6.2f} s ({per_fill:5.0f} µs/fill)"
+            if n in RECALCULATE_SIZES:
+                line += f", calculate_margin per fill {recalculate(fills):6.2f} s"
+            print(line)
@@ -0,0 +1,63 @@
+"""
+Measure how `calculate_margin_many` scales across threads. Run it on both a regular
+and a free-threaded (3.13t) interpreter to compare:
+
+    $ python benchmarks/thread_scaling.py
+    $ python3.13t benchmarks/thread_scaling.py
+"""
+
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+
+from margin_estimator import ETFType, Option, Shares, Underlying, calculate_margin_many
+
+POSITIONS = 20_000
+THREADS = [1, 2, 4, 8, 16, 32]
+
+
+def random_positions(n: int) -> list:
+    rng = random.Random(0)
+    expirations = [date.today() + timedelta(days=d) for d in (7, 30, 120)]
+    positions = []
+    for _ in range(n):
+        underlying = Underlying(
+            price=Decimal(rng.randrange(9000, 11000)) / 100,
+            etf_type=rng.choice([None, ETFType.BROAD]),
+        )
+        legs: list[Option | Shares] = [
+            Option(
+                expiration=rng.choice(expirations),
+                price=Decimal(rng.randrange(5, 2000)) / 100,
+                quantity=rng.choice([-3, -2, -1, 1, 2, 3]),
+                strike=Decimal(rng.randrange(80, 121, 5)),
+                type=rng.choice(["C", "P"]),
+            )
+            for _ in range(rng.randrange(1, 9))
+        ]
+        if rng.random() < 0.1:
+            legs.append(Shares(price=underlying.price, quantity=100))
+        positions.append((legs, underlying))
+    return positions
+
+
+if __name__ == "__main__":
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", lambda: True)
+    print(f"Python {sys.version.split()[0]}, GIL enabled: {is_gil_enabled()}")
+    positions = random_positions(POSITIONS)
+    # warm up the caches so every thread count sees the same hit rate
+    calculate_margin_many(positions)
+    baseline = None
+    for threads in THREADS:
+        with ThreadPoolExecutor(threads) as executor:
+            start = time.perf_counter()
+            calculate_margin_many(positions, executor=executor)
+            elapsed = time.perf_counter() - start
+        rate = POSITIONS / elapsed
+        baseline = baseline or rate
+        print(
+            f"{threads:>3} threads {rate:>10,.0f} positions/s {rate / baseline:>6.2f}x"
+        )
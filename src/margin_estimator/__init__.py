@@ -1,11 +1,78 @@
-from .margin import calculate_margin
-from .models import ETFType, Option, OptionType, Shares, Underlying
+from typing import TYPE_CHECKING
+
+from .aggregate import MarginAggregator
+from .batch import calculate_margin_many, iter_margins
+from .bounds import check_margin, margin_bound
+from .chain import ChainTable, chain_margin_table
+from .fanout import PriceTable, TickFanout
+from .legs import (
+    ETFType,
+    OptionLeg,
+    OptionType,
+    Requirements,
+    SharesLeg,
+    UnderlyingInfo,
+)
+from .margin import (
+    calculate_margin,
+    calculate_margin_json,
+    calculate_requirements,
+    fast_path_stats,
+)
+from .registry import UnderlyingRegistry
+from .replay import Fill, ReplayEngine
+from .sensitivity import MarginSensitivity, margin_sensitivity
+from .snapshot import MarginSnapshot, snapshot_margins
+from .timeline import margin_timeline
+from .whatif import marginal_margin, max_quantity
+
+if TYPE_CHECKING:
+    from .models import Option, Shares, Underlying, load_legs_json
+
+# the pydantic models are only imported once they're first accessed
+_MODELS = {"Option", "Shares", "Underlying", "load_legs_json"}
+
+
+def __getattr__(name: str):
+    if name in _MODELS:
+        from . import models
+
+        return getattr(models, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 __all__ = [
+    "ChainTable",
     "ETFType",
+    "Fill",
+    "MarginAggregator",
+    "MarginSensitivity",
+    "MarginSnapshot",
     "Option",
+    "OptionLeg",
     "OptionType",
+    "PriceTable",
+    "ReplayEngine",
+    "Requirements",
     "Shares",
+    "SharesLeg",
+    "TickFanout",
     "Underlying",
+    "UnderlyingInfo",
+    "UnderlyingRegistry",
     "calculate_margin",
+    "calculate_margin_json",
+    "calculate_margin_many",
+    "calculate_requirements",
+    "chain_margin_table",
+    "check_margin",
+    "fast_path_stats",
+    "iter_margins",
+    "load_legs_json",
+    "margin_bound",
+    "margin_sensitivity",
+    "margin_timeline",
+    "marginal_margin",
+    "max_quantity",
+    "snapshot_margins",
 ]
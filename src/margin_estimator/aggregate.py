@@ -0,0 +1,117 @@
+import heapq
+from decimal import Decimal
+from typing import TYPE_CHECKING, Hashable, Iterable, Mapping
+
+from .legs import ETFType, Requirements
+
+if TYPE_CHECKING:
+    from .models import MarginRequirements
+
+    Result = MarginRequirements | Requirements
+
+
+class MarginAggregator:
+    """
+    Running firm-wide totals over a stream of results: overall, by `ETFType` (None
+    for equities) and by account, along with the `top_n` account/underlying pairs
+    with the largest margin requirements.
+
+    Memory only grows with the number of accounts and ETF types, not the number of
+    results. Aggregators filled by parallel workers can be combined with
+    :meth:`merge`.
+    """
+
+    def __init__(self, top_n: int = 100):
+        self.top_n = top_n
+        self.total = Requirements()
+        self.by_etf_type: dict[ETFType | None, Requirements] = {}
+        self.by_account: dict[Hashable, Requirements] = {}
+        self.count = 0
+        # min-heap of (margin, sequence, account, underlying, requirements), so the
+        # smallest of the top consumers is the one to evict; the sequence number
+        # keeps ties from comparing accounts
+        self._top: list[tuple[Decimal, int, Hashable, str, Requirements]] = []
+        self._sequence = 0
+
+    def add(
+        self,
+        account: Hashable,
+        underlying: str,
+        requirements: "Result",
+        etf_type: ETFType | None = None,
+    ):
+        """
+        Add the requirements of one account/underlying pair.
+        """
+        requirements = Requirements(
+            requirements.cash_requirement, requirements.margin_requirement
+        )
+        self.count += 1
+        self.total += requirements
+        self.by_etf_type[etf_type] = (
+            self.by_etf_type.get(etf_type, Requirements()) + requirements
+        )
+        self.by_account[account] = (
+            self.by_account.get(account, Requirements()) + requirements
+        )
+        self._push(account, underlying, requirements)
+
+    def consume(
+        self,
+        results: "Iterable[tuple[tuple[Hashable, str], Result]]",
+        etf_types: Mapping[str, ETFType | None] | None = None,
+    ) -> "MarginAggregator":
+        """
+        Add a stream of `((account, underlying), requirements)` pairs, e.g. from
+        :func:`~margin_estimator.iter_margins` with `(account, underlying)` as the
+        portfolio ids. `etf_types` maps underlyings to their `ETFType`.
+        """
+        etf_types = etf_types or {}
+        for (account, underlying), requirements in results:
+            self.add(account, underlying, requirements, etf_types.get(underlying))
+        return self
+
+    def merge(self, other: "MarginAggregator") -> "MarginAggregator":
+        """
+        Fold the results of another aggregator into this one.
+        """
+        self.count += other.count
+        self.total += other.total
+        for etf_type, requirements in other.by_etf_type.items():
+            self.by_etf_type[etf_type] = (
+                self.by_etf_type.get(etf_type, Requirements()) + requirements
+            )
+        for account, requirements in other.by_account.items():
+            self.by_account[account] = (
+                self.by_account.get(account, Requirements()) + requirements
+            )
+        for _, _, account, underlying, requirements in other._top:
+            self._push(account, underlying, requirements)
+        return self
+
+    def top_consumers(self) -> list[tuple[Hashable, str, Requirements]]:
+        """
+        The account/underlying pairs with the largest margin requirements, largest
+        first.
+        """
+        ranked = sorted(self._top, key=lambda entry: (-entry[0], entry[1]))
+        return [
+            (account, underlying, requirements)
+            for _, _, account, underlying, requirements in ranked
+        ]
+
+    def _push(self, account: Hashable, underlying: str, requirements: Requirements):
+        if self.top_n <= 0:
+            return
+        entry = (
+            requirements.margin_requirement,
+            self._sequence,
+            account,
+            underlying,
+            requirements,
+        )
+        self._sequence += 1
+        if len(self._top) < self.top_n:
+            heapq.heappush(self._top, entry)
+        elif entry[0] > self._top[0][0]:
+            heapq.heapreplace(self._top, entry)
@@ -0,0 +1,120 @@
+from collections import deque
+from concurrent.futures import Executor, Future
+from datetime import date
+from itertools import islice, repeat
+from typing import TYPE_CHECKING, Hashable, Iterable, Iterator, Sequence
+
+from .legs import UnderlyingInfo
+from .margin import _lookup_underlying, calculate_margin
+
+if TYPE_CHECKING:
+    from .models import MarginRequirements, Option, Shares, Underlying
+    from .registry import UnderlyingRegistry
+
+    Portfolio = tuple[Hashable, Sequence[Option | Shares], Underlying | str | int]
+    Position = tuple[Sequence[Option | Shares], Underlying | str | int]
+
+
+def calculate_margin_many(
+    positions: "Iterable[Position]",
+    executor: Executor | None = None,
+    chunk_size: int = 64,
+    as_of: date | None = None,
+    registry: "UnderlyingRegistry | None" = None,
+) -> "list[MarginRequirements]":
+    """
+    Calculate margin for many `(legs, underlying)` positions, returning the
+    requirements in input order.
+
+    With an `executor`, positions are evaluated in chunks of `chunk_size` on it. The
+    engine's caches and counters are safe to share between threads, including
+    on free-threaded builds of Python.
+
+    Underlyings can also be symbols or indexes in `registry`. They're looked up
+    before any position is calculated, so all of them use the same prices.
+    """
+    # resolved once, so every chunk agrees even if the run spans midnight
+    as_of = as_of or date.today()
+    positions = [
+        (legs, _resolve(underlying, registry)) for legs, underlying in positions
+    ]
+    chunks = [
+        positions[i : i + chunk_size] for i in range(0, len(positions), chunk_size)
+    ]
+    if executor is None:
+        results = map(_calculate_positions, chunks, repeat(as_of))
+    else:
+        results = executor.map(_calculate_positions, chunks, repeat(as_of))
+    return [requirements for chunk in results for requirements in chunk]
+
+
+def iter_margins(
+    portfolios: "Iterable[Portfolio]",
+    chunk_size: int = 256,
+    executor: Executor | None = None,
+    max_pending: int = 4,
+    as_of: date | None = None,
+    registry: "UnderlyingRegistry | None" = None,
+) -> "Iterator[tuple[Hashable, MarginRequirements]]":
+    """
+    Lazily calculate margin for an iterable of `(portfolio_id, legs, underlying)`
+    tuples, yielding `(portfolio_id, requirements)` in input order.
+
+    Portfolios are pulled `chunk_size` at a time, so memory use is bounded no matter
+    how long the iterable is. If an `executor` is given, up to `max_pending` chunks
+    are evaluated ahead on it while results are being consumed. `as_of` defaults
+    to the day the first portfolio is pulled and is used for the whole stream.
+
+    Underlyings can also be symbols or indexes in `registry`, which are looked up
+    at the latest prices as each chunk is pulled.
+    """
+    # resolved once, so a stream consumed across midnight stays on one date
+    as_of = as_of or date.today()
+    iterator = iter(portfolios)
+    chunks = iter(
+        lambda: [
+            (key, legs, _resolve(underlying, registry))
+            for key, legs, underlying in islice(iterator, chunk_size)
+        ],
+        [],
+    )
+    if executor is None:
+        for chunk in chunks:
+            yield from _calculate_chunk(chunk, as_of)
+        return
+
+    pending: deque[Future] = deque()
+    try:
+        for chunk in chunks:
+            pending.append(executor.submit(_calculate_chunk, chunk, as_of))
+            # backpressure: wait for the oldest chunk before reading any further
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _resolve(
+    underlying: "Underlying | str | int", registry: "UnderlyingRegistry | None"
+) -> "Underlying | UnderlyingInfo":
+    if isinstance(underlying, (str, int)):
+        return _lookup_underlying(underlying, registry)
+    return underlying
+
+
+def _calculate_chunk(
+    chunk: "list[Portfolio]", as_of: date
+) -> "list[tuple[Hashable, MarginRequirements]]":
+    return [
+        (key, calculate_margin(legs, underlying, as_of))
+        for key, legs, underlying in chunk
+    ]
+
+
+def _calculate_positions(
+    chunk: "list[Position]", as_of: date
+) -> "list[MarginRequirements]":
+    return [calculate_margin(legs, underlying, as_of) for legs, underlying in chunk]
@@ -0,0 +1,82 @@
+import time
+from datetime import date
+from decimal import Decimal
+from typing import TYPE_CHECKING, Sequence
+
+from .legs import ZERO, OptionLeg, SharesLeg, UnderlyingInfo
+from .margin import (
+    _calculate_margin_long_option,
+    _calculate_margin_shares,
+    _calculate_margin_short_option,
+    _net,
+    _with_quantity,
+    calculate_requirements,
+)
+
+if TYPE_CHECKING:
+    from .models import Option, Shares, Underlying
+
+
+def margin_bound(
+    legs: "Sequence[Option | Shares | OptionLeg | SharesLeg]",
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date | None = None,
+) -> tuple[Decimal, Decimal]:
+    """
+    Cheaply bound the margin requirement of a position without matching any legs,
+    returning `(lower, upper)`.
+
+    The lower bound only charges the net debit (with longs at their reduced
+    requirement where eligible), as if every short were perfectly covered. The
+    upper bound charges each short as if it were naked, in a strangle and at the
+    full width of the position's strikes in a spread all at once, and each long at
+    full price plus that width.
+    """
+    as_of = as_of or date.today()
+    stock, netted = _net(legs)
+    options = [leg for leg in netted.values() if leg.quantity]
+    lower = upper = (
+        _calculate_margin_shares(stock).margin_requirement if stock else ZERO
+    )
+    if not options:
+        return lower, upper
+    width = max(leg.strike for leg in options) - min(leg.strike for leg in options)
+    for leg in options:
+        quantity = abs(leg.quantity)
+        premium = leg.price * 100 * quantity
+        if leg.quantity > 0:
+            lower += _calculate_margin_long_option(leg, as_of).margin_requirement
+            upper += premium + width * 100 * quantity
+        else:
+            lower -= premium
+            # the strangle requirement multiplies by the quantity twice
+            naked = _calculate_margin_short_option(_with_quantity(leg, -1), underlying)
+            upper += naked.margin_requirement * quantity * quantity
+            upper += premium + width * 100 * quantity
+    return lower, upper
+
+
+def check_margin(
+    legs: "Sequence[Option | Shares | OptionLeg | SharesLeg]",
+    underlying: "Underlying | UnderlyingInfo",
+    limit: Decimal,
+    deadline: float | None = None,
+    as_of: date | None = None,
+) -> bool:
+    """
+    Check whether the margin requirement of a position is within `limit`, only
+    doing the full calculation if :func:`margin_bound` can't decide.
+
+    `deadline` is a :func:`time.monotonic` timestamp; if it has already passed when
+    the full calculation would be needed, the position is conservatively rejected.
+    """
+    as_of = as_of or date.today()
+    lower, upper = margin_bound(legs, underlying, as_of)
+    if upper <= limit:
+        return True
+    if lower > limit:
+        return False
+    if deadline is not None and time.monotonic() > deadline:
+        return False
+    total = calculate_requirements(legs, underlying, as_of)
+    return total.margin_requirement <= limit
@@ -0,0 +1,99 @@
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import TYPE_CHECKING, Sequence
+
+from .legs import ZERO, ETFType, UnderlyingInfo
+
+if TYPE_CHECKING:
+    from .models import Underlying
+
+# rows are expirations, columns are strikes; missing contracts are None
+Matrix = list[list[Decimal | None]]
+
+
+class ChainTable:
+    """
+    Per-contract requirements for opening a single long or short option at every
+    strike and expiration of a chain.
+    """
+
+    __slots__ = (
+        "short_call_cash",
+        "short_call_margin",
+        "short_put_cash",
+        "short_put_margin",
+        "long_call_cash",
+        "long_call_margin",
+        "long_put_cash",
+        "long_put_margin",
+    )
+
+    def __init__(self, **matrices: Matrix):
+        for name in self.__slots__:
+            setattr(self, name, matrices[name])
+
+
+def chain_margin_table(
+    strikes: Sequence[Decimal],
+    expirations: Sequence[date],
+    call_prices: Sequence[Sequence[Decimal | None]],
+    put_prices: Sequence[Sequence[Decimal | None]],
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date | None = None,
+) -> ChainTable:
+    """
+    Calculate naked requirements for a whole option chain at once. `call_prices`
+    and `put_prices` are indexed by `[expiration][strike]`, using None for strikes
+    that aren't listed for an expiration.
+
+    The results match calling :func:`~margin_estimator.calculate_margin` on each
+    contract with a quantity of 1 or -1, but everything that only depends on the
+    underlying is computed just once for the chain.
+    """
+    price = underlying.price
+    leverage = underlying.leverage_factor
+    broad = underlying.etf_type == ETFType.BROAD
+    # 15% of a broad-based index, 20% of anything else
+    base_percent = price * 3 / 20 * leverage if broad else price / 5 * leverage
+    # minimum for calls is 10% of the underlying, for puts 10% of the strike
+    call_minimum = price / 10 * leverage
+    put_minimums = [strike / 10 * leverage for strike in strikes]
+    call_otm = [max(ZERO, strike - price) for strike in strikes]
+    put_otm = [max(ZERO, price - strike) for strike in strikes]
+    cutoff = (as_of or date.today()) + timedelta(days=90)
+
+    matrices: dict[str, Matrix] = {name: [] for name in ChainTable.__slots__}
+    for expiration, calls, puts in zip(expirations, call_prices, put_prices):
+        reduced = expiration >= cutoff
+        for kind, prices in (("call", calls), ("put", puts)):
+            short_cash: list[Decimal | None] = []
+            short_margin: list[Decimal | None] = []
+            long_cash: list[Decimal | None] = []
+            long_margin: list[Decimal | None] = []
+            for i, premium in enumerate(prices):
+                if premium is None:
+                    for row in (short_cash, short_margin, long_cash, long_margin):
+                        row.append(None)
+                    continue
+                if kind == "call":
+                    minimum = round(premium + call_minimum, 2)
+                    base = round(premium + base_percent - call_otm[i], 2)
+                    # narrow-based calls are covered by depositing the underlying
+                    cash_basis = strikes[i] if broad else price
+                else:
+                    minimum = round(premium + put_minimums[i], 2)
+                    base = round(premium + base_percent - put_otm[i], 2)
+                    cash_basis = strikes[i]
+                short_cash.append((cash_basis - premium) * 100)
+                short_margin.append(max(minimum, base) * 100)
+                long_cash.append(premium * 100)
+                if reduced:
+                    long_margin.append(round(premium * 3 / 4, 2) * 100)
+                else:
+                    long_margin.append(premium * 100)
+            matrices[f"short_{kind}_cash"].append(short_cash)
+            matrices[f"short_{kind}_margin"].append(short_margin)
+            matrices[f"long_{kind}_cash"].append(long_cash)
+            matrices[f"long_{kind}_margin"].append(long_margin)
+
+    return ChainTable(**matrices)
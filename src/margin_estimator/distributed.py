@@ -0,0 +1,322 @@
+import socket
+import struct
+import threading
+from collections import deque
+from datetime import date
+from decimal import Decimal
+from typing import TYPE_CHECKING, Hashable, Iterable, Sequence
+
+from .legs import (
+    ETFType,
+    OptionLeg,
+    OptionType,
+    Requirements,
+    SharesLeg,
+    UnderlyingInfo,
+)
+
+if TYPE_CHECKING:
+    from .models import MarginRequirements, Option, Shares, Underlying
+
+    Portfolio = tuple[
+        Hashable,
+        Sequence[Option | Shares | OptionLeg | SharesLeg],
+        Underlying | UnderlyingInfo,
+    ]
+
+# every message is framed as payload length, message kind, shard id
+FRAME = struct.Struct("<IBI")
+MESSAGE_SHARD = 1
+MESSAGE_RESULT = 2
+MESSAGE_ERROR = 3
+
+# shard: as_of ordinal, number of portfolios
+SHARD_HEADER = struct.Struct("<iI")
+# portfolio: ETF type, number of legs (followed by price and leverage factor)
+PORTFOLIO_HEADER = struct.Struct("<BI")
+# leg: kind, quantity (followed by price, then expiration and strike for options)
+LEG_HEADER = struct.Struct("<Bi")
+EXPIRATION = struct.Struct("<i")
+# decimal: exponent, length of the little-endian two's complement coefficient
+DECIMAL_HEADER = struct.Struct("<bB")
+
+KIND_CALL = 0
+KIND_PUT = 1
+KIND_SHARES = 2
+_ETF_TYPES: list[ETFType | None] = [None, *ETFType]
+
+
+class ShardError(RuntimeError):
+    """
+    A shard failed on every attempt, or no workers were left to run it.
+    """
+
+
+def distribute_margins(
+    portfolios: "Iterable[Portfolio]",
+    workers: Sequence[tuple[str, int]],
+    shard_size: int = 1000,
+    max_attempts: int = 3,
+    timeout: float | None = 300.0,
+    as_of: date | None = None,
+) -> "list[tuple[Hashable, MarginRequirements]]":
+    """
+    Calculate margin for `(portfolio_id, legs, underlying)` tuples on remote
+    workers started with `python -m margin_estimator.worker`, returning
+    `(portfolio_id, requirements)` in input order.
+
+    Portfolios are split into shards of `shard_size`, which are handed out to
+    `workers` (`(host, port)` addresses) as they finish the previous one. Once no
+    shards are left to hand out, idle workers also run shards that are still in
+    progress elsewhere, and whichever copy finishes first is used, so a slow
+    worker can't hold up the run. Shards whose worker fails or doesn't answer
+    within `timeout` seconds are retried on another worker, up to `max_attempts`
+    times. Portfolio ids never leave this process.
+    """
+    from .models import MarginRequirements
+
+    as_of = as_of or date.today()
+    ids: list[list[Hashable]] = []
+    payloads: list[bytes] = []
+    chunk: list = []
+    for portfolio in portfolios:
+        chunk.append(portfolio)
+        if len(chunk) == shard_size:
+            ids.append([key for key, _, _ in chunk])
+            payloads.append(encode_shard(chunk, as_of))
+            chunk = []
+    if chunk:
+        ids.append([key for key, _, _ in chunk])
+        payloads.append(encode_shard(chunk, as_of))
+
+    run = _Run(payloads, max_attempts)
+    threads = [
+        threading.Thread(target=run.drive, args=(address, timeout), daemon=True)
+        for address in workers
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if run.error is not None:
+        raise run.error
+    if len(run.results) < len(payloads):
+        raise ShardError("All workers failed before every shard was calculated!")
+    return [
+        (
+            key,
+            MarginRequirements.model_construct(
+                cash_requirement=total.cash_requirement,
+                margin_requirement=total.margin_requirement,
+            ),
+        )
+        for shard, keys in enumerate(ids)
+        for key, total in zip(keys, run.results[shard])
+    ]
+
+
+class _Run:
+    """
+    Shared state of a distributed run, driven by one thread per worker.
+    """
+
+    def __init__(self, payloads: list[bytes], max_attempts: int):
+        self.payloads = payloads
+        self.max_attempts = max_attempts
+        self.pending = deque(range(len(payloads)))
+        # copies of each unfinished shard currently running on a worker
+        self.running = [0] * len(payloads)
+        self.attempts = [0] * len(payloads)
+        self.results: dict[int, list[Requirements]] = {}
+        self.error: ShardError | None = None
+        self.connections: set[socket.socket] = set()
+        self.condition = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.error is not None or len(self.results) == len(self.payloads)
+
+    def _next(self) -> int | None:
+        """
+        Wait for a shard to run, or return None once the run is over.
+        """
+        with self.condition:
+            while True:
+                if self.done:
+                    return None
+                if self.pending:
+                    shard = self.pending.popleft()
+                    if shard in self.results:
+                        continue
+                    self.running[shard] += 1
+                    return shard
+                # steal a straggler that isn't already running twice
+                for shard, copies in enumerate(self.running):
+                    if copies == 1 and shard not in self.results:
+                        self.running[shard] += 1
+                        return shard
+                self.condition.wait()
+
+    def _finish(self, shard: int, results: list[Requirements] | None, reason: str):
+        with self.condition:
+            self.running[shard] -= 1
+            if shard in self.results:
+                pass
+            elif results is not None:
+                self.results[shard] = results
+            else:
+                self.attempts[shard] += 1
+                if self.attempts[shard] >= self.max_attempts:
+                    self.error = ShardError(
+                        f"Shard {shard} failed {self.attempts[shard]} times: {reason}"
+                    )
+                else:
+                    self.pending.append(shard)
+            if self.done:
+                # stop waiting on stragglers whose shards have been stolen
+                for connection in self.connections:
+                    try:
+                        connection.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+            self.condition.notify_all()
+
+    def drive(self, address: tuple[str, int], timeout: float | None):
+        try:
+            connection = socket.create_connection(address, timeout)
+        except OSError:
+            return
+        with self.condition:
+            self.connections.add(connection)
+        with connection:
+            while (shard := self._next()) is not None:
+                try:
+                    _send(connection, MESSAGE_SHARD, shard, self.payloads[shard])
+                    kind, _, payload = _receive(connection)
+                except OSError as e:
+                    # the worker is gone (or hanging), so stop using it
+                    self._finish(shard, None, f"{address}: {e!r}")
+                    return
+                if kind == MESSAGE_RESULT:
+                    self._finish(shard, decode_results(payload), "")
+                else:
+                    self._finish(shard, None, f"{address}: {payload.decode()}")
+
+
+def encode_shard(portfolios: "Sequence[Portfolio]", as_of: date) -> bytes:
+    """
+    Encode the legs and underlyings of a shard of portfolios (without their ids).
+    """
+    out = bytearray(SHARD_HEADER.pack(as_of.toordinal(), len(portfolios)))
+    for _, legs, underlying in portfolios:
+        out += PORTFOLIO_HEADER.pack(_ETF_TYPES.index(underlying.etf_type), len(legs))
+        _pack_decimal(out, underlying.price)
+        _pack_decimal(out, underlying.leverage_factor)
+        for leg in legs:
+            if hasattr(leg, "strike"):
+                kind = KIND_CALL if leg.type == OptionType.CALL else KIND_PUT
+                out += LEG_HEADER.pack(kind, leg.quantity)
+                _pack_decimal(out, leg.price)
+                out += EXPIRATION.pack(leg.expiration.toordinal())
+                _pack_decimal(out, leg.strike)
+            else:
+                out += LEG_HEADER.pack(KIND_SHARES, leg.quantity)
+                _pack_decimal(out, leg.price)
+    return bytes(out)
+
+
+def decode_shard(
+    data: bytes,
+) -> tuple[date, list[tuple[list[OptionLeg | SharesLeg], UnderlyingInfo]]]:
+    """
+    Decode a shard into `as_of` and `(legs, underlying)` pairs.
+    """
+    view = memoryview(data)
+    as_of, count = SHARD_HEADER.unpack_from(view)
+    offset = SHARD_HEADER.size
+    portfolios = []
+    for _ in range(count):
+        etf_type, n_legs = PORTFOLIO_HEADER.unpack_from(view, offset)
+        offset += PORTFOLIO_HEADER.size
+        price, offset = _unpack_decimal(view, offset)
+        leverage_factor, offset = _unpack_decimal(view, offset)
+        underlying = UnderlyingInfo(price, _ETF_TYPES[etf_type], leverage_factor)
+        legs: list[OptionLeg | SharesLeg] = []
+        for _ in range(n_legs):
+            kind, quantity = LEG_HEADER.unpack_from(view, offset)
+            offset += LEG_HEADER.size
+            price, offset = _unpack_decimal(view, offset)
+            if kind == KIND_SHARES:
+                legs.append(SharesLeg(price, quantity))
+                continue
+            (expiration,) = EXPIRATION.unpack_from(view, offset)
+            offset += EXPIRATION.size
+            strike, offset = _unpack_decimal(view, offset)
+            option_type = OptionType.CALL if kind == KIND_CALL else OptionType.PUT
+            legs.append(
+                OptionLeg(
+                    date.fromordinal(expiration), price, quantity, strike, option_type
+                )
+            )
+        portfolios.append((legs, underlying))
+    return date.fromordinal(as_of), portfolios
+
+
+def encode_results(results: Sequence[Requirements]) -> bytes:
+    out = bytearray()
+    for total in results:
+        _pack_decimal(out, total.cash_requirement)
+        _pack_decimal(out, total.margin_requirement)
+    return bytes(out)
+
+
+def decode_results(data: bytes) -> list[Requirements]:
+    view = memoryview(data)
+    offset = 0
+    results = []
+    while offset < len(view):
+        cash, offset = _unpack_decimal(view, offset)
+        margin, offset = _unpack_decimal(view, offset)
+        results.append(Requirements(cash, margin))
+    return results
+
+
+def _pack_decimal(out: bytearray, value: Decimal):
+    # exact, unlike the fixed-point fields of the position store
+    sign, digits, exponent = Decimal(value).as_tuple()
+    if not isinstance(exponent, int):
+        raise ValueError(f"{value} can't be encoded!")
+    coefficient = int("".join(map(str, digits)))
+    if sign:
+        coefficient = -coefficient
+    raw = coefficient.to_bytes(coefficient.bit_length() // 8 + 1, "little", signed=True)
+    out += DECIMAL_HEADER.pack(exponent, len(raw))
+    out += raw
+
+
+def _unpack_decimal(view: memoryview, offset: int) -> tuple[Decimal, int]:
+    exponent, length = DECIMAL_HEADER.unpack_from(view, offset)
+    offset += DECIMAL_HEADER.size
+    coefficient = int.from_bytes(view[offset : offset + length], "little", signed=True)
+    sign = 1 if coefficient < 0 else 0
+    digits = tuple(map(int, str(abs(coefficient))))
+    return Decimal((sign, digits, exponent)), offset + length
+
+
+def _send(connection: socket.socket, kind: int, shard: int, payload: bytes):
+    connection.sendall(FRAME.pack(len(payload), kind, shard) + payload)
+
+
+def _receive(connection: socket.socket) -> tuple[int, int, bytes]:
+    length, kind, shard = FRAME.unpack(_receive_exactly(connection, FRAME.size))
+    return kind, shard, _receive_exactly(connection, length)
+
+
+def _receive_exactly(connection: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed mid-message!")
+        data += chunk
+    return bytes(data)
@@ -0,0 +1,183 @@
+from datetime import date
+from decimal import Decimal
+from typing import TYPE_CHECKING, Hashable, Iterable, Mapping
+
+from .legs import ZERO, ETFType, OptionLeg, Requirements, SharesLeg, UnderlyingInfo
+from .margin import NettedKey, _calculate_totals, _decompose
+from .replay import _parse_symbol
+
+if TYPE_CHECKING:
+    from .models import Underlying
+
+
+class PriceTable:
+    """
+    Latest prices of contracts (OCC symbols) and underlyings (tickers). Every
+    symbol gets a fixed slot in a single array the first time it's seen, so
+    holders can keep the slot instead of looking the symbol up on every tick.
+    """
+
+    __slots__ = ("slots", "prices")
+
+    def __init__(self):
+        self.slots: dict[str, int] = {}
+        self.prices: list[Decimal | None] = []
+
+    def slot(self, symbol: str) -> int:
+        slot = self.slots.get(symbol)
+        if slot is None:
+            slot = self.slots[symbol] = len(self.prices)
+            self.prices.append(None)
+        return slot
+
+    def update(self, symbol: str, price: Decimal) -> int:
+        slot = self.slot(symbol)
+        self.prices[slot] = price
+        return slot
+
+    def __getitem__(self, symbol: str) -> Decimal | None:
+        slot = self.slots.get(symbol)
+        return None if slot is None else self.prices[slot]
+
+
+class _TickBook:
+    """
+    A book decomposed once, along with the price slot of every leg in the
+    decomposition. Matching never looks at prices, so a tick only needs to
+    write the new prices into the legs and total them again.
+    """
+
+    __slots__ = ("root", "symbols", "decomposition", "legs", "requirements")
+
+    def __init__(self, root: str, positions: Mapping[str, int], table: PriceTable):
+        self.root = root
+        self.symbols = [symbol for symbol, quantity in positions.items() if quantity]
+        stock_quantity = 0
+        netted: dict[NettedKey, OptionLeg] = {}
+        slots: dict[NettedKey, int] = {}
+        for symbol in self.symbols:
+            symbol_root, key = _parse_symbol(symbol)
+            if symbol_root != root:
+                raise ValueError(f"{symbol} isn't an option or shares of {root}!")
+            quantity = positions[symbol]
+            if key is None:
+                stock_quantity += quantity
+            else:
+                netted[key] = OptionLeg(key[0], ZERO, quantity, key[1], key[2])
+                slots[key] = table.slot(symbol)
+        stock = SharesLeg(ZERO, stock_quantity) if stock_quantity else None
+        self.decomposition = _decompose(stock, netted)
+        # the decomposition splits legs up into new objects, so find them all
+        decomposition = self.decomposition
+        legs = [*decomposition.covered, *decomposition.naked]
+        legs.extend(leg for pair in decomposition.strangles for leg in pair)
+        self.legs = [(slots[leg.expiration, leg.strike, leg.type], leg) for leg in legs]
+        self.requirements: Requirements | None = None
+
+    def evaluate(
+        self, prices: list[Decimal | None], underlying: UnderlyingInfo, as_of: date
+    ) -> Requirements | None:
+        """
+        Requirements at the current prices, or None if some aren't known yet.
+        """
+        for slot, leg in self.legs:
+            price = prices[slot]
+            if price is None:
+                return None
+            leg.price = price
+        if self.decomposition.stock:
+            # shares are valued at the underlying's price
+            self.decomposition.stock.price = underlying.price
+        self.requirements = _calculate_totals(self.decomposition, underlying, as_of)
+        return self.requirements
+
+
+class TickFanout:
+    """
+    Keeps the requirements of many books up to date with market data. Each book
+    is the position of one account in one underlying, as quantities by symbol
+    (OCC symbols for options and the ticker for shares, like
+    :class:`~margin_estimator.Fill`).
+
+    Prices live in a :class:`PriceTable`, which can be shared between fanouts
+    (though ticks only re-evaluate books of the fanout they're passed to), and a
+    reverse index from each contract and underlying to the books that depend on
+    it means a tick only re-evaluates those books. `underlyings`
+    provides the ETF type, leverage factor and starting price of each ticker.
+    `as_of` defaults to today.
+    """
+
+    def __init__(
+        self,
+        underlyings: "Mapping[str, Underlying | UnderlyingInfo]",
+        prices: PriceTable | None = None,
+        as_of: date | None = None,
+    ):
+        self.prices = prices or PriceTable()
+        self.as_of = as_of
+        # ETF type and leverage factor; prices are always read from the table
+        self._underlyings: dict[str, tuple[ETFType | None, Decimal]] = {}
+        for symbol, underlying in underlyings.items():
+            self._underlyings[symbol] = underlying.etf_type, underlying.leverage_factor
+            self.prices.update(symbol, underlying.price)
+        self._books: dict[Hashable, _TickBook] = {}
+        # slot of a contract or underlying -> books depending on its price
+        self._dependents: dict[int, set[Hashable]] = {}
+
+    def set_book(self, book: Hashable, root: str, positions: Mapping[str, int]):
+        """
+        Add a book, or replace its positions (e.g. after a fill), and evaluate it
+        at the current prices.
+        """
+        self.remove_book(book)
+        tick_book = _TickBook(root, positions, self.prices)
+        self._books[book] = tick_book
+        for symbol in {root, *tick_book.symbols}:
+            self._dependents.setdefault(self.prices.slot(symbol), set()).add(book)
+        self._evaluate([book])
+
+    def remove_book(self, book: Hashable):
+        tick_book = self._books.pop(book, None)
+        if tick_book is None:
+            return
+        for symbol in {tick_book.root, *tick_book.symbols}:
+            self._dependents[self.prices.slots[symbol]].discard(book)
+
+    def requirements(self, book: Hashable) -> Requirements | None:
+        """
+        Requirements of `book` at the latest prices, or None until all of its
+        prices are known.
+        """
+        return self._books[book].requirements
+
+    def on_tick(
+        self, batch: Iterable[tuple[str, Decimal]]
+    ) -> dict[Hashable, Requirements]:
+        """
+        Apply a batch of `(symbol, price)` ticks, then re-evaluate every book
+        holding one of the contracts or trading on one of the underlyings, once
+        each. Returns the new requirements of those books.
+        """
+        dirty: set[Hashable] = set()
+        for symbol, price in batch:
+            slot = self.prices.update(symbol, price)
+            dirty.update(self._dependents.get(slot, ()))
+        return self._evaluate(dirty)
+
+    def _evaluate(self, books: Iterable[Hashable]) -> dict[Hashable, Requirements]:
+        as_of = self.as_of or date.today()
+        prices = self.prices.prices
+        underlyings: dict[str, UnderlyingInfo] = {}
+        results = {}
+        for book in books:
+            tick_book = self._books[book]
+            underlying = underlyings.get(tick_book.root)
+            if underlying is None:
+                etf_type, leverage_factor = self._underlyings[tick_book.root]
+                price = self.prices[tick_book.root]
+                underlying = UnderlyingInfo(price, etf_type, leverage_factor)
+                underlyings[tick_book.root] = underlying
+            requirements = tick_book.evaluate(prices, underlying, as_of)
+            if requirements is not None:
+                results[book] = requirements
+        return results
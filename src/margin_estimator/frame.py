@@ -0,0 +1,85 @@
+from decimal import Decimal
+from typing import Any
+
+import pandas as pd
+
+from .legs import ETFType, OptionLeg, OptionType, SharesLeg, UnderlyingInfo
+from .margin import calculate_requirements
+
+GROUP_COLUMNS = ["account", "underlying"]
+
+
+def calculate_margin_frame(
+    df: pd.DataFrame, underlyings_df: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Calculate margin requirements for every (account, underlying) group of legs.
+
+    `df` needs `account`, `underlying`, `expiration`, `strike`, `type`, `price`
+    and `quantity` columns, one row per leg. Rows with a missing `strike` are
+    treated as shares. `underlyings_df` needs `underlying` and `price` columns
+    and optionally `etf_type` and `leverage_factor`.
+
+    Returns a frame indexed by (account, underlying) with `cash_requirement` and
+    `margin_requirement` columns. Requires the `pandas` extra.
+    """
+    underlyings = _load_underlyings(underlyings_df)
+    # convert each column once instead of touching individual rows
+    is_option = df["strike"].notna().tolist()
+    expirations = pd.to_datetime(df["expiration"]).dt.date.tolist()
+    strikes = _decimals(df["strike"])
+    types = df["type"].tolist()
+    prices = _decimals(df["price"])
+    quantities = df["quantity"].astype(int).tolist()
+
+    index = []
+    cash = []
+    margin = []
+    for (account, symbol), rows in df.groupby(GROUP_COLUMNS, sort=True).indices.items():
+        legs: list[OptionLeg | SharesLeg] = []
+        for i in rows:
+            if is_option[i]:
+                legs.append(
+                    OptionLeg(
+                        expirations[i],
+                        prices[i],
+                        quantities[i],
+                        strikes[i],
+                        OptionType(types[i]),
+                    )
+                )
+            else:
+                legs.append(SharesLeg(prices[i], quantities[i]))
+        total = calculate_requirements(legs, underlyings[symbol])
+        index.append((account, symbol))
+        cash.append(total.cash_requirement)
+        margin.append(total.margin_requirement)
+
+    return pd.DataFrame(
+        {"cash_requirement": cash, "margin_requirement": margin},
+        index=pd.MultiIndex.from_tuples(index, names=GROUP_COLUMNS),
+    )
+
+
+def _load_underlyings(underlyings_df: pd.DataFrame) -> dict[Any, UnderlyingInfo]:
+    n = len(underlyings_df)
+    prices = _decimals(underlyings_df["price"])
+    if "etf_type" in underlyings_df:
+        etf_types = [
+            ETFType(t) if pd.notna(t) else None for t in underlyings_df["etf_type"]
+        ]
+    else:
+        etf_types = [None] * n
+    if "leverage_factor" in underlyings_df:
+        leverage = _decimals(underlyings_df["leverage_factor"].fillna(1))
+    else:
+        leverage = [Decimal(1)] * n
+    return {
+        symbol: UnderlyingInfo(prices[i], etf_types[i], leverage[i])
+        for i, symbol in enumerate(underlyings_df["underlying"].tolist())
+    }
+
+
+def _decimals(column: pd.Series) -> list[Decimal]:
+    # go through str so floats like 0.45 don't pick up binary noise
+    return [v if isinstance(v, Decimal) else Decimal(str(v)) for v in column.tolist()]
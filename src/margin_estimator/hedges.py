@@ -0,0 +1,209 @@
+from bisect import bisect
+from collections import Counter
+from datetime import date
+from decimal import Decimal
+from typing import TYPE_CHECKING, Hashable, NamedTuple, Sequence
+
+import numpy as np
+
+from .legs import OptionLeg, OptionType, SharesLeg, UnderlyingInfo
+from .margin import NettedKey, _calculate_totals, _combine_sides, _Side, _with_quantity
+from .whatif import _BookState
+
+if TYPE_CHECKING:
+    from .models import Option, Shares, Underlying
+
+# how many of the best estimates are checked exactly for each hedge returned
+SHORTLIST_FACTOR = 4
+
+
+class MarginHedge(NamedTuple):
+    """
+    Buying one contract of `leg` costs `premium` and lowers the book's margin
+    requirement by `margin_reduction`.
+    """
+
+    leg: OptionLeg
+    premium: Decimal
+    margin_reduction: Decimal
+
+    @property
+    def reduction_per_premium(self) -> Decimal:
+        return self.margin_reduction / self.premium
+
+
+def find_margin_hedges(
+    book: "Sequence[Option | Shares | OptionLeg | SharesLeg]",
+    chain: "Sequence[Option | OptionLeg]",
+    underlying: "Underlying | UnderlyingInfo",
+    top_k: int = 10,
+    as_of: date | None = None,
+) -> list[MarginHedge]:
+    """
+    Find the contracts of `chain` (whose quantities are ignored) that lower the
+    margin requirement of `book` the most per dollar of premium when bought,
+    returning up to `top_k` of them, best first. Each reduction is exactly
+    `calculate_margin(book) - calculate_margin(book + [contract])`. A contract
+    the book already holds long is netted into that position at the book's
+    price, so it's scored and returned at that price.
+
+    The book is decomposed once. Shorts are matched with the first longs (by
+    expiration, then strike) that expire no earlier, so every contract that sits
+    between the same two longs of the book and shares an expiration changes the
+    matching the same way: it covers one more short, or displaces one of the
+    book's longs from a spread. That change, and what it does to the strangles
+    and naked legs, is found with one re-match per such slot rather than per
+    contract. The spread rule is then evaluated for every contract at once, as a
+    contracts × strikes array, and the best-scoring contracts (and any that buy
+    back a short) are checked with the full calculation. Requires the `numpy`
+    extra.
+    """
+    as_of = as_of or date.today()
+    state = _BookState(book, as_of)
+    candidates = [
+        _with_quantity(contract, 1) for contract in chain if contract.price > 0
+    ]
+    calls, puts = state.sides[OptionType.CALL], state.sides[OptionType.PUT]
+    uncovered = _uncovered_requirement(calls, puts, underlying, as_of)
+    longs = {
+        t: sorted(key for key, leg in state.netted[t].items() if leg.quantity > 0)
+        for t in OptionType
+    }
+    slots: dict[Hashable, list[int]] = {}
+    closing: list[int] = []
+    for i, leg in enumerate(candidates):
+        key = (leg.expiration, leg.strike, leg.type)
+        existing = state.netted[leg.type].get(key)
+        if existing is not None and existing.quantity < 0:
+            # buying back a short changes the netted book instead of covering it
+            closing.append(i)
+        elif existing is not None and existing.quantity > 0:
+            # netting adds it to the book's long, which keeps the book's price
+            candidates[i] = _with_quantity(existing, 1)
+            slots.setdefault(key, []).append(i)
+        else:
+            slot = (leg.type, leg.expiration, bisect(longs[leg.type], key))
+            slots.setdefault(slot, []).append(i)
+
+    # per slot: the book's long displaced from a spread, the short newly covered,
+    # and how much less the strangles and naked legs need
+    changes: list[tuple[list[int], OptionLeg | None, OptionLeg | None, float]] = []
+    for group in slots.values():
+        leg = candidates[group[0]]
+        change = _rematch(state, leg)
+        if change is not None:
+            displaced, short, side = change
+            if leg.type == OptionType.CALL:
+                after = _uncovered_requirement(side, puts, underlying, as_of)
+            else:
+                after = _uncovered_requirement(calls, side, underlying, as_of)
+            changes.append((group, displaced, short, float(uncovered - after)))
+
+    covered = calls.covered + puts.covered
+    strikes = np.unique(
+        [float(leg.strike) for leg in (*covered, *candidates)]
+        + [float(leg.strike) for _, *legs, _ in changes for leg in legs if leg]
+    )
+    # value at expiration of the book's spreads at every strike
+    values = np.zeros(len(strikes))
+    for leg in covered:
+        values += _values(leg, strikes) * leg.quantity
+    credit = float(sum(leg.quantity * leg.price * 100 for leg in covered))
+    spreads = abs(values.min()) + credit if covered else 0.0
+
+    prices = np.array([float(leg.price) for leg in candidates])
+    best = np.full(len(candidates), -np.inf)
+    for group, displaced, short, relief in changes:
+        # the displaced long leaves the spreads and the short joins them, which
+        # both take away their value and premium
+        changed_values = values.copy()
+        changed_credit = credit
+        for leg in (displaced, short):
+            if leg is not None:
+                changed_values -= _values(leg, strikes)
+                changed_credit -= float(leg.price) * 100
+        paired = changed_values + np.array(
+            [_values(candidates[i], strikes) for i in group]
+        )
+        paired_credit = changed_credit + prices[group] * 100
+        added = np.abs(paired.min(axis=1)) + paired_credit - spreads
+        best[group] = relief - added
+
+    order = np.argsort(-best / (prices * 100), kind="stable")
+    shortlist = [i for i in order[: top_k * SHORTLIST_FACTOR] if best[i] > 0]
+    base = state.requirements(underlying).margin_requirement
+    hedges = []
+    for i in [*shortlist, *closing]:
+        leg = candidates[i]
+        total = state.with_order([leg], underlying)
+        reduction = base - total.margin_requirement
+        if reduction > 0:
+            hedges.append(MarginHedge(leg, leg.price * 100, reduction))
+    hedges.sort(key=lambda hedge: hedge.reduction_per_premium, reverse=True)
+    return hedges[:top_k]
+
+
+def _values(leg: OptionLeg, strikes: np.ndarray) -> np.ndarray:
+    """
+    Value at expiration of one contract of `leg` at each of `strikes`.
+    """
+    strike = float(leg.strike)
+    if leg.type == OptionType.CALL:
+        return np.maximum(strikes - strike, 0) * 100
+    return np.maximum(strike - strikes, 0) * 100
+
+
+def _rematch(
+    state: _BookState, leg: OptionLeg
+) -> tuple[OptionLeg | None, OptionLeg | None, _Side] | None:
+    """
+    Match the side of `leg` again with one more contract of it, returning the
+    book's long it displaces from a spread, the book's short it newly covers and
+    the new side. None if `leg` ends up naked, or the matching changes in any
+    other way.
+    """
+    netted = dict(state.netted[leg.type])
+    key = (leg.expiration, leg.strike, leg.type)
+    if key in netted:
+        netted[key] = _with_quantity(netted[key], netted[key].quantity + 1)
+    else:
+        netted[key] = leg
+    side = state._match(leg.type, netted)
+    before = state.sides[leg.type]
+    added_longs = _covered_quantities(side, 1) - _covered_quantities(before, 1)
+    removed_longs = _covered_quantities(before, 1) - _covered_quantities(side, 1)
+    added_shorts = _covered_quantities(side, -1) - _covered_quantities(before, -1)
+    removed_shorts = _covered_quantities(before, -1) - _covered_quantities(side, -1)
+    if (
+        added_longs != Counter({key: 1})
+        or removed_shorts
+        or removed_longs.total() + added_shorts.total() != 1
+    ):
+        return None
+    book = state.netted[leg.type]
+    displaced = book[next(iter(removed_longs))] if removed_longs else None
+    short = book[next(iter(added_shorts))] if added_shorts else None
+    return displaced, short, side
+
+
+def _covered_quantities(side: _Side, sign: int) -> Counter[NettedKey]:
+    # covered legs are split up by the legs covering them, so add them back up
+    quantities: Counter[NettedKey] = Counter()
+    for leg in side.covered:
+        if leg.quantity * sign > 0:
+            quantities[leg.expiration, leg.strike, leg.type] += abs(leg.quantity)
+    return quantities
+
+
+def _uncovered_requirement(
+    calls: _Side,
+    puts: _Side,
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+) -> Decimal:
+    """
+    Margin requirement of the strangles and naked legs left after matching.
+    """
+    decomposition = _combine_sides(None, calls, puts)
+    decomposition.covered = []
+    return _calculate_totals(decomposition, underlying, as_of).margin_requirement
@@ -0,0 +1,125 @@
+from datetime import date
+from decimal import Decimal
+from enum import StrEnum
+
+ZERO = Decimal(0)
+
+
+class ETFType(StrEnum):
+    BROAD = "broad-based"
+    NARROW = "narrow-based"
+    VOLATILITY = "volatility"
+
+
+class OptionType(StrEnum):
+    CALL = "C"
+    PUT = "P"
+
+
+class GroupType(StrEnum):
+    # stock along with the short options it covers
+    STOCK = "stock"
+    SPREADS = "spreads"
+    STRANGLE = "strangle"
+    NAKED = "naked"
+
+
+class OptionLeg:
+    """
+    Lightweight option leg. Unlike :class:`~margin_estimator.models.Option` no
+    validation is performed, so prices and strikes should already be `Decimal`s.
+    """
+
+    __slots__ = ("expiration", "price", "quantity", "strike", "type")
+
+    def __init__(
+        self,
+        expiration: date,
+        price: Decimal,
+        quantity: int,
+        strike: Decimal,
+        type: OptionType,
+    ):
+        self.expiration = expiration
+        self.price = price
+        self.quantity = quantity
+        self.strike = strike
+        self.type = type
+
+    def __repr__(self):
+        return (
+            f"OptionLeg(expiration={self.expiration!r}, price={self.price!r}, "
+            f"quantity={self.quantity!r}, strike={self.strike!r}, "
+            f"type={self.type!r})"
+        )
+
+
+class SharesLeg:
+    """
+    Lightweight stock position, see :class:`OptionLeg`.
+    """
+
+    __slots__ = ("price", "quantity")
+
+    def __init__(self, price: Decimal, quantity: int):
+        self.price = price
+        self.quantity = quantity
+
+    def __repr__(self):
+        return f"SharesLeg(price={self.price!r}, quantity={self.quantity!r})"
+
+
+class UnderlyingInfo:
+    """
+    Lightweight underlying, see :class:`OptionLeg`.
+    """
+
+    __slots__ = ("etf_type", "leverage_factor", "price")
+
+    def __init__(
+        self,
+        price: Decimal,
+        etf_type: ETFType | None = None,
+        leverage_factor: Decimal = Decimal(1),
+    ):
+        self.etf_type = etf_type
+        self.leverage_factor = leverage_factor
+        self.price = price
+
+    def __repr__(self):
+        return (
+            f"UnderlyingInfo(price={self.price!r}, etf_type={self.etf_type!r}, "
+            f"leverage_factor={self.leverage_factor!r})"
+        )
+
+
+class Requirements:
+    """
+    Lightweight counterpart of :class:`~margin_estimator.models.MarginRequirements`.
+    """
+
+    __slots__ = ("cash_requirement", "margin_requirement")
+
+    def __init__(
+        self, cash_requirement: Decimal = ZERO, margin_requirement: Decimal = ZERO
+    ):
+        self.cash_requirement = cash_requirement
+        self.margin_requirement = margin_requirement
+
+    def __add__(self, other: "Requirements"):
+        return Requirements(
+            self.cash_requirement + other.cash_requirement,
+            self.margin_requirement + other.margin_requirement,
+        )
+
+    def __eq__(self, other):
+        return (
+            self.cash_requirement == other.cash_requirement
+            and self.margin_requirement == other.margin_requirement
+        )
+
+    def __repr__(self):
+        return (
+            f"cash_requirement={self.cash_requirement!r} "
+            f"margin_requirement={self.margin_requirement!r}"
+        )
@@ -1,147 +1,738 @@
-from collections import deque
+import threading
+import time
+import weakref
+from collections import Counter, deque
 from datetime import date, timedelta
 from decimal import Decimal
-from typing import Sequence
+from functools import lru_cache
+from math import gcd
+from typing import TYPE_CHECKING, Callable, NamedTuple, Sequence
 
-from .models import (
+from .legs import (
     ZERO,
     ETFType,
-    MarginRequirements,
-    Option,
+    GroupType,
+    OptionLeg,
     OptionType,
-    Shares,
-    Underlying,
+    Requirements,
+    SharesLeg,
+    UnderlyingInfo,
 )
 
+if TYPE_CHECKING:
+    from .models import MarginBreakdown, MarginRequirements, Option, Shares, Underlying
+    from .registry import UnderlyingRegistry
+
 
 def calculate_margin(
-    legs: Sequence[Option | Shares], underlying: Underlying
-) -> MarginRequirements:
+    legs: "Sequence[Option | Shares]",
+    underlying: "Underlying | str | int",
+    as_of: date | None = None,
+    optimize: bool = False,
+    time_budget: float = 0.01,
+    breakdown: bool = False,
+    registry: "UnderlyingRegistry | None" = None,
+) -> "MarginRequirements | MarginBreakdown":
     """
     Calculate CBOE margin requirements for both cash and margin accounts for the given
-    position as a group.
+    position as a group. Long options are eligible for reduced requirements based on
+    their time to expiration as of `as_of`, which defaults to today.
+
+    Legs are grouped greedily by default. With `optimize`, the grouping that
+    minimizes the margin requirement is also searched for, for up to
+    `time_budget` seconds, and used if it's lower.
+
+    With `breakdown`, a :class:`~margin_estimator.models.MarginBreakdown` is
+    returned instead, whose `groups` show how the legs were grouped and what
+    each group requires. Only the netted legs are kept until `groups` is first
+    accessed, so an unused breakdown costs next to nothing. Breakdowns aren't
+    available for optimized groupings.
+
+    `underlying` can also be the symbol or index of an underlying in `registry`,
+    which is then calculated at the registry's latest price.
+    """
+    from .models import MarginRequirements
+
+    if isinstance(underlying, (str, int)):
+        underlying = _lookup_underlying(underlying, registry)
+    if breakdown:
+        return _calculate_breakdown(legs, underlying, as_of, optimize)
+    total = calculate_requirements(legs, underlying, as_of, optimize, time_budget)
+    return MarginRequirements.model_construct(
+        cash_requirement=total.cash_requirement,
+        margin_requirement=total.margin_requirement,
+    )
+
+
+def _calculate_breakdown(
+    legs: "Sequence[Option | Shares]",
+    underlying: "Underlying",
+    as_of: date | None,
+    optimize: bool,
+) -> "MarginBreakdown":
+    from .models import MarginBreakdown
+
+    if optimize:
+        raise ValueError("Breakdowns aren't available for optimized groupings!")
+    as_of = as_of or date.today()
+    stock, netted = _net(legs)
+    # the underlying may be changed by the caller before the groups are accessed
+    info = UnderlyingInfo(
+        underlying.price, underlying.etf_type, underlying.leverage_factor
+    )
+    total = _calculate_greedy(stock, netted, info, as_of)
+    result = MarginBreakdown.model_construct(
+        cash_requirement=total.cash_requirement,
+        margin_requirement=total.margin_requirement,
+    )
+    result._source = (stock, netted, info, as_of)
+    return result
+
+
+def _lookup_underlying(
+    key: str | int, registry: "UnderlyingRegistry | None"
+) -> UnderlyingInfo:
+    if registry is None:
+        raise TypeError(f"A registry is needed to look up the underlying {key!r}!")
+    return registry[key]
+
+
+def calculate_margin_json(data: str | bytes) -> bytes:
+    """
+    Calculate margin requirements for a JSON array of positions, each an object
+    with `legs` and `underlying` keys, returning a JSON array of requirements.
+    Parsing and serialization are done in bulk by pydantic-core.
+    """
+    from .models import _positions_adapter, _requirements_adapter
+
+    positions = _positions_adapter().validate_json(data)
+    results = [calculate_margin(p.legs, p.underlying) for p in positions]
+    return _requirements_adapter().dump_json(results)
+
+
+def calculate_requirements(
+    legs: "Sequence[Option | Shares | OptionLeg | SharesLeg]",
+    underlying: "Underlying | UnderlyingInfo | str | int",
+    as_of: date | None = None,
+    optimize: bool = False,
+    time_budget: float = 0.01,
+    registry: "UnderlyingRegistry | None" = None,
+) -> Requirements:
+    """
+    Same as :func:`calculate_margin`, but accepts the lightweight legs from
+    :mod:`margin_estimator.legs` as well as the pydantic models and returns a
+    :class:`~margin_estimator.legs.Requirements`, so it can be used without ever
+    importing pydantic.
+    """
+    deadline = time.monotonic() + time_budget
+    if isinstance(underlying, (str, int)):
+        underlying = _lookup_underlying(underlying, registry)
+    as_of = as_of or date.today()
+    stock, netted = _net(legs)
+    total = _calculate_greedy(stock, netted, underlying, as_of)
+    if optimize:
+        from .optimizer import calculate_optimized
+
+        optimized = calculate_optimized(stock, netted, underlying, as_of, deadline)
+        # out of time, or the greedy grouping was already at least as good
+        if (
+            optimized is not None
+            and optimized.margin_requirement < total.margin_requirement
+        ):
+            return optimized
+    return total
+
+
+def _calculate_greedy(
+    stock: SharesLeg | None,
+    netted: "dict[NettedKey, OptionLeg]",
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+) -> Requirements:
+    fast = _calculate_template(stock, netted, underlying, as_of)
+    if fast is not None:
+        return fast
+    if stock is None:
+        return _calculate_scaled(netted, underlying, as_of)
+    # shares cover in lots of 100, so positions with stock can't be scaled
+    return _calculate_totals(_decompose(stock, netted), underlying, as_of)
+
+
+class Decomposition:
     """
+    A position broken up into the groups margin is charged on: covered spreads,
+    stock, strangles and naked legs.
+    """
+
+    __slots__ = ("stock", "covered", "strangles", "naked")
+
+    def __init__(
+        self,
+        stock: SharesLeg | None,
+        covered: list[OptionLeg],
+        strangles: list[tuple[OptionLeg, OptionLeg]],
+        naked: list[OptionLeg],
+    ):
+        self.stock = stock
+        self.covered = covered
+        self.strangles = strangles
+        self.naked = naked
+
+
+class _Side:
+    """
+    Calls or puts after matching them with stock and each other.
+    """
+
+    __slots__ = ("covered", "naked_shorts", "naked_longs")
+
+    def __init__(
+        self,
+        covered: list[OptionLeg],
+        naked_shorts: list[OptionLeg],
+        naked_longs: list[OptionLeg],
+    ):
+        self.covered = covered
+        self.naked_shorts = naked_shorts
+        self.naked_longs = naked_longs
+
+
+NettedKey = tuple[date, Decimal, str]
+
+
+def _net(
+    legs: "Sequence[Option | Shares | OptionLeg | SharesLeg]",
+) -> tuple[SharesLeg | None, dict[NettedKey, OptionLeg]]:
     # separate out shares from options
-    options = [leg for leg in legs if isinstance(leg, Option)]
-    stocks = [leg for leg in legs if isinstance(leg, Shares)]
-    stock: Shares | None = None
+    options = [leg for leg in legs if hasattr(leg, "strike")]
+    stocks = [leg for leg in legs if not hasattr(leg, "strike")]
+    stock: SharesLeg | None = None
     if stocks and (stock_quantity := sum(leg.quantity for leg in stocks)):
         avg_price = sum(leg.quantity * leg.price for leg in stocks) / stock_quantity
-        stock = Shares(price=Decimal(avg_price), quantity=stock_quantity)
+        stock = SharesLeg(Decimal(avg_price), stock_quantity)
     # step 0: cancel out opposing positions
-    netted: dict[tuple[date, Decimal, str], Option] = {}
+    netted: dict[NettedKey, OptionLeg] = {}
     for leg in options:
-        key = (leg.expiration, leg.strike, leg.type.value)
+        key = (leg.expiration, leg.strike, leg.type)
         if key in netted:
-            netted[key] = netted[key].model_copy(
-                update={"quantity": netted[key].quantity + leg.quantity}
-            )
+            netted[key].quantity += leg.quantity
         else:
-            netted[key] = leg
-    options = [leg for leg in netted.values() if leg.quantity != 0]
+            netted[key] = _with_quantity(leg, leg.quantity)
+    return stock, netted
 
+
+def _split_sides(
+    netted: dict[NettedKey, OptionLeg],
+) -> tuple[list[OptionLeg], list[OptionLeg]]:
     # sort by expiry to cover near-term risk first
-    shorts = sorted(o for o in options if o.quantity < 0)
-    longs = {leg: leg.quantity for leg in sorted(o for o in options if o.quantity > 0)}
-    covered: list[Option] = []
-    naked_shorts: list[Option] = []
+    calls: list[OptionLeg] = []
+    puts: list[OptionLeg] = []
+    for key in sorted(netted):
+        leg = netted[key]
+        if leg.quantity:
+            (calls if leg.type == OptionType.CALL else puts).append(leg)
+    return calls, puts
+
+
+def _covering_shares(stock: SharesLeg | None, option_type: OptionType) -> int:
+    if not stock:
+        return 0
+    target = OptionType.CALL if stock.quantity > 0 else OptionType.PUT
+    return abs(stock.quantity) if option_type == target else 0
+
+
+def _decompose(
+    stock: SharesLeg | None, netted: dict[NettedKey, OptionLeg]
+) -> Decomposition:
+    # calls and puts are only combined with each other in strangles, so each side
+    # can be matched on its own
+    calls, puts = _split_sides(netted)
+    return _combine_sides(
+        stock,
+        _match_side(calls, _covering_shares(stock, OptionType.CALL)),
+        _match_side(puts, _covering_shares(stock, OptionType.PUT)),
+    )
+
+
+def _match_side(options: list[OptionLeg], shares: int) -> _Side:
+    """
+    Match sorted options of a single type with `shares` covering shares and with
+    each other (steps 1 and 2).
+    """
+    shorts = [o for o in options if o.quantity < 0]
+    longs = [leg for leg in options if leg.quantity > 0]
+    available = [leg.quantity for leg in longs]
+    covered: list[OptionLeg] = []
+    naked_shorts: list[OptionLeg] = []
 
     # step 1: match covered calls/puts with stock position
-    if stock:
-        remaining = abs(stock.quantity)
-        target = OptionType.CALL if stock.quantity > 0 else OptionType.PUT
+    if shares >= 100:
+        remaining = shares
         new_shorts = []
         for short in shorts:
-            if short.type != target or remaining < 100:
+            if remaining < 100:
                 new_shorts.append(short)
                 continue
             paired = min(abs(short.quantity), remaining // 100)
             remaining -= paired * 100
             leftover = abs(short.quantity) - paired
             if leftover:
-                new_shorts.append(short.model_copy(update={"quantity": -leftover}))
+                new_shorts.append(_with_quantity(short, -leftover))
         shorts = new_shorts
 
     # step 2: match spreads
+    # shorts come in order of expiry, so the longs that can cover them (long
+    # expiry >= short expiry) only ever shrink to a later suffix of the longs, and
+    # each short takes the first ones left in it. Longs skipped for expiring too
+    # soon or being used up are never needed again, so one pointer suffices.
+    first = 0
     for short in shorts:
         unmatched = abs(short.quantity)
-        # iterate our long inventory to find a cover
-        for long, available in longs.items():
-            if unmatched <= 0:
+        while unmatched > 0:
+            while first < len(longs) and (
+                not available[first] or longs[first].expiration < short.expiration
+            ):
+                first += 1
+            if first == len(longs):
                 break
-            if available <= 0:
-                continue
-            # constraint: same type, long expiry >= short expiry
-            if long.type == short.type and long.expiration >= short.expiration:
-                paired = min(unmatched, available)
-                covered.append(short.model_copy(update={"quantity": -paired}))
-                covered.append(long.model_copy(update={"quantity": paired}))
-                unmatched -= paired
-                longs[long] -= paired
+            paired = min(unmatched, available[first])
+            covered.append(_with_quantity(short, -paired))
+            covered.append(_with_quantity(longs[first], paired))
+            unmatched -= paired
+            available[first] -= paired
 
         # remaining short quantity is naked
         if unmatched > 0:
-            naked_shorts.append(short.model_copy(update={"quantity": -unmatched}))
+            naked_shorts.append(_with_quantity(short, -unmatched))
+
+    naked_longs = [_with_quantity(leg, q) for leg, q in zip(longs, available) if q]
+    return _Side(covered, naked_shorts, naked_longs)
+
 
+def _combine_sides(stock: SharesLeg | None, calls: _Side, puts: _Side) -> Decomposition:
     # step 3: match strangles
-    strangles: list[tuple[Option, Option]] = []
-    naked_calls = deque(leg for leg in naked_shorts if leg.type == OptionType.CALL)
-    naked_puts = deque(leg for leg in naked_shorts if leg.type == OptionType.PUT)
+    strangles: list[tuple[OptionLeg, OptionLeg]] = []
+    naked_calls = deque(calls.naked_shorts)
+    naked_puts = deque(puts.naked_shorts)
 
     while naked_calls and naked_puts:
         call = naked_calls.popleft()
         put = naked_puts.popleft()
         q = min(abs(call.quantity), abs(put.quantity))
-        strangles.append(
-            (
-                call.model_copy(update={"quantity": -q}),
-                put.model_copy(update={"quantity": -q}),
-            )
-        )
+        strangles.append((_with_quantity(call, -q), _with_quantity(put, -q)))
         # handle remaining quantity
         if rem := abs(call.quantity) - q:
-            naked_calls.appendleft(call.model_copy(update={"quantity": -rem}))
+            naked_calls.appendleft(_with_quantity(call, -rem))
         if rem := abs(put.quantity) - q:
-            naked_puts.appendleft(put.model_copy(update={"quantity": -rem}))
+            naked_puts.appendleft(_with_quantity(put, -rem))
 
     # all unmatched options at this point go here
     naked = list(naked_calls)
     naked.extend(naked_puts)
-    naked.extend(
-        leg.model_copy(update={"quantity": q}) for leg, q in longs.items() if q
-    )
+    naked.extend(calls.naked_longs)
+    naked.extend(puts.naked_longs)
+    return Decomposition(stock, calls.covered + puts.covered, strangles, naked)
 
+
+def _calculate_totals(
+    decomposition: Decomposition,
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+) -> Requirements:
     # step 4: calculate totals
-    total = MarginRequirements()
-    if covered:
-        total += _calculate_margin_spread(covered)
-    if stock:
-        total += _calculate_margin_shares(stock)
-    for call, put in strangles:
+    total = Requirements()
+    if decomposition.covered:
+        total += _calculate_margin_spread(decomposition.covered)
+    if decomposition.stock:
+        total += _calculate_margin_shares(decomposition.stock)
+    for call, put in decomposition.strangles:
         total += _calculate_margin_short_strangle([call, put], underlying)
-    for leg in naked:
+    for leg in decomposition.naked:
         if leg.quantity > 0:
-            total += _calculate_margin_long_option(leg)
+            total += _calculate_margin_long_option(leg, as_of)
         else:
             total += _calculate_margin_short_option(leg, underlying)
+    return total
+
 
+def _group_requirements(
+    stock: SharesLeg | None,
+    netted: dict[NettedKey, OptionLeg],
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+) -> list[tuple[GroupType, list[OptionLeg | SharesLeg], Requirements]]:
+    """
+    Decompose a position and calculate each group on its own (step 4 one group
+    at a time), adding up to the same totals as :func:`_calculate_totals`.
+    """
+    decomposition = _decompose(stock, netted)
+    groups: list[tuple[GroupType, list[OptionLeg | SharesLeg], Requirements]] = []
+    if stock:
+        # shorts covered by the stock are dropped in step 1, so they're whatever
+        # the other groups left over
+        matched: Counter[NettedKey] = Counter()
+        for leg in decomposition.covered + decomposition.naked:
+            matched[leg.expiration, leg.strike, leg.type] += leg.quantity
+        for call, put in decomposition.strangles:
+            matched[call.expiration, call.strike, call.type] += call.quantity
+            matched[put.expiration, put.strike, put.type] += put.quantity
+        legs: list[OptionLeg | SharesLeg] = [stock]
+        for key in sorted(netted):
+            leg = netted[key]
+            if leg.quantity < 0 and leg.quantity != matched[key]:
+                legs.append(_with_quantity(leg, leg.quantity - matched[key]))
+        groups.append((GroupType.STOCK, legs, _calculate_margin_shares(stock)))
+    if decomposition.covered:
+        spreads = _calculate_margin_spread(decomposition.covered)
+        groups.append((GroupType.SPREADS, list(decomposition.covered), spreads))
+    for call, put in decomposition.strangles:
+        strangle = _calculate_margin_short_strangle([call, put], underlying)
+        groups.append((GroupType.STRANGLE, [call, put], strangle))
+    for leg in decomposition.naked:
+        if leg.quantity > 0:
+            naked = _calculate_margin_long_option(leg, as_of)
+        else:
+            naked = _calculate_margin_short_option(leg, underlying)
+        groups.append((GroupType.NAKED, [leg], naked))
+    return groups
+
+
+class FastPathStats(NamedTuple):
+    calls: int
+    hits: dict[str, int]
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Fraction of calls answered by a template instead of the full matching.
+        """
+        return sum(self.hits.values()) / self.calls if self.calls else 0.0
+
+
+class _FastPathCounts:
+    """
+    Fast path counters of a single thread, only ever updated by that thread so no
+    locking is needed even without the GIL.
+    """
+
+    __slots__ = ("calls", "hits")
+
+    def __init__(self):
+        self.calls = 0
+        self.hits: dict[str, int] = {}
+
+
+_thread_counts = threading.local()
+# counters of threads that are still running, summed on demand
+_live_counts: set[_FastPathCounts] = set()
+# counters of threads that have exited, folded together so they don't pile up
+_retired_counts = _FastPathCounts()
+_counts_lock = threading.Lock()
+
+
+class _CountsHandle:
+    """
+    Only referenced by its thread's locals, so it's collected when the thread
+    exits, which retires the thread's counters.
+    """
+
+    __slots__ = ("__weakref__",)
+
+
+def _retire_counts(counts: _FastPathCounts):
+    with _counts_lock:
+        _live_counts.discard(counts)
+        _retired_counts.calls += counts.calls
+        for name, hits in counts.hits.items():
+            _retired_counts.hits[name] = _retired_counts.hits.get(name, 0) + hits
+
+
+def _fast_path_counts() -> _FastPathCounts:
+    try:
+        return _thread_counts.counts
+    except AttributeError:
+        counts = _thread_counts.counts = _FastPathCounts()
+        handle = _thread_counts.handle = _CountsHandle()
+        weakref.finalize(handle, _retire_counts, counts)
+        with _counts_lock:
+            _live_counts.add(counts)
+        return counts
+
+
+def fast_path_stats() -> FastPathStats:
+    """
+    How many positions have been calculated so far, and how many of them matched
+    each of the common strategy templates.
+    """
+    hits: Counter[str] = Counter()
+    # both taken under the lock, so a thread retiring meanwhile isn't counted twice
+    with _counts_lock:
+        counts = list(_live_counts)
+        calls = _retired_counts.calls
+        hits.update(_retired_counts.hits)
+    for thread in counts:
+        calls += thread.calls
+        hits.update(dict(thread.hits))
+    return FastPathStats(calls, dict(hits))
+
+
+def _calculate_template(
+    stock: SharesLeg | None,
+    netted: dict[NettedKey, OptionLeg],
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+) -> Requirements | None:
+    """
+    Calculate common strategies directly from their closed-form requirements,
+    returning None if the position isn't one of them.
+    """
+    counts = _fast_path_counts()
+    counts.calls += 1
+    legs = [leg for leg in netted.values() if leg.quantity]
+    if not legs or len(legs) > 4:
+        return None
+    legs.sort(key=_strike_order)
+    unit = gcd(*(leg.quantity for leg in legs))
+    shape = (
+        (stock.quantity > 0) - (stock.quantity < 0) if stock else 0,
+        all(leg.expiration == legs[0].expiration for leg in legs),
+        tuple((leg.type, leg.quantity // unit) for leg in legs),
+    )
+    if template := _TEMPLATES.get(shape):
+        name, calculate = template
+        result = calculate(legs, stock, underlying, as_of)
+        if result is not None:
+            counts.hits[name] = counts.hits.get(name, 0) + 1
+        return result
+    return None
+
+
+def _strike_order(leg: OptionLeg) -> tuple[Decimal, str]:
+    return leg.strike, leg.type
+
+
+def _single_template(
+    legs: list[OptionLeg],
+    stock: None,
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+) -> Requirements:
+    if legs[0].quantity > 0:
+        return _calculate_margin_long_option(legs[0], as_of)
+    return _calculate_margin_short_option(legs[0], underlying)
+
+
+def _vertical_template(
+    legs: list[OptionLeg],
+    stock: None,
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+) -> Requirements:
+    short, long = legs if legs[0].quantity < 0 else reversed(legs)
+    # the max loss is the width if the long is further out of the money
+    if short.type == OptionType.CALL:
+        width = max(ZERO, long.strike - short.strike)
+    else:
+        width = max(ZERO, short.strike - long.strike)
+    requirement = (width + long.price - short.price) * 100 * long.quantity
+    return Requirements(requirement, requirement)
+
+
+def _strangle_template(
+    legs: list[OptionLeg],
+    stock: None,
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+) -> Requirements:
+    call, put = legs if legs[0].type == OptionType.CALL else reversed(legs)
+    return _calculate_margin_short_strangle([call, put], underlying)
+
+
+def _iron_condor_template(
+    legs: list[OptionLeg],
+    stock: None,
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+) -> Requirements | None:
+    long_put, long_call = legs[0], legs[3]
+    short_call, short_put = sorted(legs[1:3], key=lambda leg: leg.type)
+    # overlapping wings need the full strike scan
+    if short_put.strike > short_call.strike:
+        return None
+    width = max(
+        short_put.strike - long_put.strike, long_call.strike - short_call.strike
+    )
+    credit = short_put.price + short_call.price - long_put.price - long_call.price
+    requirement = (width - credit) * 100 * long_put.quantity
+    return Requirements(requirement, requirement)
+
+
+def _butterfly_template(
+    legs: list[OptionLeg],
+    stock: None,
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+) -> Requirements:
+    lower, body, upper = legs
+    lower_width = body.strike - lower.strike
+    upper_width = upper.strike - body.strike
+    # a broken wing loses the difference in widths on its wide side
+    if body.type == OptionType.CALL:
+        width = max(ZERO, upper_width - lower_width)
+    else:
+        width = max(ZERO, lower_width - upper_width)
+    debit = lower.price + upper.price - 2 * body.price
+    requirement = (width + debit) * 100 * lower.quantity
+    return Requirements(requirement, requirement)
+
+
+def _covered_template(
+    legs: list[OptionLeg],
+    stock: SharesLeg,
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+) -> Requirements | None:
+    # the stock pays for the covered option
+    if abs(stock.quantity) < 100 * abs(legs[0].quantity):
+        return None
+    return _calculate_margin_shares(stock)
+
+
+_TemplateFunc = Callable[..., Requirements | None]
+
+
+def _build_templates() -> dict[tuple, tuple[str, _TemplateFunc]]:
+    """
+    Map position shapes to templates. A shape is the direction of the stock, whether
+    all options expire together and the option types and quantities (divided by
+    their GCD) sorted by strike.
+    """
+    call, put = OptionType.CALL, OptionType.PUT
+    templates: dict[tuple, tuple[str, _TemplateFunc]] = {}
+    for same_expiration in (True, False):
+        for type in (call, put):
+            templates[0, same_expiration, ((type, 1),)] = ("single", _single_template)
+            templates[0, same_expiration, ((type, -1),)] = ("single", _single_template)
+        # strangles are paired regardless of expiration
+        for shape in (((call, -1), (put, -1)), ((put, -1), (call, -1))):
+            templates[0, same_expiration, shape] = ("strangle", _strangle_template)
+        templates[1, same_expiration, ((call, -1),)] = ("covered", _covered_template)
+        templates[-1, same_expiration, ((put, -1),)] = ("covered", _covered_template)
+    for type in (call, put):
+        for shape in (((type, 1), (type, -1)), ((type, -1), (type, 1))):
+            templates[0, True, shape] = ("vertical", _vertical_template)
+        shape = ((type, 1), (type, -2), (type, 1))
+        templates[0, True, shape] = ("butterfly", _butterfly_template)
+    # the second one is an iron butterfly, where the short call sorts first
+    for shape in (
+        ((put, 1), (put, -1), (call, -1), (call, 1)),
+        ((put, 1), (call, -1), (put, -1), (call, 1)),
+    ):
+        templates[0, True, shape] = ("iron condor", _iron_condor_template)
+    return templates
+
+
+_TEMPLATES = _build_templates()
+
+
+def _calculate_scaled(
+    netted: dict[NettedKey, OptionLeg],
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+) -> Requirements:
+    """
+    Calculate requirements for an options-only position by dividing it by the GCD
+    of its quantities, so that e.g. 3x and 7x the same iron condor share a single
+    cached evaluation of the 1x position.
+    """
+    legs = [leg for leg in netted.values() if leg.quantity]
+    if not legs:
+        return Requirements()
+    scale = gcd(*(leg.quantity for leg in legs))
+    unit = tuple(
+        sorted(
+            (leg.expiration, leg.strike, leg.type, leg.price, leg.quantity // scale)
+            for leg in legs
+        )
+    )
+    scaled, fixed_cash, strangles = _calculate_unit(
+        unit,
+        underlying.price,
+        underlying.etf_type,
+        underlying.leverage_factor,
+        as_of,
+    )
+    total = Requirements(
+        scaled.cash_requirement * scale + fixed_cash,
+        scaled.margin_requirement * scale,
+    )
+    # the strangle requirement isn't linear in the quantity, so it's calculated
+    # on the scaled legs
+    for call, put in strangles:
+        total += _calculate_margin_short_strangle(
+            [
+                _with_quantity(call, call.quantity * scale),
+                _with_quantity(put, put.quantity * scale),
+            ],
+            underlying,
+        )
     return total
 
 
-def _calculate_margin_long_option(option: Option) -> MarginRequirements:
+@lru_cache(maxsize=4096)
+def _calculate_unit(
+    unit: tuple[tuple[date, Decimal, str, Decimal, int], ...],
+    price: Decimal,
+    etf_type: ETFType | None,
+    leverage_factor: Decimal,
+    as_of: date,
+) -> tuple[Requirements, Decimal, tuple[tuple[OptionLeg, OptionLeg], ...]]:
+    """
+    Decompose a position with coprime quantities, returning the requirements that
+    scale with the position, the cash requirement that doesn't and the strangles.
+    """
+    netted = {
+        (expiration, strike, type): OptionLeg(expiration, price, quantity, strike, type)
+        for expiration, strike, type, price, quantity in unit
+    }
+    underlying = UnderlyingInfo(price, etf_type, leverage_factor)
+    # without stock, matching only takes minimums of quantities, so the
+    # decomposition of a multiple of this position is the same multiple of it
+    decomposition = _decompose(None, netted)
+    scaled = Requirements()
+    if decomposition.covered:
+        scaled += _calculate_margin_spread(decomposition.covered)
+    # the cash requirements for short options are per leg, not per contract
+    fixed_cash = ZERO
+    for leg in decomposition.naked:
+        if leg.quantity > 0:
+            scaled += _calculate_margin_long_option(leg, as_of)
+        else:
+            short = _calculate_margin_short_option(leg, underlying)
+            scaled.margin_requirement += short.margin_requirement
+            fixed_cash += short.cash_requirement
+    # cached results are shared between threads, so hand out an immutable tuple
+    return scaled, fixed_cash, tuple(decomposition.strangles)
+
+
+def _with_quantity(leg: OptionLeg, quantity: int) -> OptionLeg:
+    return OptionLeg(leg.expiration, leg.price, quantity, leg.strike, leg.type)
+
+
+def _calculate_margin_long_option(option: OptionLeg, as_of: date) -> Requirements:
     """
     Calculate margin for a single long option.
     Source: CBOE Margin Manual
     """
-    if option.expiration < date.today() + timedelta(days=90):
-        return MarginRequirements(
+    if option.expiration < as_of + timedelta(days=90):
+        return Requirements(
             # Pay for each put or call in full.
             cash_requirement=option.price * 100 * option.quantity,
             # Pay for each put or call in full.
             margin_requirement=option.price * 100 * option.quantity,
         )
     reduced_requirement = round(option.price * 3 / 4, 2)
-    return MarginRequirements(
+    return Requirements(
         # Pay for each put or call in full.
         cash_requirement=option.price * 100 * option.quantity,
         # Listed: 75% of the total cost of the option.
@@ -150,8 +741,8 @@ def _calculate_margin_long_option(option: Option) -> MarginRequirements:
 
 
 def _calculate_margin_short_option(
-    option: Option, underlying: Underlying
-) -> MarginRequirements:
+    option: OptionLeg, underlying: "Underlying | UnderlyingInfo"
+) -> Requirements:
     """
     Calculate margin for a single short option.
     Source: CBOE Margin Manual
@@ -229,15 +820,15 @@ def _calculate_margin_short_option(
             # Deposit underlying security.
             cash_requirement = (underlying.price - option.price) * 100
     margin_requirement *= 100 * abs(option.quantity)
-    return MarginRequirements(
+    return Requirements(
         cash_requirement=cash_requirement,
         margin_requirement=margin_requirement,
     )
 
 
 def _calculate_margin_short_strangle(
-    legs: list[Option], underlying: Underlying
-) -> MarginRequirements:
+    legs: list[OptionLeg], underlying: "Underlying | UnderlyingInfo"
+) -> Requirements:
     """
     Calculate margin for a short strangle.
     Source: CBOE Margin Manual
@@ -252,13 +843,13 @@ def _calculate_margin_short_strangle(
     else:
         margin_requirement = margin2.margin_requirement + legs[0].price * 100
     margin_requirement *= abs(legs[0].quantity)
-    return MarginRequirements(
+    return Requirements(
         cash_requirement=margin1.cash_requirement + margin2.cash_requirement,
         margin_requirement=margin_requirement,
     )
 
 
-def _calculate_loss_for(leg: Option, price: Decimal) -> Decimal:
+def _calculate_loss_for(leg: OptionLeg, price: Decimal) -> Decimal:
     """
     Calculate value at expiration for option at given price.
     """
@@ -269,7 +860,7 @@ def _calculate_loss_for(leg: Option, price: Decimal) -> Decimal:
     return itm_distance * leg.quantity * 100
 
 
-def _get_net_credit_or_debit(legs: list[Option]) -> Decimal:
+def _get_net_credit_or_debit(legs: list[OptionLeg]) -> Decimal:
     """
     Calculate total debit/credit paid/collected for the order.
     """
@@ -279,20 +870,32 @@ def _get_net_credit_or_debit(legs: list[Option]) -> Decimal:
     return total
 
 
-def _calculate_margin_spread(legs: list[Option]) -> MarginRequirements:
+# below this, valuing every leg at every strike is cheaper than sorting them
+_SWEEP_MIN_LEGS = 4
+
+
+def _calculate_margin_spread(legs: list[OptionLeg]) -> Requirements:
     """
     Calculate margin for a credit spread.
     Source: CBOE Margin Manual
     """
     strikes = set(leg.strike for leg in legs)
     pnl = _get_net_credit_or_debit(legs)
-    losses = []
-    for strike in strikes:
-        points = [_calculate_loss_for(leg, strike) for leg in legs]
-        losses.append(sum(points))  # type: ignore
-    margin_requirement = abs(min(losses)) + pnl
+    if len(legs) <= _SWEEP_MIN_LEGS:
+        losses = []
+        for strike in strikes:
+            points = [_calculate_loss_for(leg, strike) for leg in legs]
+            losses.append(sum(points))  # type: ignore
+        margin_requirement = abs(min(losses)) + pnl
+    else:
+        values = _values_at_strikes(legs)
+        # value the worst strike leg by leg, so the result is exactly what
+        # summing the losses of each leg gives
+        worst = min(strikes, key=values.__getitem__)
+        points = [_calculate_loss_for(leg, worst) for leg in legs]
+        margin_requirement = abs(sum(points)) + pnl  # type: ignore
 
-    return MarginRequirements(
+    return Requirements(
         # deposit and maintain cash or cash equivalents equal to the spread’s maximum
         # potential loss
         cash_requirement=margin_requirement,
@@ -302,7 +905,42 @@ def _calculate_margin_spread(legs: list[Option]) -> MarginRequirements:
     )
 
 
-def _calculate_margin_shares(shares: Shares) -> MarginRequirements:
+def _values_at_strikes(legs: list[OptionLeg]) -> dict[Decimal, Decimal]:
+    """
+    Value of all legs at expiration if the underlying closes at each strike.
+
+    The value is piecewise linear between strikes, so the strikes are swept in
+    order keeping running totals of the legs in the money instead of valuing every
+    leg at every strike: calls below the price are worth q * (price - strike), puts
+    above it q * (strike - price).
+    """
+    call_quantity = call_notional = ZERO
+    put_quantity = put_notional = ZERO
+    for leg in legs:
+        if leg.type == OptionType.PUT:
+            put_quantity += leg.quantity
+            put_notional += leg.quantity * leg.strike
+    values: dict[Decimal, Decimal] = {}
+    by_strike = sorted(legs, key=lambda leg: leg.strike)
+    i = 0
+    while i < len(by_strike):
+        strike = by_strike[i].strike
+        while i < len(by_strike) and by_strike[i].strike == strike:
+            leg = by_strike[i]
+            if leg.type == OptionType.CALL:
+                call_quantity += leg.quantity
+                call_notional += leg.quantity * leg.strike
+            else:
+                put_quantity -= leg.quantity
+                put_notional -= leg.quantity * leg.strike
+            i += 1
+        calls = call_quantity * strike - call_notional
+        puts = put_notional - put_quantity * strike
+        values[strike] = (calls + puts) * 100
+    return values
+
+
+def _calculate_margin_shares(shares: SharesLeg) -> Requirements:
     """
     Calculate margin for a stock position.
     Source: CBOE Margin Manual.
@@ -311,7 +949,7 @@ def _calculate_margin_shares(shares: Shares) -> MarginRequirements:
     half = round(shares.price / 2, 2) * abs(shares.quantity)
     if shares.quantity > 0:
         # long: pay 100% in cash, 50% requirement in margin account
-        return MarginRequirements(cash_requirement=value, margin_requirement=half)
+        return Requirements(cash_requirement=value, margin_requirement=half)
     # short: not permitted in cash account.
     # margin: short sale proceeds plus 50% requirement = 150%
-    return MarginRequirements(margin_requirement=value + half)
+    return Requirements(margin_requirement=value + half)
@@ -1,22 +1,12 @@
 import re
 from datetime import date, datetime
 from decimal import Decimal
-from enum import StrEnum
+from functools import cache
+from typing import Annotated, Any
 
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, TypeAdapter
 
-ZERO = Decimal(0)
-
-
-class ETFType(StrEnum):
-    BROAD = "broad-based"
-    NARROW = "narrow-based"
-    VOLATILITY = "volatility"
-
-
-class OptionType(StrEnum):
-    CALL = "C"
-    PUT = "P"
+from .legs import ZERO, ETFType, GroupType, OptionLeg, OptionType, SharesLeg
 
 
 class Option(BaseModel):
@@ -90,7 +80,94 @@ class Underlying(BaseModel):
 
 
 class Shares(BaseModel):
-    model_config = ConfigDict(frozen=True)
+    # so that an option with a missing or misspelled field can't pass as shares
+    model_config = ConfigDict(frozen=True, extra="forbid")
 
     price: Decimal
     quantity: int
+
+
+class MarginGroup(BaseModel):
+    """
+    Legs margined together, and what they require.
+    """
+
+    type: GroupType
+    legs: list[Option | Shares]
+    requirements: MarginRequirements
+
+
+class MarginBreakdown(MarginRequirements):
+    """
+    Requirements of a position along with how its legs were grouped. The
+    decomposition is only kept as a reference to the netted legs, and the
+    groups are calculated the first time `groups` is accessed.
+    """
+
+    _source: Any = PrivateAttr(default=None)
+    _groups: list[MarginGroup] | None = PrivateAttr(default=None)
+
+    @property
+    def groups(self) -> list[MarginGroup]:
+        if self._groups is None:
+            from .margin import _group_requirements
+
+            groups = []
+            for group_type, legs, total in _group_requirements(*self._source):
+                groups.append(
+                    MarginGroup.model_construct(
+                        type=group_type,
+                        legs=[_to_model(leg) for leg in legs],
+                        requirements=MarginRequirements.model_construct(
+                            cash_requirement=total.cash_requirement,
+                            margin_requirement=total.margin_requirement,
+                        ),
+                    )
+                )
+            self._groups = groups
+        return self._groups
+
+
+def _to_model(leg: OptionLeg | SharesLeg) -> Option | Shares:
+    if isinstance(leg, SharesLeg):
+        return Shares.model_construct(price=leg.price, quantity=leg.quantity)
+    return Option.model_construct(
+        expiration=leg.expiration,
+        price=leg.price,
+        quantity=leg.quantity,
+        strike=leg.strike,
+        type=leg.type,
+    )
+
+
+# tried in order by pydantic-core without calling back into Python: options
+# match on the first try, and anything with option fields is never shares
+Leg = Annotated[Option | Shares, Field(union_mode="left_to_right")]
+
+
+class Position(BaseModel):
+    legs: list[Leg]
+    underlying: Underlying
+
+
+@cache
+def _legs_adapter() -> TypeAdapter[list[Option | Shares]]:
+    return TypeAdapter(list[Leg])
+
+
+@cache
+def _positions_adapter() -> TypeAdapter[list[Position]]:
+    return TypeAdapter(list[Position])
+
+
+@cache
+def _requirements_adapter() -> TypeAdapter[list[MarginRequirements]]:
+    return TypeAdapter(list[MarginRequirements])
+
+
+def load_legs_json(data: str | bytes) -> list[Option | Shares]:
+    """
+    Parse and validate a JSON array of option and share legs in a single pass.
+    Legs with a `strike` are parsed as options, all others as shares.
+    """
+    return _legs_adapter().validate_json(data)
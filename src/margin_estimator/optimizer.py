@@ -0,0 +1,304 @@
+import heapq
+import time
+from datetime import date
+from decimal import Decimal
+from typing import TYPE_CHECKING
+
+from .legs import ZERO, OptionLeg, OptionType, Requirements, SharesLeg, UnderlyingInfo
+from .margin import (
+    NettedKey,
+    _calculate_margin_long_option,
+    _calculate_margin_short_option,
+    _calculate_margin_short_strangle,
+    _calculate_totals,
+    _combine_sides,
+    _covering_shares,
+    _Side,
+    _with_quantity,
+)
+
+if TYPE_CHECKING:
+    from .models import Underlying
+
+# costs are compared as integers in units of 1 / COST_SCALE dollars
+COST_SCALE = 10_000
+_INFINITY = float("inf")
+
+
+def calculate_optimized(
+    stock: SharesLeg | None,
+    netted: dict[NettedKey, OptionLeg],
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+    deadline: float,
+) -> Requirements | None:
+    """
+    Group a netted position to minimize its margin requirement, returning None if
+    the :func:`time.monotonic` `deadline` passes first.
+
+    Each short unit can be covered by stock, by a long of the same type (as a
+    vertical or calendar spread), paired with a short of the other type in a
+    strangle, or left naked. Starting from everything naked, each of these saves a
+    fixed amount per unit, so the best grouping is a maximum-savings flow from
+    short calls and long puts to short puts and long calls (and stock), found
+    with successive shortest paths.
+
+    Only the covering (steps 1 and 2) is taken from the flow. Shorts it leaves
+    uncovered, including those it pairs in strangles, go through the same
+    strangle matching and totals (steps 3 and 4) as the greedy grouping, so
+    strangles are charged at their grouped quantity like everywhere else.
+    Spreads and strangles are costed one contract at a time in the flow, while
+    the requirements returned are those of the whole grouping, so the result can
+    still be beaten by the greedy matching; callers should keep whichever is
+    lower.
+    """
+    legs = [leg for leg in netted.values() if leg.quantity]
+    calls = [leg for leg in legs if leg.type == OptionType.CALL]
+    puts = [leg for leg in legs if leg.type == OptionType.PUT]
+    short_calls = [leg for leg in calls if leg.quantity < 0]
+    short_puts = [leg for leg in puts if leg.quantity < 0]
+    long_calls = [leg for leg in calls if leg.quantity > 0]
+    long_puts = [leg for leg in puts if leg.quantity > 0]
+    naked_cost = {id(leg): _unit_cost(leg, underlying, as_of) for leg in legs}
+
+    # one side of the flow: short calls, long puts and shares covering puts;
+    # the other: short puts, long calls and shares covering calls
+    graph = _Graph()
+    source, sink = graph.node(), graph.node()
+    nodes: dict[int, int] = {}
+    for leg in short_calls + long_puts:
+        nodes[id(leg)] = graph.node()
+        graph.add(source, nodes[id(leg)], abs(leg.quantity), 0)
+    for leg in short_puts + long_calls:
+        nodes[id(leg)] = graph.node()
+        graph.add(nodes[id(leg)], sink, abs(leg.quantity), 0)
+    pairs: list[tuple[OptionLeg, OptionLeg, int]] = []
+
+    def pair(a: OptionLeg, b: OptionLeg, savings: int):
+        # only groupings that beat leaving both legs naked are worth considering
+        if savings > 0:
+            capacity = min(abs(a.quantity), abs(b.quantity))
+            edge = graph.add(nodes[id(a)], nodes[id(b)], capacity, -savings)
+            pairs.append((a, b, edge))
+
+    for short, longs in ((short_calls, long_calls), (short_puts, long_puts)):
+        for s in short:
+            for long in longs:
+                if long.expiration >= s.expiration:
+                    savings = naked_cost[id(s)] + naked_cost[id(long)]
+                    savings -= _spread_cost(s, long)
+                    if s.type == OptionType.CALL:
+                        pair(s, long, savings)
+                    else:
+                        pair(long, s, savings)
+    for call in short_calls:
+        for put in short_puts:
+            savings = naked_cost[id(call)] + naked_cost[id(put)]
+            savings -= _strangle_cost(call, put, underlying)
+            pair(call, put, savings)
+    covering: list[tuple[OptionLeg, int]] = []
+    for option_type, shorts in (
+        (OptionType.CALL, short_calls),
+        (OptionType.PUT, short_puts),
+    ):
+        shares = _covering_shares(stock, option_type) // 100
+        if shares and shorts:
+            shares_node = graph.node()
+            if option_type == OptionType.CALL:
+                graph.add(shares_node, sink, shares, 0)
+            else:
+                graph.add(source, shares_node, shares, 0)
+            for s in shorts:
+                # covered shorts are free, so they save their whole requirement
+                capacity, cost = min(abs(s.quantity), shares), -naked_cost[id(s)]
+                if option_type == OptionType.CALL:
+                    edge = graph.add(nodes[id(s)], shares_node, capacity, cost)
+                else:
+                    edge = graph.add(shares_node, nodes[id(s)], capacity, cost)
+                covering.append((s, edge))
+
+    if not graph.min_cost_flow(source, sink, deadline):
+        return None
+
+    remaining = {id(leg): abs(leg.quantity) for leg in legs}
+    covered: dict[OptionType, list[OptionLeg]] = {t: [] for t in OptionType}
+    for a, b, edge in pairs:
+        flow = graph.flow(edge)
+        # strangles are left for step 3, which pairs the uncovered shorts
+        if not flow or (a.quantity < 0 and b.quantity < 0):
+            continue
+        remaining[id(a)] -= flow
+        remaining[id(b)] -= flow
+        covered[a.type].append(_with_quantity(a, flow if a.quantity > 0 else -flow))
+        covered[b.type].append(_with_quantity(b, flow if b.quantity > 0 else -flow))
+    for s, edge in covering:
+        remaining[id(s)] -= graph.flow(edge)
+    sides = {}
+    for option_type, typed in ((OptionType.CALL, calls), (OptionType.PUT, puts)):
+        # in the same order as the greedy matching leaves them
+        uncovered = [
+            _with_quantity(leg, remaining[id(leg)] * (1 if leg.quantity > 0 else -1))
+            for leg in sorted(typed, key=lambda leg: (leg.expiration, leg.strike))
+            if remaining[id(leg)]
+        ]
+        sides[option_type] = _Side(
+            covered[option_type],
+            [leg for leg in uncovered if leg.quantity < 0],
+            [leg for leg in uncovered if leg.quantity > 0],
+        )
+    decomposition = _combine_sides(stock, sides[OptionType.CALL], sides[OptionType.PUT])
+    return _calculate_totals(decomposition, underlying, as_of)
+
+
+def _scaled(value: Decimal) -> int:
+    return int(value * COST_SCALE)
+
+
+def _unit_cost(
+    leg: OptionLeg, underlying: "Underlying | UnderlyingInfo", as_of: date
+) -> int:
+    """
+    Margin requirement of one naked contract.
+    """
+    if leg.quantity > 0:
+        unit = _calculate_margin_long_option(_with_quantity(leg, 1), as_of)
+    else:
+        unit = _calculate_margin_short_option(_with_quantity(leg, -1), underlying)
+    return _scaled(unit.margin_requirement)
+
+
+def _spread_cost(short: OptionLeg, long: OptionLeg) -> int:
+    """
+    Margin requirement of a one-lot vertical or calendar spread.
+    """
+    # the max loss is the width if the long is further out of the money
+    if short.type == OptionType.CALL:
+        width = max(ZERO, long.strike - short.strike)
+    else:
+        width = max(ZERO, short.strike - long.strike)
+    return _scaled((width + long.price - short.price) * 100)
+
+
+def _strangle_cost(
+    call: OptionLeg, put: OptionLeg, underlying: "Underlying | UnderlyingInfo"
+) -> int:
+    """
+    Margin requirement of a one-lot short strangle.
+    """
+    unit = _calculate_margin_short_strangle(
+        [_with_quantity(call, -1), _with_quantity(put, -1)], underlying
+    )
+    return _scaled(unit.margin_requirement)
+
+
+class _Graph:
+    """
+    Flow network stored as parallel edge arrays, with each edge's residual
+    reverse edge at the index with the last bit flipped.
+    """
+
+    def __init__(self):
+        self.adjacency: list[list[int]] = []
+        self.heads: list[int] = []
+        self.capacities: list[int] = []
+        self.costs: list[int] = []
+
+    def node(self) -> int:
+        self.adjacency.append([])
+        return len(self.adjacency) - 1
+
+    def add(self, tail: int, head: int, capacity: int, cost: int) -> int:
+        edge = len(self.heads)
+        self.adjacency[tail].append(edge)
+        self.adjacency[head].append(edge + 1)
+        self.heads += [head, tail]
+        self.capacities += [capacity, 0]
+        self.costs += [cost, -cost]
+        return edge
+
+    def flow(self, edge: int) -> int:
+        return self.capacities[edge ^ 1]
+
+    def min_cost_flow(self, source: int, sink: int, deadline: float) -> bool:
+        """
+        Push flow along cheapest paths while they have a negative cost, i.e. find
+        the flow of minimum cost (of any size). Returns False if the deadline
+        passes first.
+        """
+        potentials = self._initial_potentials(source)
+        while True:
+            if time.monotonic() > deadline:
+                return False
+            distances, parents = self._shortest_paths(source, potentials)
+            if distances[sink] == _INFINITY:
+                return True
+            for node, distance in enumerate(distances):
+                if distance != _INFINITY:
+                    potentials[node] += distance
+            # with the potentials updated, the sink's is the path's true cost
+            if potentials[sink] - potentials[source] >= 0:
+                return True
+            bottleneck = None
+            node = sink
+            while node != source:
+                edge = parents[node]
+                capacity = self.capacities[edge]
+                bottleneck = (
+                    capacity if bottleneck is None else min(bottleneck, capacity)
+                )
+                node = self.heads[edge ^ 1]
+            node = sink
+            while node != source:
+                edge = parents[node]
+                self.capacities[edge] -= bottleneck
+                self.capacities[edge ^ 1] += bottleneck
+                node = self.heads[edge ^ 1]
+
+    def _initial_potentials(self, source: int) -> list[float]:
+        # Bellman-Ford; before any flow the network is acyclic and only a few
+        # edges deep, so this settles in a handful of rounds
+        potentials = [_INFINITY] * len(self.adjacency)
+        potentials[source] = 0
+        changed = True
+        while changed:
+            changed = False
+            for tail, edges in enumerate(self.adjacency):
+                if potentials[tail] == _INFINITY:
+                    continue
+                for edge in edges:
+                    if self.capacities[edge]:
+                        distance = potentials[tail] + self.costs[edge]
+                        if distance < potentials[self.heads[edge]]:
+                            potentials[self.heads[edge]] = distance
+                            changed = True
+        return [0 if p == _INFINITY else p for p in potentials]
+
+    def _shortest_paths(
+        self, source: int, potentials: list[float]
+    ) -> tuple[list[float], list[int]]:
+        # Dijkstra on costs reduced by the potentials, which keeps them positive
+        adjacency, heads, capacities, costs = (
+            self.adjacency,
+            self.heads,
+            self.capacities,
+            self.costs,
+        )
+        distances = [_INFINITY] * len(adjacency)
+        parents = [-1] * len(adjacency)
+        distances[source] = 0
+        queue = [(0, source)]
+        pop, push = heapq.heappop, heapq.heappush
+        while queue:
+            distance, tail = pop(queue)
+            if distance > distances[tail]:
+                continue
+            base = distance + potentials[tail]
+            for edge in adjacency[tail]:
+                if capacities[edge]:
+                    head = heads[edge]
+                    candidate = base + costs[edge] - potentials[head]
+                    if candidate < distances[head]:
+                        distances[head] = candidate
+                        parents[head] = edge
+                        push(queue, (candidate, head))
+        return distances, parents
@@ -0,0 +1,123 @@
+import csv
+import os
+import threading
+from decimal import Decimal
+from typing import Iterable
+
+from .legs import ETFType, UnderlyingInfo
+
+
+class UnderlyingRegistry:
+    """
+    Reference data of underlyings, loaded once from a CSV file with `symbol`,
+    `etf_type` and `leverage_factor` columns (blank for an ordinary equity and a
+    factor of 1), along with their latest prices.
+
+    Every symbol gets a fixed index the first time it's loaded, and the current
+    :class:`~margin_estimator.legs.UnderlyingInfo` of each index is built when
+    its price or reference data changes rather than on every calculation. Pass
+    a symbol or index along with the registry instead of an underlying to
+    :func:`~margin_estimator.calculate_margin` and the batch functions.
+    """
+
+    def __init__(self, path: str | os.PathLike):
+        self.path = path
+        self.slots: dict[str, int] = {}
+        self.symbols: list[str] = []
+        # None for symbols that were dropped from the file by a reload
+        self._reference: list[tuple[ETFType | None, Decimal] | None] = []
+        # None until a price is known
+        self._prices: list[Decimal | None] = []
+        # built from the two above, None if either is
+        self._underlyings: list[UnderlyingInfo | None] = []
+        self._lock = threading.Lock()
+        self._mtime: int | None = None
+        self.reload()
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Load the file again if it changed since it was last loaded. Symbols keep
+        their indexes and prices, and new symbols are added at the end. Returns
+        whether the file was loaded.
+        """
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime and not force:
+            return False
+        with open(self.path, newline="") as f:
+            rows = list(csv.DictReader(f))
+        with self._lock:
+            reference: list[tuple[ETFType | None, Decimal] | None]
+            reference = [None] * len(self.symbols)
+            for row in rows:
+                symbol = row["symbol"]
+                slot = self._slot(symbol)
+                if slot == len(reference):
+                    reference.append(None)
+                etf_type = ETFType(row["etf_type"]) if row.get("etf_type") else None
+                leverage_factor = Decimal(row.get("leverage_factor") or 1)
+                reference[slot] = etf_type, leverage_factor
+            self._reference = reference
+            for slot in range(len(self.symbols)):
+                self._build(slot)
+            self._mtime = mtime
+        return True
+
+    def index(self, symbol: str) -> int:
+        """
+        Index of `symbol`, which can be passed instead of it to skip the lookup.
+        """
+        return self.slots[symbol]
+
+    def update_prices(self, prices: Iterable[tuple[str | int, Decimal]]):
+        """
+        Set the latest prices of `(symbol or index, price)` pairs.
+        """
+        with self._lock:
+            for key, price in prices:
+                if isinstance(key, str):
+                    slot = self.slots[key]
+                else:
+                    slot = self._check_index(key)
+                if self._reference[slot] is None:
+                    raise KeyError(key)
+                self._prices[slot] = price
+                self._build(slot)
+
+    def __getitem__(self, key: str | int) -> UnderlyingInfo:
+        slot = self.slots[key] if isinstance(key, str) else self._check_index(key)
+        underlying = self._underlyings[slot]
+        if underlying is None:
+            if self._reference[slot] is None:
+                raise KeyError(key)
+            raise ValueError(f"No price is known for {self.symbols[slot]}!")
+        return underlying
+
+    def __contains__(self, symbol: str) -> bool:
+        slot = self.slots.get(symbol)
+        return slot is not None and self._reference[slot] is not None
+
+    def _check_index(self, index: int) -> int:
+        # negative indexes would count from the end instead of failing
+        if not 0 <= index < len(self.symbols):
+            raise KeyError(index)
+        return index
+
+    def _slot(self, symbol: str) -> int:
+        slot = self.slots.get(symbol)
+        if slot is None:
+            slot = len(self.symbols)
+            self.symbols.append(symbol)
+            self._reference.append(None)
+            self._prices.append(None)
+            self._underlyings.append(None)
+            self.slots[symbol] = slot
+        return slot
+
+    def _build(self, slot: int):
+        reference, price = self._reference[slot], self._prices[slot]
+        if reference is None or price is None:
+            self._underlyings[slot] = None
+        else:
+            # a new object rather than an update, so calculations in progress on
+            # other threads keep a consistent underlying
+            self._underlyings[slot] = UnderlyingInfo(price, *reference)
@@ -0,0 +1,242 @@
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+from itertools import islice
+from typing import TYPE_CHECKING, Iterable, Iterator, Mapping, NamedTuple
+
+from .legs import ZERO, OptionLeg, OptionType, Requirements, SharesLeg, UnderlyingInfo
+from .margin import (
+    NettedKey,
+    _calculate_totals,
+    _combine_sides,
+    _covering_shares,
+    _match_side,
+    _Side,
+    _with_quantity,
+)
+
+if TYPE_CHECKING:
+    from .models import Underlying
+
+# root (padded to 6) + YYMMDD + C/P + strike * 1000 (padded to 8)
+OCC_LENGTH = 21
+
+
+class Fill(NamedTuple):
+    """
+    A single execution. `symbol` is an OCC option symbol, or the ticker of the
+    underlying for shares.
+    """
+
+    account: str
+    symbol: str
+    price: Decimal
+    quantity: int
+    timestamp: datetime
+
+
+@lru_cache(maxsize=65536)
+def _parse_symbol(symbol: str) -> tuple[str, NettedKey | None]:
+    if len(symbol) != OCC_LENGTH:
+        return symbol, None
+    expiration = datetime.strptime(symbol[6:12], "%y%m%d").date()
+    strike = Decimal(int(symbol[13:])) / 1000
+    return symbol[:6].rstrip(), (expiration, strike, OptionType(symbol[12]))
+
+
+class _Book:
+    """
+    The position of one account in one underlying, with each side kept matched so
+    a fill only re-matches the side(s) it changes.
+    """
+
+    __slots__ = ("stock_quantity", "stock_cost", "netted", "sides", "requirements")
+
+    def __init__(
+        self,
+        stock_quantity: int = 0,
+        stock_cost: Decimal = ZERO,
+        legs: Iterable[OptionLeg] = (),
+    ):
+        self.stock_quantity = stock_quantity
+        self.stock_cost = stock_cost
+        self.netted: dict[OptionType, dict[NettedKey, OptionLeg]] = {
+            OptionType.CALL: {},
+            OptionType.PUT: {},
+        }
+        for leg in legs:
+            key = (leg.expiration, leg.strike, leg.type)
+            self.netted[leg.type][key] = _with_quantity(leg, leg.quantity)
+        stock = self.stock
+        self.sides = {t: self._match(t, stock) for t in OptionType}
+        self.requirements = Requirements()
+
+    @property
+    def stock(self) -> SharesLeg | None:
+        if not self.stock_quantity:
+            return None
+        return SharesLeg(
+            Decimal(self.stock_cost / self.stock_quantity), self.stock_quantity
+        )
+
+    def _match(self, option_type: OptionType, stock: SharesLeg | None) -> _Side:
+        netted = self.netted[option_type]
+        # sort by expiry to cover near-term risk first
+        legs = [netted[key] for key in sorted(netted) if netted[key].quantity]
+        return _match_side(legs, _covering_shares(stock, option_type))
+
+    def apply(self, key: NettedKey | None, price: Decimal, quantity: int):
+        if key is None:
+            self.stock_quantity += quantity
+            self.stock_cost += quantity * price
+            stock = self.stock
+            # the covering shares changed, so both sides need matching again
+            self.sides = {t: self._match(t, stock) for t in OptionType}
+            return
+        netted = self.netted[key[2]]
+        if key in netted:
+            # like calculate_margin, keep the price of the first fill
+            netted[key].quantity += quantity
+        else:
+            netted[key] = OptionLeg(key[0], price, quantity, key[1], key[2])
+        self.sides[key[2]] = self._match(key[2], self.stock)
+
+    def total(
+        self, underlying: "Underlying | UnderlyingInfo", as_of: date
+    ) -> Requirements:
+        self.requirements = _calculate_totals(
+            _combine_sides(
+                self.stock, self.sides[OptionType.CALL], self.sides[OptionType.PUT]
+            ),
+            underlying,
+            as_of,
+        )
+        return self.requirements
+
+
+class ReplayCheckpoint:
+    """
+    The state of a :class:`ReplayEngine` after its first `position` fills. Only
+    plain values are kept, so checkpoints can be pickled.
+    """
+
+    __slots__ = ("position", "as_of", "books")
+
+    def __init__(
+        self,
+        position: int,
+        as_of: date | None,
+        books: dict[tuple[str, str], tuple[int, Decimal, list[OptionLeg]]],
+    ):
+        self.position = position
+        self.as_of = as_of
+        self.books = books
+
+
+class ReplayEngine:
+    """
+    Replays an ordered fill log, tracking the requirements of every account after
+    each fill the way :func:`~margin_estimator.calculate_margin` would calculate
+    them for all the account's fills so far, grouped by underlying.
+
+    Underlying prices are held fixed at those in `underlyings`, keyed by ticker.
+    `as_of` defaults to the date of the first fill.
+
+    Fills are never netted again, but each one re-matches the side(s) of its book
+    and totals the book again, which takes O(n log n) for the n contracts open in
+    that account and underlying. Replaying books that trade a bounded set of
+    contracts is linear in the number of fills, while a single book that keeps
+    opening new contracts is quadratic (see `benchmarks/replay.py`).
+    """
+
+    def __init__(
+        self,
+        underlyings: "Mapping[str, Underlying | UnderlyingInfo]",
+        as_of: date | None = None,
+    ):
+        self.underlyings = underlyings
+        self.as_of = as_of
+        self.position = 0
+        self.checkpoints: list[ReplayCheckpoint] = []
+        self._books: dict[tuple[str, str], _Book] = {}
+        self._accounts: dict[str, tuple[Decimal, Decimal]] = {}
+
+    @classmethod
+    def from_checkpoint(
+        cls,
+        checkpoint: ReplayCheckpoint,
+        underlyings: "Mapping[str, Underlying | UnderlyingInfo]",
+    ) -> "ReplayEngine":
+        """
+        Restore an engine from a checkpoint. Passing it the same fill log resumes
+        the replay after the fills the checkpoint already includes.
+        """
+        engine = cls(underlyings, checkpoint.as_of)
+        engine.position = checkpoint.position
+        for (account, root), state in checkpoint.books.items():
+            book = _Book(*state)
+            engine._books[account, root] = book
+            if checkpoint.as_of is not None:
+                new = book.total(underlyings[root], checkpoint.as_of)
+                cash, margin = engine._accounts.get(account, (ZERO, ZERO))
+                engine._accounts[account] = (
+                    cash + new.cash_requirement,
+                    margin + new.margin_requirement,
+                )
+        return engine
+
+    def requirements(self, account: str) -> Requirements:
+        """
+        Current requirements of `account`, summed over its underlyings.
+        """
+        cash, margin = self._accounts.get(account, (ZERO, ZERO))
+        return Requirements(cash, margin)
+
+    def apply(self, fill: Fill) -> Requirements:
+        """
+        Apply a single fill, returning the new requirements of its account.
+        """
+        if self.as_of is None:
+            self.as_of = fill.timestamp.date()
+        root, key = _parse_symbol(fill.symbol)
+        book = self._books.get((fill.account, root))
+        if book is None:
+            book = self._books[fill.account, root] = _Book()
+        old = book.requirements
+        book.apply(key, fill.price, fill.quantity)
+        new = book.total(self.underlyings[root], self.as_of)
+        self.position += 1
+        # only this book changed, so adjust the account total by the difference
+        cash, margin = self._accounts.get(fill.account, (ZERO, ZERO))
+        cash += new.cash_requirement - old.cash_requirement
+        margin += new.margin_requirement - old.margin_requirement
+        self._accounts[fill.account] = (cash, margin)
+        return Requirements(cash, margin)
+
+    def replay(
+        self, fills: Iterable[Fill], checkpoint_every: int | None = None
+    ) -> Iterator[tuple[Fill, Requirements]]:
+        """
+        Apply `fills` in order, yielding each fill with the requirements of its
+        account afterwards. Fills before the engine's position (e.g. those included
+        in the checkpoint it was restored from) are skipped. Every
+        `checkpoint_every` fills, a checkpoint is added to `checkpoints`.
+        """
+        for fill in islice(fills, self.position, None):
+            yield fill, self.apply(fill)
+            if checkpoint_every and self.position % checkpoint_every == 0:
+                self.checkpoints.append(self.checkpoint())
+
+    def checkpoint(self) -> ReplayCheckpoint:
+        """
+        Snapshot the current state of the replay.
+        """
+        books = {}
+        for name, book in self._books.items():
+            legs = [
+                _with_quantity(leg, leg.quantity)
+                for side in book.netted.values()
+                for leg in side.values()
+            ]
+            books[name] = (book.stock_quantity, book.stock_cost, legs)
+        return ReplayCheckpoint(self.position, self.as_of, books)
@@ -0,0 +1,220 @@
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import TYPE_CHECKING, Sequence
+
+from .legs import ZERO, ETFType, OptionLeg, OptionType, SharesLeg, UnderlyingInfo
+from .margin import (
+    NettedKey,
+    _calculate_margin_shares,
+    _calculate_margin_spread,
+    _decompose,
+    _get_net_credit_or_debit,
+    _net,
+)
+
+if TYPE_CHECKING:
+    from .models import Option, Shares, Underlying
+
+# slack on strangle comparisons, since the requirements compared are rounded
+_ROUNDING = Decimal("0.01")
+
+
+class _Linear:
+    """
+    Per-contract requirement of a short option, `price + slope * underlying +
+    intercept`, valid while the underlying stays within `[low, high]`.
+    """
+
+    __slots__ = ("slope", "intercept", "low", "high")
+
+    def __init__(
+        self, slope: Decimal, intercept: Decimal, low: Decimal, high: Decimal | None
+    ):
+        self.slope = slope
+        self.intercept = intercept
+        self.low = low
+        self.high = high
+
+
+class MarginSensitivity:
+    """
+    The margin requirement of a position as a linear function of its option prices
+    and the underlying price, valid as long as prices stay in the region where the
+    same requirement rules apply.
+
+    `coefficients[i]` is the change in requirement per dollar change in the price
+    of `contracts[i]`. Per-contract requirements are rounded to the cent, which the
+    linear model ignores, so results can be off by up to `tolerance`.
+    """
+
+    def __init__(self, contracts: list[NettedKey]):
+        self.contracts = contracts
+        self.index = {contract: i for i, contract in enumerate(contracts)}
+        self.coefficients = [ZERO] * len(contracts)
+        self.underlying_coefficient = ZERO
+        self.constant = ZERO
+        self.tolerance = ZERO
+        self.underlying_low = ZERO
+        self.underlying_high: Decimal | None = None
+        # (call index, put index, slope, intercept, call is greater): the strangle
+        # requirement depends on which side is greater
+        self.strangles: list[tuple[int, int, Decimal, Decimal, bool]] = []
+
+    def contains(self, prices: Sequence[Decimal], underlying_price: Decimal) -> bool:
+        """
+        Whether the linear model holds for the given prices (in the same order as
+        `contracts`) and underlying price.
+        """
+        if underlying_price < self.underlying_low:
+            return False
+        if self.underlying_high is not None and underlying_price > self.underlying_high:
+            return False
+        for call, put, slope, intercept, call_greater in self.strangles:
+            difference = prices[call] - prices[put] + slope * underlying_price
+            difference += intercept
+            if call_greater and difference <= _ROUNDING:
+                return False
+            if not call_greater and difference >= -_ROUNDING:
+                return False
+        return True
+
+    def evaluate(
+        self, prices: Sequence[Decimal], underlying_price: Decimal
+    ) -> Decimal | None:
+        """
+        Margin requirement for the given prices (in the same order as `contracts`)
+        and underlying price, or None if they're outside the region where the model
+        holds and the position needs to be recalculated.
+        """
+        if not self.contains(prices, underlying_price):
+            return None
+        total = self.constant + self.underlying_coefficient * underlying_price
+        for coefficient, price in zip(self.coefficients, prices):
+            total += coefficient * price
+        return total
+
+
+def margin_sensitivity(
+    legs: "Sequence[Option | Shares | OptionLeg | SharesLeg]",
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date | None = None,
+) -> MarginSensitivity:
+    """
+    Linearize the margin requirement of a position around the current prices.
+
+    Matching only depends on quantities, strikes and expirations, so the groups
+    the position decomposes into never change with prices. Within them, spreads and
+    long options are linear in the option prices, and naked shorts and strangles
+    are too, until the underlying crosses a strike or the point where the minimum
+    requirement takes over, or the other side of a strangle becomes greater.
+    """
+    as_of = as_of or date.today()
+    stock, netted = _net(legs)
+    decomposition = _decompose(stock, netted)
+    result = MarginSensitivity([key for key, leg in netted.items() if leg.quantity])
+
+    def index(leg: OptionLeg) -> int:
+        return result.index[leg.expiration, leg.strike, leg.type]
+
+    if stock:
+        result.constant += _calculate_margin_shares(stock).margin_requirement
+    if decomposition.covered:
+        # the max loss only depends on strikes, the rest is the net debit
+        spread = _calculate_margin_spread(decomposition.covered)
+        result.constant += spread.margin_requirement
+        result.constant -= _get_net_credit_or_debit(decomposition.covered)
+        for leg in decomposition.covered:
+            result.coefficients[index(leg)] += leg.quantity * 100
+    for call, put in decomposition.strangles:
+        quantity = abs(call.quantity)
+        call_linear = _linearize_short(call, underlying)
+        put_linear = _linearize_short(put, underlying)
+        _restrict(result, call_linear)
+        _restrict(result, put_linear)
+        slope = call_linear.slope - put_linear.slope
+        intercept = call_linear.intercept - put_linear.intercept
+        difference = call.price - put.price + slope * underlying.price + intercept
+        call_greater = difference > 0
+        result.strangles.append(
+            (index(call), index(put), slope, intercept, call_greater)
+        )
+        greater, linear, other = (
+            (call, call_linear, put) if call_greater else (put, put_linear, call)
+        )
+        # the greater side is multiplied by the quantity twice
+        result.coefficients[index(greater)] += 100 * quantity * quantity
+        result.underlying_coefficient += 100 * quantity * quantity * linear.slope
+        result.constant += 100 * quantity * quantity * linear.intercept
+        result.coefficients[index(other)] += 100 * quantity
+        result.tolerance += Decimal("0.5") * quantity * quantity
+    cutoff = as_of + timedelta(days=90)
+    for leg in decomposition.naked:
+        quantity = abs(leg.quantity)
+        if leg.quantity > 0:
+            if leg.expiration < cutoff:
+                result.coefficients[index(leg)] += 100 * quantity
+            else:
+                result.coefficients[index(leg)] += 75 * quantity
+                result.tolerance += Decimal("0.5") * quantity
+            continue
+        linear = _linearize_short(leg, underlying)
+        _restrict(result, linear)
+        result.coefficients[index(leg)] += 100 * quantity
+        result.underlying_coefficient += 100 * quantity * linear.slope
+        result.constant += 100 * quantity * linear.intercept
+        result.tolerance += Decimal("0.5") * quantity
+    return result
+
+
+def _restrict(result: MarginSensitivity, linear: _Linear):
+    result.underlying_low = max(result.underlying_low, linear.low)
+    if linear.high is not None:
+        if result.underlying_high is None:
+            result.underlying_high = linear.high
+        else:
+            result.underlying_high = min(result.underlying_high, linear.high)
+
+
+def _linearize_short(
+    option: OptionLeg, underlying: "Underlying | UnderlyingInfo"
+) -> _Linear:
+    """
+    Linearize the per-contract requirement of a short option (less its price) in
+    the underlying price, following the branches of
+    `_calculate_margin_short_option`.
+    """
+    leverage = underlying.leverage_factor
+    percent = (
+        Decimal(3) / 20 if underlying.etf_type == ETFType.BROAD else Decimal(1) / 5
+    )
+    strike = option.strike
+    low, high = ZERO, None
+    # base: percentage of the underlying less the out-of-the-money amount
+    if option.type == OptionType.PUT:
+        minimum = (ZERO, strike / 10 * leverage)
+        if underlying.price <= strike:
+            base, high = (percent * leverage, ZERO), strike
+        else:
+            base, low = (percent * leverage - 1, strike), strike
+    else:
+        minimum = (leverage / 10, ZERO)
+        if underlying.price >= strike:
+            base, low = (percent * leverage, ZERO), strike
+        else:
+            base, high = (percent * leverage + 1, -strike), strike
+    # whichever is greater applies until the two cross
+    difference = (base[0] - minimum[0], base[1] - minimum[1])
+    if difference[0] * underlying.price + difference[1] >= 0:
+        slope, intercept = base
+        sign = 1
+    else:
+        slope, intercept = minimum
+        sign = -1
+    if difference[0]:
+        crossing = -difference[1] / difference[0]
+        # the active side stays greater on one side of the crossing
+        if sign * difference[0] > 0:
+            low = max(low, crossing)
+        else:
+            high = crossing if high is None else min(high, crossing)
+    return _Linear(slope, intercept, low, high)
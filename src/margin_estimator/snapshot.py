@@ -0,0 +1,99 @@
+import hashlib
+from concurrent.futures import Executor
+from datetime import date, timedelta
+from typing import TYPE_CHECKING, Hashable, Iterable, Sequence
+
+from .batch import calculate_margin_many
+from .legs import OptionLeg, SharesLeg, UnderlyingInfo
+from .margin import _net
+
+if TYPE_CHECKING:
+    from .models import MarginRequirements, Option, Shares, Underlying
+
+    Portfolio = tuple[
+        Hashable,
+        Sequence[Option | Shares | OptionLeg | SharesLeg],
+        Underlying | UnderlyingInfo,
+    ]
+
+
+class MarginSnapshot:
+    """
+    Requirements of every portfolio in a run, each stored with a hash of the
+    inputs it was calculated from. `recalculated` lists the portfolios whose
+    inputs changed since the previous snapshot. Only plain values are kept, so
+    snapshots can be pickled between runs.
+    """
+
+    __slots__ = ("as_of", "hashes", "results", "recalculated")
+
+    def __init__(
+        self,
+        as_of: date,
+        hashes: dict[Hashable, bytes],
+        results: "dict[Hashable, MarginRequirements]",
+        recalculated: list[Hashable],
+    ):
+        self.as_of = as_of
+        self.hashes = hashes
+        self.results = results
+        self.recalculated = recalculated
+
+
+def snapshot_margins(
+    portfolios: "Iterable[Portfolio]",
+    previous: MarginSnapshot | None = None,
+    executor: Executor | None = None,
+    as_of: date | None = None,
+) -> MarginSnapshot:
+    """
+    Calculate margin for `(portfolio_id, legs, underlying)` tuples, reusing the
+    results of `previous` for portfolios whose inputs haven't changed since.
+
+    A portfolio's inputs are its netted legs (including the price each is
+    calculated at), its stock, its underlying and, for long options, whether
+    they're far enough from expiration as of `as_of` for the reduced
+    requirement, so a new day only recalculates portfolios whose longs crossed
+    that cutoff. Changed portfolios are calculated with
+    :func:`~margin_estimator.calculate_margin_many` on `executor`, if given.
+    """
+    as_of = as_of or date.today()
+    hashes: dict[Hashable, bytes] = {}
+    results: "dict[Hashable, MarginRequirements]" = {}
+    changed: list[Hashable] = []
+    positions = []
+    for key, legs, underlying in portfolios:
+        digest = _content_hash(legs, underlying, as_of)
+        hashes[key] = digest
+        if previous is not None and previous.hashes.get(key) == digest:
+            results[key] = previous.results[key]
+        else:
+            changed.append(key)
+            positions.append((legs, underlying))
+    calculated = calculate_margin_many(positions, executor, as_of=as_of)
+    results.update(zip(changed, calculated))
+    return MarginSnapshot(as_of, hashes, results, changed)
+
+
+def _content_hash(
+    legs: "Sequence[Option | Shares | OptionLeg | SharesLeg]",
+    underlying: "Underlying | UnderlyingInfo",
+    as_of: date,
+) -> bytes:
+    """
+    Hash everything the requirements of a portfolio depend on.
+    """
+    stock, netted = _net(legs)
+    cutoff = as_of + timedelta(days=90)
+    lines = [f"U {underlying.price} {underlying.etf_type} {underlying.leverage_factor}"]
+    if stock:
+        lines.append(f"S {stock.price} {stock.quantity}")
+    for key in sorted(netted):
+        leg = netted[key]
+        if leg.quantity:
+            reduced = leg.quantity > 0 and leg.expiration >= cutoff
+            lines.append(
+                f"O {leg.expiration} {leg.strike} {leg.type} {leg.price} "
+                f"{leg.quantity} {reduced:d}"
+            )
+    return hashlib.blake2b("\n".join(lines).encode(), digest_size=16).digest()
@@ -0,0 +1,203 @@
+import mmap
+import struct
+from datetime import date
+from decimal import ROUND_HALF_EVEN, Decimal
+from os import PathLike
+from typing import TYPE_CHECKING, Iterable, Mapping, Sequence
+
+import numpy as np
+
+from .legs import ETFType, OptionLeg, OptionType, SharesLeg, UnderlyingInfo
+from .margin import calculate_requirements
+
+if TYPE_CHECKING:
+    from .models import Option, Shares, Underlying
+
+MAGIC = b"MEST"
+VERSION = 1
+# magic, version, number of underlyings, number of legs
+HEADER = struct.Struct("<4sIQQ")
+# fixed-point scales for the integer fields
+PRICE_SCALE = 10_000
+STRIKE_SCALE = 1_000
+LEVERAGE_SCALE = 100
+
+KIND_CALL = 0
+KIND_PUT = 1
+KIND_SHARES = 2
+_ETF_TYPES: list[ETFType | None] = [None, *ETFType]
+
+UNDERLYING_DTYPE = np.dtype(
+    [
+        ("symbol", "S12"),
+        ("price", "<i8"),
+        ("leverage_factor", "<i4"),
+        ("etf_type", "u1"),
+    ]
+)
+LEG_DTYPE = np.dtype(
+    [
+        ("account", "<u8"),
+        ("underlying", "<u4"),
+        ("expiration", "<i4"),  # date.toordinal()
+        ("strike", "<i8"),
+        ("price", "<i8"),
+        ("quantity", "<i4"),
+        ("kind", "u1"),
+    ]
+)
+RESULT_DTYPE = np.dtype(
+    [
+        ("account", "<u8"),
+        ("underlying", "<u4"),
+        ("cash_requirement", "<i8"),
+        ("margin_requirement", "<i8"),
+    ]
+)
+
+
+class PositionStore:
+    """
+    A position file mapped into memory. `underlyings` and `legs` are read-only
+    structured arrays backed by the mapping, with legs sorted by account and
+    underlying.
+    """
+
+    def __init__(self, path: str | PathLike):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_underlyings, n_legs = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} position store!")
+        offset = HEADER.size
+        self.underlyings = np.frombuffer(
+            self._mmap, UNDERLYING_DTYPE, n_underlyings, offset
+        )
+        offset += UNDERLYING_DTYPE.itemsize * n_underlyings
+        self.legs = np.frombuffer(self._mmap, LEG_DTYPE, n_legs, offset)
+
+    def close(self):
+        del self.underlyings, self.legs
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_store(
+    path: str | PathLike,
+    underlyings: "Mapping[str, Underlying | UnderlyingInfo]",
+    positions: "Iterable[tuple[int, str, Sequence[Option | Shares]]]",
+):
+    """
+    Write `(account, symbol, legs)` positions along with their underlyings to a
+    position store. Prices may have at most 4 decimal places and strikes 3, and
+    symbols at most 12 bytes in UTF-8.
+    """
+    symbols = {symbol: i for i, symbol in enumerate(underlyings)}
+    table = np.zeros(len(symbols), UNDERLYING_DTYPE)
+    for i, (symbol, underlying) in enumerate(underlyings.items()):
+        encoded = symbol.encode()
+        # NumPy would silently cut longer symbols short
+        if len(encoded) > UNDERLYING_DTYPE["symbol"].itemsize:
+            raise ValueError(f"{symbol} is too long to be stored!")
+        table[i] = (
+            encoded,
+            _to_fixed(underlying.price, PRICE_SCALE),
+            _to_fixed(underlying.leverage_factor, LEVERAGE_SCALE),
+            _ETF_TYPES.index(underlying.etf_type),
+        )
+    records = []
+    for account, symbol, legs in positions:
+        for leg in legs:
+            if hasattr(leg, "strike"):
+                records.append(
+                    (
+                        account,
+                        symbols[symbol],
+                        leg.expiration.toordinal(),
+                        _to_fixed(leg.strike, STRIKE_SCALE),
+                        _to_fixed(leg.price, PRICE_SCALE),
+                        leg.quantity,
+                        KIND_CALL if leg.type == OptionType.CALL else KIND_PUT,
+                    )
+                )
+            else:
+                price = _to_fixed(leg.price, PRICE_SCALE)
+                records.append(
+                    (account, symbols[symbol], 0, 0, price, leg.quantity, KIND_SHARES)
+                )
+    legs = np.array(records, LEG_DTYPE)
+    legs.sort(order=["account", "underlying"], kind="stable")
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(table), len(legs)))
+        f.write(table.tobytes())
+        f.write(legs.tobytes())
+
+
+def calculate_margin_store(store: PositionStore, out_path: str | PathLike) -> np.memmap:
+    """
+    Calculate margin requirements for every (account, underlying) group in the
+    store, writing them to a memory-mapped array of `RESULT_DTYPE` at `out_path`.
+    Requirements are stored in units of 1 / `PRICE_SCALE` dollars.
+    """
+    legs = store.legs
+    underlyings = [
+        UnderlyingInfo(
+            _from_fixed(row["price"], PRICE_SCALE),
+            _ETF_TYPES[row["etf_type"]],
+            _from_fixed(row["leverage_factor"], LEVERAGE_SCALE),
+        )
+        for row in store.underlyings
+    ]
+    # group boundaries are wherever account or underlying changes
+    changed = (legs["account"][1:] != legs["account"][:-1]) | (
+        legs["underlying"][1:] != legs["underlying"][:-1]
+    )
+    starts = np.concatenate(([0], np.flatnonzero(changed) + 1)) if len(legs) else []
+    ends = [*starts[1:], len(legs)]
+    results = np.lib.format.open_memmap(
+        out_path, mode="w+", dtype=RESULT_DTYPE, shape=(len(starts),)
+    )
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        group = legs[start:end]
+        underlying = int(group["underlying"][0])
+        total = calculate_requirements(
+            [_to_leg(row) for row in group.tolist()], underlyings[underlying]
+        )
+        results[i] = (
+            group["account"][0],
+            underlying,
+            _to_fixed(total.cash_requirement, PRICE_SCALE, exact=False),
+            _to_fixed(total.margin_requirement, PRICE_SCALE, exact=False),
+        )
+    results.flush()
+    return results
+
+
+def _to_leg(row: tuple) -> OptionLeg | SharesLeg:
+    _, _, expiration, strike, price, quantity, kind = row
+    if kind == KIND_SHARES:
+        return SharesLeg(_from_fixed(price, PRICE_SCALE), quantity)
+    return OptionLeg(
+        date.fromordinal(expiration),
+        _from_fixed(price, PRICE_SCALE),
+        quantity,
+        _from_fixed(strike, STRIKE_SCALE),
+        OptionType.CALL if kind == KIND_CALL else OptionType.PUT,
+    )
+
+
+def _to_fixed(value: Decimal, scale: int, exact: bool = True) -> int:
+    scaled = Decimal(value) * scale
+    fixed = int(scaled.to_integral_value(ROUND_HALF_EVEN))
+    if exact and fixed != scaled:
+        raise ValueError(f"{value} can't be stored with a scale of {scale}!")
+    return fixed
+
+
+def _from_fixed(value: int, scale: int) -> Decimal:
+    return Decimal(int(value)) / scale
@@ -0,0 +1,163 @@
+from datetime import date
+from typing import TYPE_CHECKING, Hashable, Iterable, Mapping, Sequence
+
+import numpy as np
+
+from .legs import ETFType, OptionLeg, OptionType, SharesLeg, UnderlyingInfo
+from .margin import Decomposition, _calculate_totals, _decompose, _net
+
+if TYPE_CHECKING:
+    from .models import Option, Shares, Underlying
+
+
+class StressResult:
+    """
+    Requirements of every `(account, symbol)` group (rows of `cash` and `margin`)
+    in every scenario (columns), along with the underlying prices the scenarios
+    gave each group.
+    """
+
+    __slots__ = ("groups", "shocks", "prices", "cash", "margin")
+
+    def __init__(
+        self,
+        groups: list[tuple[Hashable, str]],
+        shocks: list[float],
+        prices: np.ndarray,
+        cash: np.ndarray,
+        margin: np.ndarray,
+    ):
+        self.groups = groups
+        self.shocks = shocks
+        self.prices = prices
+        self.cash = cash
+        self.margin = margin
+
+    def account_margin(self) -> dict[Hashable, np.ndarray]:
+        """
+        Margin requirement of each account in every scenario, summed over its
+        underlyings.
+        """
+        accounts: dict[Hashable, int] = {}
+        rows = [
+            accounts.setdefault(account, len(accounts)) for account, _ in self.groups
+        ]
+        totals = np.zeros((len(accounts), len(self.shocks)))
+        np.add.at(totals, rows, self.margin)
+        return dict(zip(accounts, totals))
+
+
+def stress_margins(
+    portfolios: "Iterable[tuple[Hashable, str, Sequence[Option | Shares | OptionLeg | SharesLeg]]]",
+    underlyings: "Mapping[str, Underlying | UnderlyingInfo]",
+    betas: Mapping[str, float],
+    shocks: Sequence[float],
+    as_of: date | None = None,
+) -> StressResult:
+    """
+    Calculate requirements of `(account, symbol, legs)` groups under moves of the
+    market index by each of `shocks` (e.g. -0.1 for a 10% drop). The underlying
+    of each group moves by the shock times its beta in `betas` (1 if missing),
+    and everything else, including the prices of the legs, is held fixed.
+    Results match calling :func:`~margin_estimator.calculate_margin` for every
+    group at every scenario price, up to float rounding.
+
+    Matching doesn't depend on the underlying's price, and neither do spreads,
+    long options or shares, so each group is decomposed and those parts are
+    totalled just once. Only the naked shorts and strangles are evaluated per
+    scenario, for all groups at once as shorts × scenarios arrays. Requires the
+    `numpy` extra.
+    """
+    as_of = as_of or date.today()
+    shocks = [float(shock) for shock in shocks]
+    groups: list[tuple[Hashable, str]] = []
+    fixed_cash: list[float] = []
+    fixed_margin: list[float] = []
+    naked: list[tuple[int, OptionLeg]] = []
+    strangles: list[tuple[int, OptionLeg, OptionLeg]] = []
+    for account, symbol, legs in portfolios:
+        row = len(groups)
+        groups.append((account, symbol))
+        decomposition = _decompose(*_net(legs))
+        shorts = [leg for leg in decomposition.naked if leg.quantity < 0]
+        longs = [leg for leg in decomposition.naked if leg.quantity > 0]
+        fixed = _calculate_totals(
+            Decomposition(decomposition.stock, decomposition.covered, [], longs),
+            underlyings[symbol],
+            as_of,
+        )
+        fixed_cash.append(float(fixed.cash_requirement))
+        fixed_margin.append(float(fixed.margin_requirement))
+        naked.extend((row, leg) for leg in shorts)
+        strangles.extend((row, call, put) for call, put in decomposition.strangles)
+
+    # scenario prices of every group's underlying
+    info = [underlyings[symbol] for _, symbol in groups]
+    spot = np.array([float(underlying.price) for underlying in info])
+    beta = np.array([float(betas.get(symbol, 1)) for _, symbol in groups])
+    prices = spot[:, None] * (1 + beta[:, None] * np.array(shocks)[None, :])
+    prices = np.maximum(prices, 0)
+    broad = np.array([underlying.etf_type == ETFType.BROAD for underlying in info])
+    leverage = np.array([float(underlying.leverage_factor) for underlying in info])
+
+    cash = np.repeat(np.array(fixed_cash)[:, None], len(shocks), axis=1)
+    margin = np.repeat(np.array(fixed_margin)[:, None], len(shocks), axis=1)
+    if naked:
+        rows = np.array([row for row, _ in naked])
+        short_cash, short_margin = _short_requirements(
+            [leg for _, leg in naked], prices[rows], broad[rows], leverage[rows]
+        )
+        np.add.at(cash, rows, short_cash)
+        np.add.at(margin, rows, short_margin)
+    if strangles:
+        rows = np.array([row for row, _, _ in strangles])
+        calls = [call for _, call, _ in strangles]
+        puts = [put for _, _, put in strangles]
+        call_cash, call_margin = _short_requirements(
+            calls, prices[rows], broad[rows], leverage[rows]
+        )
+        put_cash, put_margin = _short_requirements(
+            puts, prices[rows], broad[rows], leverage[rows]
+        )
+        call_premium = np.array([float(call.price) for call in calls])[:, None] * 100
+        put_premium = np.array([float(put.price) for put in puts])[:, None] * 100
+        # the greater requirement plus the proceeds of the other side
+        strangle_margin = np.where(
+            call_margin > put_margin,
+            call_margin + put_premium,
+            put_margin + call_premium,
+        )
+        quantity = np.array([abs(call.quantity) for call in calls])[:, None]
+        np.add.at(cash, rows, call_cash + put_cash)
+        np.add.at(margin, rows, strangle_margin * quantity)
+    return StressResult(groups, shocks, prices, cash, margin)
+
+
+def _short_requirements(
+    legs: list[OptionLeg],
+    prices: np.ndarray,
+    broad: np.ndarray,
+    leverage: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Requirements of short options (rows) at each of their underlying's scenario
+    prices (columns), following `_calculate_margin_short_option`.
+    """
+    is_call = np.array([leg.type == OptionType.CALL for leg in legs])[:, None]
+    strike = np.array([float(leg.strike) for leg in legs])[:, None]
+    premium = np.array([float(leg.price) for leg in legs])[:, None]
+    quantity = np.array([abs(leg.quantity) for leg in legs])[:, None]
+    broad = broad[:, None]
+    leverage = leverage[:, None]
+    otm_distance = np.where(
+        is_call, np.maximum(strike - prices, 0), np.maximum(prices - strike, 0)
+    )
+    # 15% of a broad-based index, 20% of anything else
+    percent = np.where(broad, 0.15, 0.2)
+    base = np.round(premium + prices * percent * leverage - otm_distance, 2)
+    # minimum for calls is 10% of the underlying, for puts 10% of the strike
+    minimum = np.round(premium + np.where(is_call, prices, strike) / 10 * leverage, 2)
+    margin = np.maximum(minimum, base) * 100 * quantity
+    # narrow-based calls are covered by depositing the underlying
+    cash_basis = np.where(is_call & ~broad, prices, strike)
+    return (cash_basis - premium) * 100, margin
@@ -0,0 +1,56 @@
+from datetime import date, timedelta
+from typing import TYPE_CHECKING, Sequence
+
+from .legs import OptionLeg, Requirements, SharesLeg, UnderlyingInfo
+from .margin import calculate_requirements
+
+if TYPE_CHECKING:
+    from .models import MarginRequirements, Option, Shares, Underlying
+
+
+def margin_timeline(
+    legs: "Sequence[Option | Shares | OptionLeg | SharesLeg]",
+    underlying: "Underlying | UnderlyingInfo",
+    start: date,
+    end: date,
+) -> "list[tuple[date, MarginRequirements]]":
+    """
+    Project the requirements of a position from `start` through `end`, holding
+    prices fixed and dropping options once they've expired.
+
+    Returns a step function as `(date, requirements)` pairs, each of which holds
+    until the next one. Requirements only change when an option expires or when a
+    long option gets within 90 days of expiration, so only those dates are
+    calculated.
+    """
+    from .models import MarginRequirements
+
+    dates = {start}
+    for leg in legs:
+        if hasattr(leg, "strike"):
+            # longs lose their reduced requirement 89 days before expiration and
+            # options drop off the day after
+            expiring = leg.expiration - timedelta(days=89)
+            expired = leg.expiration + timedelta(days=1)
+            for change in (expiring, expired):
+                if start < change <= end:
+                    dates.add(change)
+
+    steps: list[tuple[date, Requirements]] = []
+    for day in sorted(dates):
+        alive = [
+            leg for leg in legs if not hasattr(leg, "strike") or leg.expiration >= day
+        ]
+        total = calculate_requirements(alive, underlying, day)
+        if not steps or steps[-1][1] != total:
+            steps.append((day, total))
+    return [
+        (
+            day,
+            MarginRequirements.model_construct(
+                cash_requirement=total.cash_requirement,
+                margin_requirement=total.margin_requirement,
+            ),
+        )
+        for day, total in steps
+    ]
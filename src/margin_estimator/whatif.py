@@ -0,0 +1,203 @@
+from datetime import date
+from decimal import Decimal
+from typing import TYPE_CHECKING, Iterable, Sequence
+
+from .legs import ZERO, OptionLeg, OptionType, Requirements, SharesLeg, UnderlyingInfo
+from .margin import (
+    NettedKey,
+    _calculate_totals,
+    _combine_sides,
+    _covering_shares,
+    _decompose,
+    _match_side,
+    _net,
+    _Side,
+    _with_quantity,
+)
+
+if TYPE_CHECKING:
+    from .models import MarginRequirements, Option, Shares, Underlying
+
+
+def marginal_margin(
+    book: "Sequence[Option | Shares]",
+    candidates: "Iterable[Sequence[Option | Shares]]",
+    underlying: "Underlying",
+    as_of: date | None = None,
+) -> "list[MarginRequirements]":
+    """
+    Calculate how much each candidate order would change the margin requirements
+    of an existing position, i.e. `calculate_margin(book + candidate) -
+    calculate_margin(book)` for every candidate.
+
+    The book is netted and matched only once. Calls and puts are matched
+    independently until strangles are paired, so a candidate only re-matches the
+    side(s) it actually trades.
+    """
+    from .models import MarginRequirements
+
+    state = _BookState(book, as_of or date.today())
+    base = state.requirements(underlying)
+    deltas = []
+    for candidate in candidates:
+        total = state.with_order(candidate, underlying)
+        deltas.append(
+            MarginRequirements.model_construct(
+                cash_requirement=total.cash_requirement - base.cash_requirement,
+                margin_requirement=total.margin_requirement - base.margin_requirement,
+            )
+        )
+    return deltas
+
+
+class _BookState:
+    """
+    A position that has been netted and matched once, against which orders can
+    be evaluated cheaply.
+    """
+
+    def __init__(
+        self, book: "Sequence[Option | Shares | OptionLeg | SharesLeg]", as_of: date
+    ):
+        self.book = book
+        self.as_of = as_of
+        self.stock, netted = _net(book)
+        self.netted: dict[OptionType, dict[NettedKey, OptionLeg]] = {
+            OptionType.CALL: {},
+            OptionType.PUT: {},
+        }
+        for key, leg in netted.items():
+            self.netted[leg.type][key] = leg
+        self.sides = {t: self._match(t, self.netted[t]) for t in OptionType}
+
+    def _match(
+        self, option_type: OptionType, netted: dict[NettedKey, OptionLeg]
+    ) -> _Side:
+        # sort by expiry to cover near-term risk first
+        legs = [netted[key] for key in sorted(netted) if netted[key].quantity]
+        return _match_side(legs, _covering_shares(self.stock, option_type))
+
+    def requirements(
+        self, underlying: "Underlying | UnderlyingInfo", *sides: _Side
+    ) -> Requirements:
+        calls, puts = sides or (self.sides[OptionType.CALL], self.sides[OptionType.PUT])
+        return _calculate_totals(
+            _combine_sides(self.stock, calls, puts), underlying, self.as_of
+        )
+
+    def with_order(
+        self,
+        order: "Sequence[Option | Shares | OptionLeg | SharesLeg]",
+        underlying: "Underlying | UnderlyingInfo",
+    ) -> Requirements:
+        """
+        Requirements of the book plus `order`.
+        """
+        if any(not hasattr(leg, "strike") for leg in order):
+            # shares change which shorts are covered, so start over
+            return _calculate_totals(
+                _decompose(*_net([*self.book, *order])), underlying, self.as_of
+            )
+        merged: dict[OptionType, dict[NettedKey, OptionLeg]] = {}
+        for leg in order:
+            key = (leg.expiration, leg.strike, leg.type)
+            side = merged.setdefault(leg.type, dict(self.netted[leg.type]))
+            if key in side:
+                side[key] = _with_quantity(side[key], side[key].quantity + leg.quantity)
+            else:
+                side[key] = _with_quantity(leg, leg.quantity)
+        sides = [
+            self._match(t, merged[t]) if t in merged else self.sides[t]
+            for t in (OptionType.CALL, OptionType.PUT)
+        ]
+        return self.requirements(underlying, *sides)
+
+
+def max_quantity(
+    book: "Sequence[Option | Shares]",
+    strategy_legs: "Sequence[Option | Shares]",
+    underlying: "Underlying",
+    buying_power: Decimal,
+    cash_account: bool = False,
+    limit: int = 10_000,
+    as_of: date | None = None,
+) -> int:
+    """
+    Find the largest multiple of `strategy_legs` (up to `limit`) that can be added
+    to `book` without the additional requirement exceeding `buying_power`. Uses the
+    cash requirement if `cash_account` is set, otherwise the margin requirement.
+
+    Assumes only that the additional requirement doesn't shrink as the strategy
+    grows. Each step guesses where the buying power runs out by extrapolating the
+    line through the last two quantities evaluated: first up from 0 (doubling
+    where the line is flat) until a quantity that can't be afforded is found, then
+    within that bracket, bisecting whenever the guess falls outside it. A guess is
+    only returned once the full calculation shows that it can be afforded and one
+    more can't. Spreads and covered legs grow close to linearly and take a handful
+    of evaluations; strangles grow quadratically with the quantity and take more.
+    """
+    state = _BookState(book, as_of or date.today())
+    base = _pick(state.requirements(underlying), cash_account)
+    evaluated: dict[int, Decimal] = {0: ZERO}
+
+    def additional(quantity: int) -> Decimal:
+        if quantity not in evaluated:
+            order = [_scale(leg, quantity) for leg in strategy_legs]
+            total = state.with_order(order, underlying)
+            evaluated[quantity] = _pick(total, cash_account) - base
+        return evaluated[quantity]
+
+    def extrapolate(a: int, b: int) -> int | None:
+        # where the line through a and b reaches the buying power
+        slope = (additional(b) - additional(a)) / (b - a)
+        if slope <= 0:
+            return None
+        return a + int((buying_power - additional(a)) / slope)
+
+    # find a quantity that can't be afforded, following the slope from 0
+    low, high = 0, 1
+    while additional(high) <= buying_power:
+        if high == limit:
+            return limit
+        guess = extrapolate(low, high)
+        low = high
+        if guess is None or guess <= high:
+            high = min(2 * high, limit)
+            continue
+        guess = min(guess, limit)
+        if additional(guess) > buying_power:
+            high = guess
+        elif guess == limit:
+            return limit
+        elif additional(guess + 1) > buying_power:
+            # the guess is affordable and one more isn't
+            return guess
+        else:
+            # past a change in slope, keep going from here
+            low, high = guess, guess + 1
+    # now additional(low) <= buying power < additional(high)
+    while high - low > 1:
+        guess = extrapolate(low, high)
+        if guess is None or not low < guess < high:
+            guess = (low + high) // 2
+        if additional(guess) > buying_power:
+            high = guess
+        elif additional(guess + 1) > buying_power:
+            return guess
+        else:
+            low = guess + 1
+    return low
+
+
+def _pick(requirements: Requirements, cash_account: bool) -> Decimal:
+    if cash_account:
+        return requirements.cash_requirement
+    return requirements.margin_requirement
+
+
+def _scale(
+    leg: "Option | Shares | OptionLeg | SharesLeg", quantity: int
+) -> OptionLeg | SharesLeg:
+    if hasattr(leg, "strike"):
+        return _with_quantity(leg, leg.quantity * quantity)
+    return SharesLeg(leg.price, leg.quantity * quantity)
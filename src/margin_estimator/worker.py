@@ -0,0 +1,78 @@
+"""
+Worker for :func:`~margin_estimator.distributed.distribute_margins`. Run one per
+core on each machine::
+
+    python -m margin_estimator.worker --host 0.0.0.0 --port 7878
+"""
+
+import argparse
+import socketserver
+
+from .distributed import (
+    MESSAGE_ERROR,
+    MESSAGE_RESULT,
+    MESSAGE_SHARD,
+    _receive,
+    _send,
+    decode_shard,
+    encode_results,
+)
+from .margin import calculate_requirements
+
+DEFAULT_PORT = 7878
+
+
+class _ShardHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # the coordinator keeps one connection open per worker for the whole run
+        while True:
+            try:
+                kind, shard, payload = _receive(self.request)
+            except OSError:
+                return
+            if kind != MESSAGE_SHARD:
+                return
+            try:
+                as_of, portfolios = decode_shard(payload)
+                results = [
+                    calculate_requirements(legs, underlying, as_of)
+                    for legs, underlying in portfolios
+                ]
+            except Exception as e:
+                _send(self.request, MESSAGE_ERROR, shard, repr(e).encode())
+                continue
+            _send(self.request, MESSAGE_RESULT, shard, encode_results(results))
+
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    """
+    TCP server calculating the shards it's sent. Pass port 0 to pick a free port,
+    which is then available from `server_address`.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = DEFAULT_PORT):
+        super().__init__((host, port), _ShardHandler)
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m margin_estimator.worker",
+        description="Serve margin calculations to a distributed coordinator.",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(argv)
+    with WorkerServer(args.host, args.port) as server:
+        host, port = server.server_address[:2]
+        print(f"listening on {host}:{port}", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,54 @@
+import json
+import pickle
 import random
-from datetime import date, timedelta
+import socket
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 from decimal import Decimal
 
+import pytest
+from pydantic import ValidationError
+
 from margin_estimator import (
     ETFType,
+    Fill,
+    MarginAggregator,
     Option,
+    OptionLeg,
     OptionType,
+    PriceTable,
+    ReplayEngine,
+    SharesLeg,
+    TickFanout,
     Underlying,
+    UnderlyingInfo,
+    UnderlyingRegistry,
     calculate_margin,
+    calculate_margin_json,
+    calculate_margin_many,
+    calculate_requirements,
+    chain_margin_table,
+    check_margin,
+    fast_path_stats,
+    iter_margins,
+    load_legs_json,
+    margin_bound,
+    margin_sensitivity,
+    margin_timeline,
+    marginal_margin,
+    max_quantity,
+    snapshot_margins,
 )
-from margin_estimator.models import MarginRequirements, Shares
+from margin_estimator.distributed import ShardError, distribute_margins
+from margin_estimator.hedges import find_margin_hedges
+from margin_estimator.margin import _calculate_unit, _live_counts
+from margin_estimator.models import MarginBreakdown, MarginRequirements, Shares
+from margin_estimator.portfolio import portfolio_margin, portfolio_margin_many
+from margin_estimator.stress import stress_margins
+from margin_estimator.worker import WorkerServer, _ShardHandler
 
 
 def test_long_option():
@@ -1047,3 +1086,995 @@ def test_long_shares_dont_cover_short_put():
     assert margin == calculate_margin([put], underlying) + calculate_margin(
         [shares], underlying
     )
+
+
+def test_lightweight_legs():
+    underlying = Underlying(price=Decimal("445.35"), etf_type=ETFType.BROAD)
+    put = Option(
+        expiration=date.today(),
+        price=Decimal("0.1"),
+        quantity=-1,
+        strike=410,
+        type=OptionType.PUT,
+    )
+    shares = Shares(price=Decimal("440.5"), quantity=100)
+    lite = calculate_requirements(
+        [
+            OptionLeg(put.expiration, put.price, -1, put.strike, put.type),
+            SharesLeg(shares.price, shares.quantity),
+        ],
+        UnderlyingInfo(underlying.price, etf_type=ETFType.BROAD),
+    )
+    assert lite == calculate_margin([put, shares], underlying)
+
+
+def test_import_is_pydantic_free():
+    code = "import sys, margin_estimator; assert 'pydantic' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_load_legs_json():
+    data = b"""[
+        {"expiration": "2024-12-20", "price": "5.61", "quantity": -1,
+         "strike": "572", "type": "P"},
+        {"price": "587.5", "quantity": 100}
+    ]"""
+    put, shares = load_legs_json(data)
+    assert put == Option(
+        expiration=date(2024, 12, 20),
+        price=Decimal("5.61"),
+        quantity=-1,
+        strike=572,
+        type=OptionType.PUT,
+    )
+    assert shares == Shares(price=Decimal("587.5"), quantity=100)
+
+    # options missing a field, or with a misspelled one, aren't taken for shares
+    for malformed in (
+        b'[{"expiration": "2024-12-20", "price": "5.61", "quantity": -1, "type": "P"}]',
+        b'[{"expiration": "2024-12-20", "price": "5.61", "quantity": -1, '
+        b'"strik": "572", "type": "P"}]',
+    ):
+        with pytest.raises(ValidationError):
+            load_legs_json(malformed)
+
+
+def test_calculate_margin_json():
+    underlying = Underlying(price=Decimal("11.03"))
+    put = Option(
+        expiration=date.today(),
+        price=Decimal("0.45"),
+        quantity=-1,
+        strike=11,
+        type=OptionType.PUT,
+    )
+    shares = Shares(price=Decimal("47.38"), quantity=100)
+    positions = [
+        {"legs": [put.model_dump(mode="json")], "underlying": {"price": "11.03"}},
+        {"legs": [shares.model_dump(mode="json")], "underlying": {"price": "50"}},
+    ]
+    results = json.loads(calculate_margin_json(json.dumps(positions)))
+    expected = [
+        calculate_margin([put], underlying),
+        calculate_margin([shares], underlying),
+    ]
+    assert [MarginRequirements(**r) for r in results] == expected
+
+
+def test_calculate_margin_frame():
+    pd = pytest.importorskip("pandas")
+    from margin_estimator.frame import calculate_margin_frame
+
+    today = date.today()
+    df = pd.DataFrame(
+        {
+            "account": ["A", "A", "A", "B", "B"],
+            "underlying": ["SPY", "SPY", "F", "SPY", "SPY"],
+            "expiration": [today, today, today, today, None],
+            "strike": [567, 572, 11, 572, None],
+            "type": ["P", "P", "P", "P", None],
+            "price": [4.78, 5.61, 0.45, 5.61, 587.5],
+            "quantity": [1, -1, -1, -1, 100],
+        }
+    )
+    underlyings = pd.DataFrame(
+        {
+            "underlying": ["SPY", "F"],
+            "price": [587.88, 11.03],
+            "etf_type": [ETFType.BROAD, None],
+        }
+    )
+    result = calculate_margin_frame(df, underlyings)
+    spy = Underlying(price=Decimal("587.88"), etf_type=ETFType.BROAD)
+    f = Underlying(price=Decimal("11.03"))
+
+    def put(strike, price, quantity):
+        return Option(
+            expiration=today,
+            price=Decimal(price),
+            quantity=quantity,
+            strike=strike,
+            type=OptionType.PUT,
+        )
+
+    expected = {
+        ("A", "F"): calculate_margin([put(11, "0.45", -1)], f),
+        ("A", "SPY"): calculate_margin(
+            [put(567, "4.78", 1), put(572, "5.61", -1)], spy
+        ),
+        ("B", "SPY"): calculate_margin(
+            [put(572, "5.61", -1), Shares(price=Decimal("587.5"), quantity=100)], spy
+        ),
+    }
+    assert list(result.index) == list(expected)
+    for key, margin in expected.items():
+        row = result.loc[key]
+        assert row.cash_requirement == margin.cash_requirement
+        assert row.margin_requirement == margin.margin_requirement
+
+
+def test_position_store(tmp_path):
+    pytest.importorskip("numpy")
+    from margin_estimator.store import (
+        PRICE_SCALE,
+        PositionStore,
+        calculate_margin_store,
+        write_store,
+    )
+
+    spy = Underlying(price=Decimal("587.88"), etf_type=ETFType.BROAD)
+    tqqq = Underlying(price=Decimal("77.35"), etf_type=ETFType.BROAD, leverage_factor=3)
+    expiration = date.today() + timedelta(days=120)
+    condor = [
+        Option(
+            expiration=expiration,
+            price=Decimal(price),
+            quantity=quantity,
+            strike=strike,
+            type=type,
+        )
+        for price, quantity, strike, type in [
+            ("4.78", 1, 567, OptionType.PUT),
+            ("5.61", -1, 572, OptionType.PUT),
+            ("5.23", -1, 602, OptionType.CALL),
+            ("3.68", 2, 607, OptionType.CALL),
+        ]
+    ]
+    covered = [
+        Option(
+            expiration=expiration,
+            price=Decimal("4.45"),
+            quantity=-1,
+            strike=Decimal("80.5"),
+            type=OptionType.CALL,
+        ),
+        Shares(price=Decimal("75.1234"), quantity=150),
+    ]
+    positions = [(2, "TQQQ", covered), (1, "SPY", condor), (2, "SPY", condor[:2])]
+    path = tmp_path / "book.bin"
+    write_store(path, {"SPY": spy, "TQQQ": tqqq}, positions)
+    with PositionStore(path) as store:
+        results = calculate_margin_store(store, tmp_path / "margins.npy")
+        assert len(store.legs) == 8
+    expected = [
+        (1, 0, calculate_margin(condor, spy)),
+        (2, 0, calculate_margin(condor[:2], spy)),
+        (2, 1, calculate_margin(covered, tqqq)),
+    ]
+    for row, (account, underlying, margin) in zip(results, expected):
+        assert row["account"] == account and row["underlying"] == underlying
+        assert row["cash_requirement"] == margin.cash_requirement * PRICE_SCALE
+        assert row["margin_requirement"] == margin.margin_requirement * PRICE_SCALE
+
+    # symbols longer than 12 bytes would be cut short
+    write_store(path, {"ABCDEFGHIJKL": spy}, [])
+    with PositionStore(path) as store:
+        assert store.underlyings["symbol"][0] == b"ABCDEFGHIJKL"
+    with pytest.raises(ValueError, match="too long"):
+        write_store(path, {"ABCDEFGHIJKLM": spy}, [])
+    with pytest.raises(ValueError, match="too long"):
+        write_store(path, {"ÄÖÜÄÖÜÄ": spy}, [])
+
+
+def test_iter_margins():
+    def portfolios():
+        for i in range(1, 50):
+            underlying = Underlying(price=100 + i)
+            put = Option(
+                expiration=date.today(),
+                price=i,
+                quantity=-i,
+                strike=100,
+                type=OptionType.PUT,
+            )
+            yield i, [put], underlying
+
+    expected = [(i, calculate_margin(legs, u)) for i, legs, u in portfolios()]
+    assert list(iter_margins(portfolios(), chunk_size=8)) == expected
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = iter_margins(portfolios(), chunk_size=5, executor=executor)
+        assert list(results) == expected
+
+    # longs lose their reduced requirement within 90 days of expiration
+    long_put = Option(
+        expiration=date.today() + timedelta(days=100),
+        price=4,
+        quantity=1,
+        strike=100,
+        type=OptionType.PUT,
+    )
+    later = date.today() + timedelta(days=20)
+    expected = calculate_margin([long_put], Underlying(price=100), later)
+    assert expected != calculate_margin([long_put], Underlying(price=100))
+    results = iter_margins([("a", [long_put], Underlying(price=100))], as_of=later)
+    assert list(results) == [("a", expected)]
+
+
+def test_marginal_margin():
+    underlying = Underlying(price=1060)
+    today = date.today()
+    tomorrow = today + timedelta(days=1)
+    book = [
+        Option(expiration=today, price=32, quantity=1, strike=1000, type="P"),
+        Option(expiration=today, price=35, quantity=-2, strike=1025, type="P"),
+        Option(expiration=today, price=9, quantity=-1, strike=1150, type="C"),
+        Option(expiration=tomorrow, price=6, quantity=1, strike=1175, type="C"),
+        Shares(price=1050, quantity=100),
+    ]
+    candidates = [
+        [Option(expiration=tomorrow, price=30, quantity=1, strike=1000, type="P")],
+        [Option(expiration=today, price=9, quantity=1, strike=1150, type="C")],
+        [
+            Option(expiration=today, price=8, quantity=-3, strike=1160, type="C"),
+            Option(expiration=today, price=20, quantity=-3, strike=1010, type="P"),
+        ],
+        [Shares(price=1060, quantity=-100)],
+        [],
+    ]
+    base = calculate_margin(book, underlying)
+    deltas = marginal_margin(book, candidates, underlying)
+    for candidate, delta in zip(candidates, deltas):
+        total = calculate_margin(book + candidate, underlying)
+        assert delta.cash_requirement == total.cash_requirement - base.cash_requirement
+        assert (
+            delta.margin_requirement
+            == total.margin_requirement - base.margin_requirement
+        )
+
+
+@pytest.mark.parametrize(
+    "underlying",
+    [
+        Underlying(price=Decimal("587.88"), etf_type=ETFType.BROAD),
+        Underlying(price=Decimal("11.03")),
+        Underlying(price=Decimal("77.35"), etf_type=ETFType.BROAD, leverage_factor=3),
+        Underlying(price=Decimal("390.7"), leverage_factor=2),
+    ],
+)
+def test_chain_margin_table(underlying):
+    strikes = [underlying.price * Decimal(m) / 100 for m in (80, 95, 100, 105, 120)]
+    expirations = [date.today(), date.today() + timedelta(days=200)]
+    call_prices = [
+        [Decimal("9.5"), Decimal("4.2"), Decimal("2.15"), None, Decimal("0.05")],
+        [Decimal("15.3"), Decimal("8.8"), Decimal("6.1"), Decimal("4.4"), None],
+    ]
+    put_prices = [
+        [Decimal("0.1"), Decimal("1.75"), Decimal("2.5"), Decimal("6.3"), None],
+        [Decimal("1.2"), Decimal("5.05"), Decimal("6.6"), None, Decimal("21.7")],
+    ]
+    table = chain_margin_table(
+        strikes, expirations, call_prices, put_prices, underlying
+    )
+    for i, expiration in enumerate(expirations):
+        for j, strike in enumerate(strikes):
+            for kind, prices in (("call", call_prices), ("put", put_prices)):
+                if prices[i][j] is None:
+                    assert getattr(table, f"short_{kind}_margin")[i][j] is None
+                    continue
+                for side, quantity in (("short", -1), ("long", 1)):
+                    option = Option(
+                        expiration=expiration,
+                        price=prices[i][j],
+                        quantity=quantity,
+                        strike=strike,
+                        type=OptionType.CALL if kind == "call" else OptionType.PUT,
+                    )
+                    margin = calculate_margin([option], underlying)
+                    cash = getattr(table, f"{side}_{kind}_cash")[i][j]
+                    assert cash == margin.cash_requirement
+                    requirement = getattr(table, f"{side}_{kind}_margin")[i][j]
+                    assert requirement == margin.margin_requirement
+
+
+def test_max_quantity():
+    underlying = Underlying(price=Decimal("587.88"), etf_type=ETFType.BROAD)
+    expiration = date.today()
+    condor = [
+        Option(
+            expiration=expiration,
+            price=Decimal(price),
+            quantity=quantity,
+            strike=strike,
+            type=type,
+        )
+        for price, quantity, strike, type in [
+            ("4.78", 1, 567, OptionType.PUT),
+            ("5.61", -1, 572, OptionType.PUT),
+            ("5.23", -1, 602, OptionType.CALL),
+            ("3.68", 1, 607, OptionType.CALL),
+        ]
+    ]
+    # the book's naked puts get covered by the condor's long puts first
+    book = [
+        Option(
+            expiration=expiration,
+            price=Decimal("3.1"),
+            quantity=-3,
+            strike=560,
+            type=OptionType.PUT,
+        ),
+        Shares(price=Decimal("580.1"), quantity=250),
+    ]
+    covered_call = [condor[2], Shares(price=Decimal("587.88"), quantity=50)]
+    for strategy in (condor, covered_call, condor[1:3]):
+        base = calculate_margin(book, underlying).margin_requirement
+
+        def additional(q):
+            scaled = [
+                leg.model_copy(update={"quantity": leg.quantity * q})
+                for leg in strategy
+            ]
+            return calculate_margin(book + scaled, underlying).margin_requirement - base
+
+        for buying_power in (Decimal(0), Decimal(1000), Decimal(12345), 10**6):
+            quantity = max_quantity(book, strategy, underlying, buying_power)
+            assert additional(quantity) <= buying_power
+            assert additional(quantity + 1) > buying_power
+
+
+def test_proportional_positions_share_cache():
+    underlying = Underlying(price=100)
+    today = date.today()
+
+    def position(size):
+        return [
+            Option(expiration=today, price=2, quantity=size, strike=90, type="P"),
+            Option(expiration=today, price=3, quantity=-2 * size, strike=95, type="P"),
+            Option(expiration=today, price=4, quantity=-3 * size, strike=110, type="C"),
+            Option(expiration=today, price=1, quantity=size, strike=120, type="C"),
+        ]
+
+    calculate_margin(position(1), underlying)
+    hits = _calculate_unit.cache_info().hits
+    # a single share doesn't cover anything, but skips the cache
+    share = Shares(price=100, quantity=1)
+    for size in (3, 7):
+        scaled = calculate_margin(position(size), underlying)
+        uncached = calculate_margin(position(size) + [share], underlying)
+        assert scaled + calculate_margin([share], underlying) == uncached
+    assert _calculate_unit.cache_info().hits == hits + 2
+
+
+def test_fast_path_stats():
+    underlying = Underlying(price=100)
+    today = date.today()
+    long = Option(expiration=today, price=1, quantity=2, strike=90, type="P")
+    short = Option(expiration=today, price=3, quantity=-2, strike=95, type="P")
+    calendar = Option(
+        expiration=today + timedelta(days=1), price=4, quantity=1, strike=90, type="P"
+    )
+    before = fast_path_stats()
+    vertical = calculate_margin([long, short], underlying)
+    assert vertical.margin_requirement == Decimal(600)
+    calculate_margin([long, short, calendar], underlying)
+    after = fast_path_stats()
+    assert after.calls == before.calls + 2
+    assert after.hits["vertical"] == before.hits.get("vertical", 0) + 1
+    assert sum(after.hits.values()) == sum(before.hits.values()) + 1
+    assert 0 < after.hit_rate <= 1
+
+    # counters of exited threads are folded together instead of piling up
+    live = len(_live_counts)
+    threads = [
+        threading.Thread(target=calculate_margin, args=([long, short], underlying))
+        for _ in range(20)
+    ]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    assert len(_live_counts) == live
+    final = fast_path_stats()
+    assert final.calls == after.calls + 20
+    assert final.hits["vertical"] == after.hits["vertical"] + 20
+
+
+def test_margin_bound():
+    underlying = Underlying(price=500)
+    today = date.today()
+    legs = [
+        Option(expiration=today, price=10, quantity=2, strike=510, type="C"),
+        Option(expiration=today, price=13, quantity=-2, strike=505, type="C"),
+        Option(expiration=today, price=5, quantity=-3, strike=520, type="C"),
+        Option(expiration=today, price=6, quantity=-2, strike=480, type="P"),
+        Option(expiration=today, price=2, quantity=1, strike=530, type="C"),
+        Shares(price=Decimal("499.5"), quantity=150),
+    ]
+    margin = calculate_margin(legs, underlying).margin_requirement
+    lower, upper = margin_bound(legs, underlying)
+    assert lower <= margin <= upper
+    assert check_margin(legs, underlying, upper)
+    assert not check_margin(legs, underlying, lower - 1)
+    assert check_margin(legs, underlying, margin)
+    assert not check_margin(legs, underlying, margin - 1)
+    # out of time, so anything undecided is rejected
+    assert not check_margin(legs, underlying, margin, deadline=0)
+
+
+def test_as_of():
+    underlying = Underlying(price=78)
+    call = Option(
+        expiration=date(2027, 6, 18), price=12, quantity=1, strike=80, type="C"
+    )
+    reduced = calculate_margin([call], underlying, as_of=date(2027, 3, 20))
+    assert reduced.margin_requirement == Decimal(900)
+    full = calculate_margin([call], underlying, as_of=date(2027, 3, 21))
+    assert full.margin_requirement == Decimal(1200)
+
+
+def test_margin_breakdown():
+    underlying = Underlying(price=100)
+    expiration = date.today() + timedelta(days=30)
+    shares = Shares(price=100, quantity=100)
+    legs = [
+        shares,
+        Option(expiration=expiration, price=2, quantity=-2, strike=110, type="C"),
+        Option(expiration=expiration, price=1, quantity=1, strike=115, type="C"),
+        Option(expiration=expiration, price=3, quantity=-1, strike=95, type="P"),
+        Option(expiration=expiration, price=1, quantity=-1, strike=90, type="P"),
+        Option(expiration=expiration, price=4, quantity=2, strike=100, type="P"),
+    ]
+    short_call = legs[1].model_copy(update={"quantity": -1})
+    margin = calculate_margin(legs, underlying, breakdown=True)
+    assert isinstance(margin, MarginBreakdown)
+    assert margin == calculate_margin(legs, underlying)
+    groups = {group.type: group for group in margin.groups}
+    assert [group.type for group in margin.groups] == ["stock", "spreads"]
+    assert groups["stock"].legs == [shares, short_call]
+    assert len(groups["spreads"].legs) == 6
+    total = sum((group.requirements for group in margin.groups), MarginRequirements())
+    assert total == margin
+    # groups are only calculated once
+    assert margin.groups is margin.groups
+
+    strangle = calculate_margin([short_call, legs[3]], underlying, breakdown=True)
+    [group] = strangle.groups
+    assert group.type == "strangle"
+    assert group.requirements == strangle
+
+    for _, legs, underlying in _random_portfolios(50):
+        margin = calculate_margin(legs, underlying, breakdown=True)
+        total = sum(
+            (group.requirements for group in margin.groups), MarginRequirements()
+        )
+        assert total == margin == calculate_margin(legs, underlying)
+    with pytest.raises(ValueError):
+        calculate_margin(legs, underlying, optimize=True, breakdown=True)
+
+
+def test_underlying_registry(tmp_path):
+    path = tmp_path / "underlyings.csv"
+    path.write_text(
+        "symbol,etf_type,leverage_factor\nSPY,broad-based,\nF,,\nTQQQ,narrow-based,3\n"
+    )
+    registry = UnderlyingRegistry(path)
+    assert "SPY" in registry and "QQQ" not in registry
+    with pytest.raises(ValueError):
+        registry["SPY"]
+    registry.update_prices([("SPY", Decimal(500)), (registry.index("TQQQ"), 60)])
+    assert registry["TQQQ"].leverage_factor == 3
+    for index in (-1, 3):
+        with pytest.raises(KeyError):
+            registry[index]
+        with pytest.raises(KeyError):
+            registry.update_prices([(index, Decimal(1))])
+
+    expiration = date.today() + timedelta(days=30)
+    put = Option(expiration=expiration, price=3, quantity=-1, strike=480, type="P")
+    spy = Underlying(price=500, etf_type=ETFType.BROAD)
+    expected = calculate_margin([put], spy)
+    assert calculate_margin([put], "SPY", registry=registry) == expected
+    spy_index = registry.index("SPY")
+    assert calculate_margin([put], spy_index, registry=registry) == expected
+    with pytest.raises(TypeError):
+        calculate_margin([put], "SPY")
+    assert calculate_margin_many([([put], "SPY")], registry=registry) == [expected]
+    assert list(iter_margins([("a", [put], spy_index)], registry=registry)) == [
+        ("a", expected)
+    ]
+
+    # prices and indexes survive a reload, and dropped symbols are unknown
+    path.write_text("symbol,etf_type,leverage_factor\nQQQ,,\nSPY,,\n")
+    assert registry.reload(force=True)
+    assert not registry.reload()
+    assert registry.index("SPY") == spy_index
+    assert registry["SPY"].price == 500 and registry["SPY"].etf_type is None
+    assert "QQQ" in registry and "F" not in registry
+    with pytest.raises(KeyError):
+        registry.update_prices([("F", Decimal(12))])
+
+
+def test_margin_timeline():
+    underlying = Underlying(price=100)
+    start = date(2027, 1, 4)
+    legs = [
+        Option(
+            expiration=start + timedelta(days=30),
+            price=Decimal("3.1"),
+            quantity=-2,
+            strike=95,
+            type="P",
+        ),
+        Option(
+            expiration=start + timedelta(days=150),
+            price=Decimal("4.4"),
+            quantity=1,
+            strike=90,
+            type="P",
+        ),
+        Option(
+            expiration=start + timedelta(days=200),
+            price=Decimal("6.35"),
+            quantity=3,
+            strike=110,
+            type="C",
+        ),
+        Shares(price=99, quantity=100),
+    ]
+    end = start + timedelta(days=250)
+    timeline = margin_timeline(legs, underlying, start, end)
+    assert timeline[0][0] == start
+    assert len(timeline) < 10
+    day = start
+    while day <= end:
+        alive = [
+            leg for leg in legs if isinstance(leg, Shares) or leg.expiration >= day
+        ]
+        expected = calculate_margin(alive, underlying, as_of=day)
+        assert [m for d, m in timeline if d <= day][-1] == expected
+        day += timedelta(days=1)
+
+
+def test_margin_sensitivity():
+    underlying = Underlying(price=100)
+    expiration = date.today() + timedelta(days=30)
+    legs = [
+        Option(expiration=expiration, price=3, quantity=-2, strike=105, type="C"),
+        Option(expiration=expiration, price=2, quantity=-2, strike=95, type="P"),
+        Option(expiration=expiration, price=1, quantity=-1, strike=90, type="P"),
+        Option(expiration=expiration, price=1, quantity=1, strike=85, type="P"),
+    ]
+    sensitivity = margin_sensitivity(legs, underlying)
+    for shift in (Decimal(0), Decimal("0.37"), Decimal("-0.21")):
+        moved = [leg.model_copy(update={"price": leg.price + shift}) for leg in legs]
+        price = underlying.price + shift
+        prices = {(leg.expiration, leg.strike, leg.type): leg.price for leg in moved}
+        margin = sensitivity.evaluate(
+            [prices[contract] for contract in sensitivity.contracts], price
+        )
+        expected = calculate_margin(moved, Underlying(price=price))
+        assert abs(margin - expected.margin_requirement) <= sensitivity.tolerance
+    # the put becomes greater than the call in the strangle
+    assert sensitivity.evaluate([Decimal(1)] * 4, Decimal(98)) is None
+
+
+def test_replay_engine():
+    underlyings = {"SPY": Underlying(price=600, etf_type=ETFType.BROAD)}
+    start = datetime(2027, 3, 1, 9, 30)
+    fills = [
+        Fill("a", "SPY   270319P00590000", Decimal("4.1"), -2, start),
+        Fill("b", "SPY   270319C00610000", Decimal("3.2"), -1, start),
+        Fill("a", "SPY   270319P00585000", Decimal("3.05"), 1, start),
+        Fill("a", "SPY", Decimal("599.5"), 100, start),
+        Fill("a", "SPY   270319C00610000", Decimal("3.25"), -1, start),
+        Fill("a", "SPY   270319P00585000", Decimal("3.1"), 1, start),
+        Fill("b", "SPY   270319C00610000", Decimal("3.3"), 1, start),
+        Fill("a", "SPY", Decimal("600.25"), -100, start),
+    ]
+    engine = ReplayEngine(underlyings)
+    results = list(engine.replay(fills, checkpoint_every=3))
+    for i, (fill, requirements) in enumerate(results):
+        book = [
+            Shares(price=f.price, quantity=f.quantity)
+            if f.symbol == "SPY"
+            else Option.from_occ(f.symbol, f.price, f.quantity)
+            for f in fills[: i + 1]
+            if f.account == fill.account
+        ]
+        expected = calculate_margin(book, underlyings["SPY"], as_of=start.date())
+        assert requirements == expected
+    assert [c.position for c in engine.checkpoints] == [3, 6]
+    checkpoint = pickle.loads(pickle.dumps(engine.checkpoints[0]))
+    resumed = ReplayEngine.from_checkpoint(checkpoint, underlyings)
+    assert list(resumed.replay(fills)) == results[3:]
+
+
+def test_margin_aggregator():
+    rng = random.Random(7)
+    results = [
+        (
+            (f"account-{rng.randrange(20)}", rng.choice(["SPY", "F", "QQQ"])),
+            MarginRequirements(
+                cash_requirement=Decimal(rng.randrange(10**6)) / 100,
+                margin_requirement=Decimal(rng.randrange(10**6)) / 100,
+            ),
+        )
+        for _ in range(500)
+    ]
+    etf_types = {"SPY": ETFType.BROAD, "QQQ": ETFType.BROAD}
+    whole = MarginAggregator(top_n=10).consume(results, etf_types)
+    assert whole.count == 500
+    assert whole.total.margin_requirement == sum(
+        r.margin_requirement for _, r in results
+    )
+    assert whole.by_etf_type[None].cash_requirement == sum(
+        r.cash_requirement for (_, u), r in results if u == "F"
+    )
+    assert whole.by_account["account-3"].margin_requirement == sum(
+        r.margin_requirement for (a, _), r in results if a == "account-3"
+    )
+    largest = sorted(results, key=lambda r: r[1].margin_requirement, reverse=True)
+    assert whole.top_consumers() == [(a, u, r) for (a, u), r in largest[:10]]
+
+    # partial aggregators from workers merge into the same result
+    first = MarginAggregator(top_n=10).consume(results[:200], etf_types)
+    second = MarginAggregator(top_n=10).consume(results[200:], etf_types)
+    merged = first.merge(pickle.loads(pickle.dumps(second)))
+    assert merged.total == whole.total
+    assert merged.by_etf_type == whole.by_etf_type
+    assert merged.by_account == whole.by_account
+    assert merged.top_consumers() == whole.top_consumers()
+
+
+def _start_worker(handler=_ShardHandler) -> tuple[WorkerServer, tuple[str, int]]:
+    server = WorkerServer(port=0)
+    server.RequestHandlerClass = handler
+    threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+    return server, server.server_address[:2]
+
+
+class _DroppingHandler(_ShardHandler):
+    def handle(self):
+        self.request.recv(1)
+
+
+def _random_portfolios(n: int) -> list:
+    rng = random.Random(3)
+    expiration = date.today() + timedelta(days=30)
+    portfolios = []
+    for i in range(n):
+        legs = [
+            Option(
+                expiration=expiration + timedelta(days=rng.choice([0, 120])),
+                price=Decimal(rng.randrange(5, 900)) / 100,
+                quantity=rng.choice([-2, -1, 1, 3]),
+                strike=Decimal(rng.randrange(80, 121, 5)),
+                type=rng.choice(["C", "P"]),
+            )
+            for _ in range(rng.randrange(1, 6))
+        ]
+        if rng.random() < 0.2:
+            legs.append(Shares(price=Decimal("100.5"), quantity=100))
+        underlying = Underlying(
+            price=Decimal(rng.randrange(9000, 11000)) / 100,
+            etf_type=rng.choice([None, ETFType.BROAD]),
+        )
+        portfolios.append((("account", i), legs, underlying))
+    return portfolios
+
+
+def test_distribute_margins():
+    portfolios = _random_portfolios(200)
+    servers = [_start_worker() for _ in range(2)]
+    flaky = _start_worker(_DroppingHandler)
+    # nothing listens on a closed port
+    unused = socket.socket()
+    unused.bind(("127.0.0.1", 0))
+    dead = unused.getsockname()
+    unused.close()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "margin_estimator.worker", "--port", "0"],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        host, port = process.stdout.readline().split()[-1].rsplit(":", 1)
+        workers = [address for _, address in servers]
+        workers += [flaky[1], dead, (host, int(port))]
+        results = distribute_margins(portfolios, workers, shard_size=16)
+    finally:
+        process.terminate()
+        process.wait()
+        for server, _ in [*servers, flaky]:
+            server.shutdown()
+    assert [key for key, _ in results] == [key for key, _, _ in portfolios]
+    for (_, legs, underlying), (_, requirements) in zip(portfolios, results):
+        assert requirements == calculate_margin(legs, underlying)
+
+    flaky = _start_worker(_DroppingHandler)
+    with pytest.raises(ShardError):
+        distribute_margins(portfolios, [flaky[1]], shard_size=16)
+    flaky[0].shutdown()
+
+
+def test_distribute_margins_steals_from_stragglers():
+    release = threading.Event()
+
+    class StuckHandler(_ShardHandler):
+        def handle(self):
+            release.wait()
+
+    portfolios = _random_portfolios(40)
+    stuck = _start_worker(StuckHandler)
+    healthy = _start_worker()
+    try:
+        results = distribute_margins(portfolios, [stuck[1], healthy[1]], shard_size=10)
+    finally:
+        release.set()
+        stuck[0].shutdown()
+        healthy[0].shutdown()
+    assert [r for _, r in results] == [
+        calculate_margin(legs, underlying) for _, legs, underlying in portfolios
+    ]
+
+
+def test_calculate_margin_many_across_threads():
+    positions = [(legs, underlying) for _, legs, underlying in _random_portfolios(400)]
+    expected = [calculate_margin(legs, underlying) for legs, underlying in positions]
+    start = fast_path_stats()
+    assert calculate_margin_many(positions) == expected
+    serial = fast_path_stats()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert calculate_margin_many(positions, executor, chunk_size=7) == expected
+    threaded = fast_path_stats()
+    # no counter updates are lost between threads
+    assert threaded.calls - serial.calls == serial.calls - start.calls == 400
+    for name, hits in serial.hits.items():
+        assert threaded.hits[name] - hits == hits - start.hits.get(name, 0)
+
+
+def test_portfolio_margin():
+    broad = Underlying(price=100, etf_type=ETFType.BROAD)
+    shares = Shares(price=100, quantity=100)
+    # stock loses the whole move
+    assert portfolio_margin([shares], broad).margin_requirement == 1500
+    leveraged = Underlying(price=100, etf_type=ETFType.BROAD, leverage_factor=2)
+    assert portfolio_margin([shares], leveraged).margin_requirement == 3000
+
+    expiration = date.today() + timedelta(days=45)
+    long_put = Option(expiration=expiration, price=3, quantity=2, strike=95, type="P")
+    short_call = Option(
+        expiration=expiration, price=Decimal("2.4"), quantity=-1, strike=105, type="C"
+    )
+    # a long option can't lose more than its premium
+    assert 0 < portfolio_margin([long_put], broad).margin_requirement <= 600
+    # hedges reduce the worst-case loss
+    hedged = portfolio_margin([shares, long_put, short_call], broad)
+    assert (
+        hedged.margin_requirement < portfolio_margin([shares], broad).margin_requirement
+    )
+    assert (
+        hedged.cash_requirement
+        == calculate_margin([shares, long_put, short_call], broad).cash_requirement
+    )
+
+    # 5x leverage moves an equity by up to 125%, which floors the price near zero
+    equity = Underlying(price=100, leverage_factor=5)
+    assert portfolio_margin([shares], equity).margin_requirement == Decimal("9999.99")
+    volatility = Underlying(price=100, etf_type=ETFType.VOLATILITY, leverage_factor=3)
+    short_put = long_put.model_copy(update={"quantity": -1})
+    margin = portfolio_margin([short_put, short_call], volatility)
+    # the put loses at most its strike less premium, the call its upside
+    assert 9200 < margin.margin_requirement < 15000
+
+    positions = [(legs, u) for _, legs, u in _random_portfolios(50)]
+    assert portfolio_margin_many(positions) == [
+        portfolio_margin(legs, u) for legs, u in positions
+    ]
+
+
+def test_optimized_grouping():
+    underlying = Underlying(price=100)
+    expiration = date.today() + timedelta(days=30)
+    legs = [
+        Option(expiration=expiration, price=3, quantity=-1, strike=95, type="P"),
+        Option(expiration=expiration, price=3, quantity=1, strike=110, type="P"),
+        Option(expiration=expiration, price=3, quantity=-1, strike=100, type="P"),
+    ]
+    # the greedy matching covers the 95 put, leaving the costlier 100 put naked
+    greedy = calculate_margin(legs, underlying)
+    optimized = calculate_margin(legs, underlying, optimize=True, time_budget=1)
+    assert greedy.margin_requirement == 2300
+    assert optimized.margin_requirement == 1800
+    # without time to solve, the greedy result is used
+    assert calculate_margin(legs, underlying, optimize=True, time_budget=0) == greedy
+
+    for _, legs, u in _random_portfolios(200):
+        assert (
+            calculate_margin(legs, u, optimize=True).margin_requirement
+            <= calculate_margin(legs, u).margin_requirement
+        )
+
+    # a multi-lot strangle can't be regrouped, so optimizing doesn't change it
+    for quantity in (1, 5, 10):
+        strangle = [
+            Option(
+                expiration=expiration, price=2, quantity=-quantity, strike=110, type="C"
+            ),
+            Option(
+                expiration=expiration, price=3, quantity=-quantity, strike=90, type="P"
+            ),
+        ]
+        assert calculate_margin(
+            strangle, underlying, optimize=True, time_budget=1
+        ) == calculate_margin(strangle, underlying)
+
+
+def test_find_margin_hedges():
+    underlying = Underlying(price=100)
+    near = date.today() + timedelta(days=30)
+    far = date.today() + timedelta(days=60)
+    book = [
+        Option(expiration=near, price=4, quantity=-2, strike=105, type="C"),
+        Option(expiration=near, price=5, quantity=-1, strike=95, type="P"),
+        Option(expiration=far, price=8, quantity=1, strike=115, type="C"),
+    ]
+    rng = random.Random(0)
+    chain = [
+        Option(
+            expiration=expiration,
+            price=Decimal(rng.randrange(5, 1500)) / 100,
+            quantity=1,
+            strike=strike,
+            type=option_type,
+        )
+        for expiration in (near, far)
+        for strike in range(80, 125, 5)
+        for option_type in ("C", "P")
+    ]
+    hedges = find_margin_hedges(book, chain, underlying, top_k=5)
+    assert len(hedges) == 5
+    base = calculate_margin(book, underlying).margin_requirement
+    for hedge in hedges:
+        total = calculate_margin([*book, hedge.leg], underlying)
+        assert hedge.margin_reduction == base - total.margin_requirement
+        assert hedge.premium == hedge.leg.price * 100
+    efficiencies = [hedge.reduction_per_premium for hedge in hedges]
+    assert efficiencies == sorted(efficiencies, reverse=True)
+    # the same as trying every contract
+    best = max(
+        (base - calculate_margin([*book, contract], underlying).margin_requirement)
+        / (contract.price * 100)
+        for contract in chain
+    )
+    assert efficiencies[0] == best
+    assert find_margin_hedges(book, [], underlying) == []
+
+
+def test_find_margin_hedges_book_long():
+    underlying = Underlying(price=100)
+    near = date.today() + timedelta(days=30)
+    book = [
+        Option(expiration=near, price=4, quantity=-2, strike=105, type="C"),
+        Option(expiration=near, price=1, quantity=1, strike=110, type="C"),
+    ]
+    # the 110 call is quoted higher than the book bought it for
+    chain = [
+        Option(expiration=near, price=price, quantity=1, strike=strike, type="C")
+        for strike, price in ((110, 3), (115, Decimal("1.5")), (120, 1))
+    ]
+    hedges = find_margin_hedges(book, chain, underlying, top_k=1)
+    # netted into the book's long at the book's price
+    assert hedges[0].leg.strike == 110
+    assert hedges[0].premium == 100
+    base = calculate_margin(book, underlying).margin_requirement
+    total = calculate_margin([*book, chain[0]], underlying)
+    assert hedges[0].margin_reduction == base - total.margin_requirement
+
+
+def test_stress_margins():
+    portfolios = _random_portfolios(60)
+    underlyings = {f"U{i}": u for i, (_, _, u) in enumerate(portfolios)}
+    groups = [(i % 7, f"U{i}", legs) for i, (_, legs, _) in enumerate(portfolios)]
+    betas = {f"U{i}": 0.5 + i % 4 / 2 for i in range(len(portfolios))}
+    shocks = [-0.2, -0.05, 0, 0.1]
+    result = stress_margins(groups, underlyings, betas, shocks)
+    assert result.margin.shape == result.cash.shape == (60, 4)
+    for row, (_, symbol, legs) in enumerate(groups):
+        underlying = underlyings[symbol]
+        for column, shock in enumerate(shocks):
+            price = underlying.price * (1 + Decimal(str(betas[symbol] * shock)))
+            assert result.prices[row, column] == pytest.approx(float(price))
+            expected = calculate_margin(
+                legs, underlying.model_copy(update={"price": price})
+            )
+            assert result.margin[row, column] == pytest.approx(
+                float(expected.margin_requirement), abs=0.01
+            )
+            assert result.cash[row, column] == pytest.approx(
+                float(expected.cash_requirement), abs=0.01
+            )
+    accounts = result.account_margin()
+    assert accounts.keys() == set(range(7))
+    assert accounts[3] == pytest.approx(result.margin[3::7].sum(axis=0))
+
+
+def test_snapshot_margins():
+    portfolios = _random_portfolios(50)
+    first = snapshot_margins(portfolios)
+    assert len(first.recalculated) == 50
+    for key, legs, underlying in portfolios:
+        assert first.results[key] == calculate_margin(legs, underlying)
+
+    # change one portfolio's legs and another's underlying, and drop a third
+    changed = list(portfolios[:-1])
+    key, legs, underlying = changed[3]
+    changed[3] = (key, [*legs, Shares(price=100, quantity=100)], underlying)
+    key, legs, underlying = changed[7]
+    changed[7] = (key, legs, Underlying(price=underlying.price + 1))
+    second = snapshot_margins(changed, pickle.loads(pickle.dumps(first)))
+    assert second.recalculated == [changed[3][0], changed[7][0]]
+    assert len(second.results) == 49
+    for key, legs, underlying in changed:
+        assert second.results[key] == calculate_margin(legs, underlying)
+
+    # only portfolios with longs crossing the reduced requirement's cutoff change
+    later = date.today() + timedelta(days=61)
+    third = snapshot_margins(changed, second, as_of=later)
+    assert 0 < len(third.recalculated) < 49
+    for key, legs, underlying in changed:
+        assert third.results[key] == calculate_margin(legs, underlying, later)
+
+
+def test_tick_fanout():
+    spy = Underlying(price=500, etf_type=ETFType.BROAD)
+    table = PriceTable()
+    fanout = TickFanout({"SPY": spy, "F": Underlying(price=12)}, table)
+    call = "SPY   261218C00550000"
+    put = "SPY   261218P00450000"
+    assert fanout.on_tick([(call, Decimal("4.5"))]) == {}
+    fanout.set_book("a", "SPY", {call: -1, put: -2})
+    fanout.set_book("b", "SPY", {call: 1, "SPY": 100})
+    fanout.set_book("c", "F", {"F": -100})
+    # the put has no price yet
+    assert fanout.requirements("a") is None
+    assert fanout.on_tick([(put, Decimal("3.1"))]).keys() == {"a"}
+
+    def expected(legs, price=Decimal(500)):
+        underlying = Underlying(price=price, etf_type=ETFType.BROAD)
+        return calculate_margin(legs, underlying)
+
+    expiration = date(2026, 12, 18)
+    short_call = Option(
+        expiration=expiration, price=4, quantity=-1, strike=550, type="C"
+    )
+    short_puts = Option(
+        expiration=expiration, price=3, quantity=-2, strike=450, type="P"
+    )
+    long_call = short_call.model_copy(update={"quantity": 1})
+    results = fanout.on_tick([(call, Decimal(4)), (put, Decimal(3))])
+    assert results.keys() == {"a", "b"}
+    assert results["a"] == expected([short_call, short_puts])
+    shares = Shares(price=500, quantity=100)
+    assert results["b"] == expected([long_call, shares])
+
+    # underlying ticks reach every book on it, and reprice its shares
+    results = fanout.on_tick([("SPY", Decimal(510))])
+    assert results.keys() == {"a", "b"}
+    shares = Shares(price=510, quantity=100)
+    assert results["b"] == expected([long_call, shares], Decimal(510))
+    assert table["SPY"] == 510
+
+    fanout.remove_book("a")
+    assert fanout.on_tick([(put, Decimal("3.2"))]) == {}
+    with pytest.raises(ValueError):
+        fanout.set_book("d", "F", {call: 1})